@@ -10,8 +10,11 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/6.0/ref/settings/
 """
 
+import os
 from pathlib import Path
 
+from django.core.exceptions import ImproperlyConfigured
+
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -41,6 +44,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'hospital.metrics.MetricsMiddleware',  # First, so its timing covers everything below
+    'hospital.admission.AdmissionControlMiddleware',  # 429s before sessions, auth or the ORM
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -48,7 +53,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
-    'whitenoise.middleware.WhiteNoiseMiddleware',
+    'hospital.middleware.WhiteNoiseMiddleware',  # Async-capable WhiteNoise
 ]
 
 ROOT_URLCONF = 'config.urls'
@@ -74,11 +79,79 @@ WSGI_APPLICATION = 'config.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/6.0/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+# DB_ENGINE=sqlite (default) or postgres. SQLite connections are tuned for
+# concurrent writers on connect (hospital/db.py).
+
+DB_ENGINE = os.environ.get('DB_ENGINE', 'sqlite')
+
+if DB_ENGINE == 'postgres':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.environ.get('POSTGRES_DB', 'smarthospital'),
+            'USER': os.environ.get('POSTGRES_USER', 'postgres'),
+            'PASSWORD': os.environ.get('POSTGRES_PASSWORD', ''),
+            'HOST': os.environ.get('POSTGRES_HOST', 'localhost'),
+            'PORT': os.environ.get('POSTGRES_PORT', '5432'),
+            # Off by default: under ASGI each request runs its sync code on a thread of
+            # its own, so a persistent connection is never reused, only closed late
+            'CONN_MAX_AGE': int(os.environ.get('DB_CONN_MAX_AGE', '0')),
+            'CONN_HEALTH_CHECKS': True,
+        }
     }
+elif DB_ENGINE == 'sqlite':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            # db.sqlite3 is the checked-in demo data. Local runs use a copy, so the
+            # WAL pragma and migrations never dirty it: cp db.sqlite3 local.sqlite3
+            'NAME': os.environ.get('SQLITE_PATH', BASE_DIR / 'local.sqlite3'),
+            'OPTIONS': {
+                # Take the write lock at BEGIN: a deferred transaction that later
+                # upgrades to a writer fails at once with "database is locked"
+                'transaction_mode': 'IMMEDIATE',
+                'timeout': 5,
+            },
+        }
+    }
+else:
+    raise ImproperlyConfigured(f"DB_ENGINE must be 'sqlite' or 'postgres', not {DB_ENGINE!r}")
+
+# Applied to every new SQLite connection. WAL lets readers run alongside the
+# single writer; NORMAL sync is durable across app crashes in WAL mode.
+SQLITE_PRAGMAS = {
+    'journal_mode': os.environ.get('SQLITE_JOURNAL_MODE', 'WAL'),
+    'synchronous': 'NORMAL',
+    'busy_timeout': 5000,             # ms to wait for the write lock
+    'mmap_size': 256 * 1024 * 1024,   # read pages through the OS cache
+    'cache_size': -20000,             # ~20 MB page cache per connection
+    'temp_store': 'MEMORY',
+}
+
+
+# Cache
+# Holds the per-doctor queue state (hospital/queue_state.py). Sized so two
+# entries per doctor never get culled; point it at a shared backend before
+# running more than one worker process. 'admission' holds the rate-limit
+# buckets and idempotency keys (hospital/admission.py), kept apart so a flood
+# of client buckets can never push queue state out.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'smarthospital',
+        'OPTIONS': {'MAX_ENTRIES': 10000},
+    },
+    # Admission buckets and idempotency keys (hospital/admission.py): per
+    # process unless ADMISSION_REDIS_URL points every worker at one Redis
+    'admission': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': os.environ['ADMISSION_REDIS_URL'],
+    } if os.environ.get('ADMISSION_REDIS_URL') else {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'smarthospital-admission',
+        'OPTIONS': {'MAX_ENTRIES': 50000},
+    },
 }
 
 
@@ -131,4 +204,80 @@ STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
 SECURE_CROSS_ORIGIN_OPENER_POLICY = 'same-origin-allow-popups'
 
 # Mandatory for Google Cloud Run
-CSRF_TRUSTED_ORIGINS = ['https://*.run.app']
\ No newline at end of file
+CSRF_TRUSTED_ORIGINS = ['https://*.run.app']
+
+# Firebase Realtime Database (live queue cards). Views queue changes and a
+# background worker pushes them; an empty URL turns syncing off.
+FIREBASE_DB_URL = os.environ.get('FIREBASE_DB_URL', 'https://smarthospital-63b2c-default-rtdb.firebaseio.com')
+
+# Pre-rendered token PDFs (hospital/pdf.py): cache directory and render processes
+# (0 workers turns background pre-rendering off; downloads then render on demand)
+TOKEN_PDF_DIR = os.environ.get('TOKEN_PDF_DIR', str(BASE_DIR / 'media' / 'token_pdfs'))
+TOKEN_PDF_WORKERS = int(os.environ.get('TOKEN_PDF_WORKERS', '1'))
+
+# Finished appointments older than this many days move to the archive table
+# (manage.py archive_appointments [--loop]); the live table keeps only recent days
+ARCHIVE_AFTER_DAYS = int(os.environ.get('ARCHIVE_AFTER_DAYS', '3'))
+
+# Import the lazily loaded PDF / Firebase libraries in a background thread once
+# the first response is out (hospital/warmup.py); set to 0 to keep them on demand
+WARMUP_AFTER_FIRST_REQUEST = os.environ.get('WARMUP_AFTER_FIRST_REQUEST', '1') == '1'
+
+# Admission control (hospital/admission.py). Requests are sorted into lanes by
+# URL name; 'per_client', 'per_address' and 'total' are token buckets as
+# (requests per second, burst). A lane without buckets is a priority lane and
+# is never throttled.
+ADMISSION_CACHE = 'admission'
+ADMISSION_LANES = {
+    'doctor': {
+        'views': ['doctor_dashboard', 'call_patient', 'complete_appointment', 'toggle_duty'],
+    },
+    'checkin': {
+        'views': ['patient_check_in', 'bulk_check_in'],
+        'methods': ['POST'],
+        'per_client': (0.2, 5),
+        'per_address': (2, 30),
+        'total': (20, 50),
+    },
+    'polling': {
+        'views': ['patient_live_status', 'get_doctors', 'public_display'],
+        'per_client': (0.5, 10),
+        'per_address': (20, 100),
+        'total': (200, 400),
+    },
+}
+# Proxies in front of the app that append the caller's address to
+# X-Forwarded-For (Cloud Run's front end is one). 0: use REMOTE_ADDR
+ADMISSION_TRUSTED_PROXIES = int(os.environ.get('ADMISSION_TRUSTED_PROXIES', '1'))
+
+# Check-in idempotency keys: how long a key is remembered, and how long a
+# duplicate submit waits for the first one to finish
+IDEMPOTENCY_KEY_TTL = 3600
+IDEMPOTENCY_WAIT = 5
+
+# "Your turn is near" emails (hospital/notify.py): a waiting patient is emailed
+# once, when a call leaves at most this many patients ahead of them or their
+# estimated start is this many minutes away. Sent in batches of up to
+# TURN_NOTIFY_BATCH_SIZE over one SMTP connection by a background worker.
+TURN_NOTIFY_PATIENTS_AHEAD = int(os.environ.get('TURN_NOTIFY_PATIENTS_AHEAD', '2'))
+TURN_NOTIFY_MINUTES_AWAY = int(os.environ.get('TURN_NOTIFY_MINUTES_AWAY', '15'))
+TURN_NOTIFY_BATCH_SIZE = 50
+TURN_NOTIFY_IN_BACKGROUND = True
+
+EMAIL_BACKEND = os.environ.get('EMAIL_BACKEND', 'django.core.mail.backends.console.EmailBackend')
+EMAIL_HOST = os.environ.get('EMAIL_HOST', 'localhost')
+EMAIL_PORT = int(os.environ.get('EMAIL_PORT', '587'))
+EMAIL_HOST_USER = os.environ.get('EMAIL_HOST_USER', '')
+EMAIL_HOST_PASSWORD = os.environ.get('EMAIL_HOST_PASSWORD', '')
+EMAIL_USE_TLS = os.environ.get('EMAIL_USE_TLS', '1') == '1'
+EMAIL_TIMEOUT = 10
+DEFAULT_FROM_EMAIL = os.environ.get('DEFAULT_FROM_EMAIL', 'Smart Hospital <no-reply@smarthospital.local>')
+
+# Analytics rollups (hospital/analytics.py) only fold events recorded at least
+# this long ago, so a transaction that commits a lower event id late is not
+# skipped. Keep it above the longest transaction that writes events.
+ROLLUP_LAG_SECONDS = int(os.environ.get('ROLLUP_LAG_SECONDS', '120'))
+
+# /metrics answers staff users and scrapers sending "Authorization: Bearer
+# <METRICS_TOKEN>" (Prometheus: authorization.credentials). Unset: staff only.
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
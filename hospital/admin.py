@@ -1,10 +1,94 @@
+from datetime import date, timedelta
+
 from django.contrib import admin
-from .models import Department, Doctor, Appointment
+from django.db import transaction
+from django.template.response import TemplateResponse
+from django.utils import timezone
+
+from . import analytics
+from .models import Department, Doctor, Appointment, AppointmentEvent, ArchivedAppointment, DepartmentRollup
 
 admin.site.register(Department)
 admin.site.register(Doctor)
 
+# Appointment status -> the event an admin edit records
+STATUS_EVENTS = {'in_consultation': 'called', 'completed': 'completed', 'cancelled': 'cancelled'}
+
 @admin.register(Appointment)
 class AppointmentAdmin(admin.ModelAdmin):
     list_display = ('token_number', 'patient_name', 'doctor', 'status', 'estimated_start_time')
-    list_filter = ('status', 'doctor')
\ No newline at end of file
+    list_filter = ('status', 'doctor')
+
+    def save_model(self, request, obj, form, change):
+        # Cancellations happen here: log them with the save, like the views do. The cached queues of the
+        # old and new doctor are invalidated after the commit by queue_state's signal handlers
+        with transaction.atomic():
+            super().save_model(request, obj, form, change)
+            if not change:
+                AppointmentEvent.record(obj, 'booked')
+            elif 'status' in form.changed_data and obj.status in STATUS_EVENTS:
+                AppointmentEvent.record(obj, STATUS_EVENTS[obj.status], timezone.now())
+            elif 'doctor' in form.changed_data:
+                AppointmentEvent.record(obj, 'reassigned', timezone.now())
+
+@admin.register(ArchivedAppointment)
+class ArchivedAppointmentAdmin(admin.ModelAdmin):
+    list_display = ('ticket_id', 'token_number', 'patient_name', 'doctor', 'status', 'booked_at')
+    list_filter = ('status', 'doctor')
+    search_fields = ('ticket_id', 'patient_name', 'patient_email')
+    date_hierarchy = 'booked_at'
+
+    # Archived rows are history: read-only
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+@admin.register(AppointmentEvent)
+class AppointmentEventAdmin(admin.ModelAdmin):
+    list_display = ('appointment_id', 'kind', 'doctor', 'department', 'at', 'wait_minutes', 'duration_minutes')
+    list_filter = ('kind', 'department')
+    date_hierarchy = 'at'
+
+    # The log is append-only
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+@admin.register(DepartmentRollup)
+class AnalyticsAdmin(admin.ModelAdmin):
+    """The department analytics page: reads only the rollups (manage.py rollup_events)."""
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+    def changelist_view(self, request, extra_context=None):
+        last_day = _day(request.GET.get('end')) or timezone.localdate()
+        first_day = _day(request.GET.get('start')) or last_day - timedelta(days=29)
+        if first_day > last_day:
+            first_day, last_day = last_day, first_day
+        return TemplateResponse(request, 'admin/hospital/analytics.html', {
+            **self.admin_site.each_context(request),
+            'title': 'Department analytics',
+            'opts': self.model._meta,
+            'report': analytics.report(first_day, last_day),
+            **(extra_context or {}),
+        })
+
+def _day(value):
+    try:
+        return date.fromisoformat(value) if value else None
+    except ValueError:
+        return None
@@ -0,0 +1,241 @@
+"""
+Admission control for the hot patient endpoints, plus idempotent check-in.
+
+At OPD opening hundreds of phones poll live status and re-submit the
+check-in form at once. Without a gate that traffic queues up in front of
+the doctors' own call / complete clicks on the same database.
+
+AdmissionControlMiddleware sorts each request into a lane by URL name
+(settings.ADMISSION_LANES). A lane can limit each client, each address
+and the lane as a whole with token buckets. Over the limit, the request gets
+a plain 429 with Retry-After before sessions, auth or any ORM work. Lanes
+without limits (the doctor actions) are never throttled, so they keep the
+capacity the patient lanes are capped below.
+
+A client is its address plus its session or CSRF cookie: phones behind one
+hospital Wi-Fi share an address but not a cookie. A client that drops its
+cookies gets a fresh per-client bucket, so the looser per-address bucket
+still bounds what one address can send.
+
+Buckets live in the ADMISSION_CACHE cache. Each take is one atomic incr,
+using GCRA, the token bucket written as a single "theoretical arrival time"
+per bucket. By default that cache is in-process memory, so each worker
+process counts on its own and the limits apply per worker. Set
+ADMISSION_REDIS_URL to share the counts between all workers and instances.
+
+Idempotency keys: the check-in form carries a one-off key (an API client
+sends an Idempotency-Key header). A double submit with the same key waits
+for the first booking and gets the same answer, instead of a second token.
+"""
+import hashlib
+import math
+import re
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.http import HttpResponse
+from django.urls import Resolver404, resolve
+
+
+def _cache():
+    return caches[settings.ADMISSION_CACHE]
+
+
+# ==========================================
+# TOKEN BUCKETS
+# ==========================================
+
+def take(key, rate, burst, now=None):
+    """
+    Takes one token from the bucket (`rate` tokens per second, holding at most
+    `burst`). Returns 0 when admitted, else the seconds until a token is free.
+    """
+    cache = _cache()
+    now_ms = int((time.time() if now is None else now) * 1000)
+    interval = max(int(1000 / rate), 1)
+    limit = burst * interval
+    timeout = math.ceil(limit / 1000) + 1  # An idle bucket is full again by then
+    try:
+        tat = cache.incr(key, interval)
+    except ValueError:
+        if cache.add(key, now_ms + interval, timeout):
+            return 0
+        tat = cache.incr(key, interval)
+    if tat <= now_ms + interval:
+        # Idle since its last use: restart from now (a racing request may get one extra token)
+        cache.set(key, now_ms + interval, timeout)
+        return 0
+    if tat - now_ms <= limit:
+        cache.touch(key, timeout)
+        return 0
+    cache.decr(key, interval)  # Rejected requests don't use up tokens
+    return (tat - now_ms - limit) / 1000
+
+
+def client_address(request):
+    """
+    The caller's address. Each of the ADMISSION_TRUSTED_PROXIES proxies in
+    front of the app appends the address it saw to X-Forwarded-For, so the
+    caller is that many entries from the right. Entries further left come
+    from the client itself and could be anything.
+    """
+    hops = settings.ADMISSION_TRUSTED_PROXIES
+    if hops:
+        forwarded = [hop.strip() for hop in request.META.get('HTTP_X_FORWARDED_FOR', '').split(',')]
+        if len(forwarded) >= hops and forwarded[-hops]:
+            return forwarded[-hops]
+    return request.META.get('REMOTE_ADDR', '')
+
+
+def client_id(request, address=None):
+    """Who is asking: the address, plus a hash of the session or CSRF cookie when there is one."""
+    address = client_address(request) if address is None else address
+    cookie = request.COOKIES.get(settings.SESSION_COOKIE_NAME) or request.COOKIES.get(settings.CSRF_COOKIE_NAME)
+    if cookie:
+        return f"{address}:{hashlib.sha256(cookie.encode()).hexdigest()[:16]}"
+    return address
+
+
+def compile_lanes(lanes):
+    """settings.ADMISSION_LANES -> {url name: (lane, config)}."""
+    return {view: (lane, config) for lane, config in lanes.items() for view in config['views']}
+
+
+def admit(request, lane, config):
+    """Seconds the request has to wait (0: admit now) under the lane's buckets."""
+    if 'methods' in config and request.method not in config['methods']:
+        return 0
+    address = client_address(request)
+    if 'per_client' in config:
+        wait = take(f"admission:{lane}:c:{client_id(request, address)}", *config['per_client'])
+        if wait:
+            return wait
+    if 'per_address' in config:
+        wait = take(f"admission:{lane}:a:{address}", *config['per_address'])
+        if wait:
+            return wait
+    if 'total' in config:
+        return take(f"admission:{lane}", *config['total'])
+    return 0
+
+
+def too_many_requests(wait):
+    seconds = max(math.ceil(wait), 1)
+    response = HttpResponse(
+        f"Too many requests. Please retry in {seconds} s.\n", status=429, content_type='text/plain'
+    )
+    response['Retry-After'] = str(seconds)
+    response['Cache-Control'] = 'no-store'
+    return response
+
+
+class AdmissionControlMiddleware:
+    """
+    Goes right after MetricsMiddleware, ahead of sessions and auth: a rejected
+    request costs one URL resolve and a cache incr or two.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.lanes = compile_lanes(settings.ADMISSION_LANES)
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        found = self._lane(request)
+        if found is not None:
+            wait = admit(request, *found[1])
+            if wait:
+                return self._reject(request, found[0], wait)
+        return self.get_response(request)
+
+    async def __acall__(self, request):
+        found = self._lane(request)
+        if found is not None:
+            # The buckets are blocking cache round trips (to Redis with
+            # ADMISSION_REDIS_URL): keep them off the event loop
+            wait = await sync_to_async(admit, thread_sensitive=False)(request, *found[1])
+            if wait:
+                return self._reject(request, found[0], wait)
+        return await self.get_response(request)
+
+    def _lane(self, request):
+        """(resolver match, lane) for a limited view, else None. No I/O."""
+        if not self.lanes:
+            return None
+        try:
+            match = resolve(request.path_info)
+        except Resolver404:
+            return None  # Static files, 404s
+        lane = self.lanes.get(match.url_name)
+        if lane is None:
+            return None
+        return match, lane
+
+    def _reject(self, request, match, wait):
+        request.resolver_match = match  # So the metrics count the 429 against the view
+        return too_many_requests(wait)
+
+
+# ==========================================
+# IDEMPOTENCY KEYS
+# ==========================================
+
+PENDING = '__pending__'
+VALID_KEY = re.compile(r'^[A-Za-z0-9_-]{8,64}$')
+
+
+class IdempotencyConflict(Exception):
+    """The first request with this key is still running."""
+
+
+def _idempotency_key(scope, key):
+    if not key or not VALID_KEY.match(key):
+        return None  # No (usable) key: no deduplication
+    return f"idempotency:{scope}:{key}"
+
+
+def claim(scope, key):
+    """
+    Returns None when this request owns `key` and should do the work, then
+    call complete() or release(). Returns the stored result when an earlier
+    request with the key already finished. Raises IdempotencyConflict when
+    that request is still running after IDEMPOTENCY_WAIT seconds.
+    """
+    cache_key = _idempotency_key(scope, key)
+    if cache_key is None:
+        return None
+    cache = _cache()
+    if cache.add(cache_key, PENDING, settings.IDEMPOTENCY_KEY_TTL):
+        return None
+    deadline = time.monotonic() + settings.IDEMPOTENCY_WAIT
+    while True:
+        result = cache.get(cache_key)
+        if result is None:
+            # Released by a failed first attempt: try to take over
+            if cache.add(cache_key, PENDING, settings.IDEMPOTENCY_KEY_TTL):
+                return None
+        elif result != PENDING:
+            return result
+        if time.monotonic() > deadline:
+            raise IdempotencyConflict(key)
+        time.sleep(0.05)
+
+
+def complete(scope, key, result):
+    cache_key = _idempotency_key(scope, key)
+    if cache_key is not None:
+        _cache().set(cache_key, result, settings.IDEMPOTENCY_KEY_TTL)
+
+
+def release(scope, key):
+    """The work failed or was rejected: let the next attempt with the key run it."""
+    cache_key = _idempotency_key(scope, key)
+    if cache_key is not None:
+        _cache().delete(cache_key)
@@ -0,0 +1,188 @@
+"""
+Precomputed daily and hourly rollups of the appointment event log.
+
+Questions like "patients per hour per department" or "average wait by
+weekday" used to mean scanning Appointment and diffing its timestamps.
+roll_up() instead folds new AppointmentEvent rows, past a checkpoint, into
+per-doctor and per-department counters for each local hour and day. The
+checkpoint moves in the same transaction, so no event is counted twice,
+whenever and however often the job runs (manage.py rollup_events).
+
+The checkpoint is an event id, and ids are handed out when a row is inserted,
+not when its transaction commits. On Postgres a slow transaction can commit
+id 10 after id 11 is already visible; a checkpoint moved to 11 would then skip
+10 for good. So only events recorded at least ROLLUP_LAG_SECONDS ago are
+folded, and a batch stops at the first younger one. Every event is counted
+exactly once as long as no transaction writing events stays open longer than
+the lag. (SQLite runs one writer at a time, so ids commit in order there and
+the lag only delays the rollups.)
+
+report() reads only the rollup tables: a year is 365 day rows and 8760 hour
+rows per department, whatever the patient volume.
+"""
+from collections import defaultdict
+from datetime import datetime, time, timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Sum
+from django.db.models.functions import ExtractHour, ExtractWeekDay
+from django.utils import timezone
+
+from .models import AppointmentEvent, DepartmentRollup, DoctorRollup, RollupCheckpoint, RollupCounts
+
+CHECKPOINT = 'appointment_events'
+
+WEEKDAYS = ['Sunday', 'Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday']  # ExtractWeekDay: 1 = Sunday
+
+
+def _counts(kind, wait_minutes, duration_minutes):
+    """What one event adds to its buckets ('reassigned' adds nothing: the booking was counted already)."""
+    if kind == 'booked':
+        return {'booked': 1}
+    if kind == 'called':
+        return {'called': 1, 'wait_minutes': wait_minutes or 0.0}
+    if kind == 'completed':
+        if duration_minutes is None:
+            return {'completed': 1}
+        return {'completed': 1, 'consultations': 1, 'consultation_minutes': duration_minutes}
+    if kind == 'cancelled':
+        return {'cancelled': 1}
+    return {}
+
+
+def _periods(at):
+    hour = timezone.localtime(at).replace(minute=0, second=0, microsecond=0)
+    return (('hour', hour), ('day', hour.replace(hour=0)))
+
+
+def roll_up(batch_size=5000, now=None):
+    """Folds the settled events past the checkpoint into the rollups. Returns how many were folded."""
+    settled = (now or timezone.now()) - timedelta(seconds=settings.ROLLUP_LAG_SECONDS)
+    total = 0
+    while True:
+        folded = _roll_up_batch(batch_size, settled)
+        total += folded
+        if folded < batch_size:
+            return total
+
+
+def _roll_up_batch(batch_size, settled):
+    with transaction.atomic():
+        # The row lock keeps two jobs from folding the same events
+        checkpoint, _ = RollupCheckpoint.objects.select_for_update().get_or_create(name=CHECKPOINT)
+        events = list(AppointmentEvent.objects.filter(id__gt=checkpoint.last_event_id).order_by('id').values_list(
+            'id', 'doctor_id', 'department_id', 'kind', 'at', 'wait_minutes', 'duration_minutes', 'recorded_at'
+        )[:batch_size])
+        # Stop at the first event recorded after `settled`: a lower id may still be about to commit
+        young = next((i for i, event in enumerate(events) if event[-1] > settled), None)
+        if young is not None:
+            events = events[:young]
+        if not events:
+            return 0
+
+        doctors, departments = defaultdict(lambda: defaultdict(float)), defaultdict(lambda: defaultdict(float))
+        for _, doctor_id, department_id, kind, at, wait, duration, _ in events:
+            counts = _counts(kind, wait, duration)
+            if not counts:
+                continue
+            for period, start in _periods(at):
+                for deltas, owner_id in ((doctors, doctor_id), (departments, department_id)):
+                    bucket = deltas[owner_id, period, start]
+                    for field, value in counts.items():
+                        bucket[field] += value
+
+        _merge(DoctorRollup, 'doctor_id', doctors)
+        _merge(DepartmentRollup, 'department_id', departments)
+        checkpoint.last_event_id = events[-1][0]
+        checkpoint.save(update_fields=['last_event_id'])
+    return len(events)
+
+
+def _merge(model, owner_field, deltas):
+    """Adds `deltas` {(owner_id, period, start): {counter: value}} to the rollup rows: three queries."""
+    if not deltas:
+        return
+    starts = [start for _, _, start in deltas]
+    existing = {
+        (getattr(row, owner_field), row.period, row.start): row
+        for row in model.objects.filter(
+            **{f"{owner_field}__in": {owner for owner, _, _ in deltas}},
+            start__range=(min(starts), max(starts)),
+        )
+    }
+    changed, created = [], []
+    for key, counts in deltas.items():
+        row = existing.get(key)
+        if row is None:
+            row = model(**{owner_field: key[0]}, period=key[1], start=key[2])
+            created.append(row)
+        else:
+            changed.append(row)
+        for field, value in counts.items():
+            setattr(row, field, getattr(row, field) + (int(value) if field in _INTEGER_COUNTERS else value))
+    model.objects.bulk_create(created, batch_size=500)
+    model.objects.bulk_update(changed, RollupCounts.COUNTERS, batch_size=100)
+
+
+_INTEGER_COUNTERS = {'booked', 'called', 'completed', 'cancelled', 'consultations'}
+
+
+# ==========================================
+# REPORTS (rollups only)
+# ==========================================
+
+def _average(total, count):
+    return round(total / count, 1) if count else None
+
+
+def report(first_day, last_day):
+    """
+    Department analytics for local days `first_day`..`last_day`: totals,
+    average patients seen per hour of the day, and average wait by weekday.
+    Three aggregate queries over the rollup tables.
+    """
+    start = timezone.make_aware(datetime.combine(first_day, time.min))
+    end = timezone.make_aware(datetime.combine(last_day + timedelta(days=1), time.min))
+    days = (last_day - first_day).days + 1
+    rollups = DepartmentRollup.objects.filter(start__gte=start, start__lt=end)
+    sums = {field: Sum(field) for field in RollupCounts.COUNTERS}
+
+    totals = []
+    for row in rollups.filter(period='day').values('department__name').annotate(**sums).order_by('department__name'):
+        totals.append({
+            'department': row['department__name'],
+            'booked': row['booked'],
+            'completed': row['completed'],
+            'cancelled': row['cancelled'],
+            'per_day': round(row['completed'] / days, 1),
+            'average_wait': _average(row['wait_minutes'], row['called']),
+            'average_consultation': _average(row['consultation_minutes'], row['consultations']),
+        })
+
+    hourly = defaultdict(dict)  # department -> {hour: completed per day}
+    for row in rollups.filter(period='hour').annotate(hour=ExtractHour('start')).values(
+        'department__name', 'hour'
+    ).annotate(completed=Sum('completed')):
+        hourly[row['department__name']][row['hour']] = round(row['completed'] / days, 2)
+
+    weekdays = defaultdict(dict)  # department -> {weekday name: average wait}
+    for row in rollups.filter(period='day').annotate(weekday=ExtractWeekDay('start')).values(
+        'department__name', 'weekday'
+    ).annotate(wait=Sum('wait_minutes'), called=Sum('called')):
+        weekdays[row['department__name']][WEEKDAYS[row['weekday'] - 1]] = _average(row['wait'], row['called'])
+
+    hours = sorted({hour for per_hour in hourly.values() for hour in per_hour})
+    return {
+        'first_day': first_day,
+        'last_day': last_day,
+        'totals': totals,
+        'hours': hours,
+        'patients_per_hour': {
+            department: [per_hour.get(hour, 0) for hour in hours] for department, per_hour in sorted(hourly.items())
+        },
+        'weekdays': WEEKDAYS,
+        'wait_by_weekday': {
+            department: [waits.get(day) for day in WEEKDAYS] for department, waits in sorted(weekdays.items())
+        },
+    }
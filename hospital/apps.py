@@ -1,5 +1,27 @@
 from django.apps import AppConfig
+from django.conf import settings
+from django.core.signals import request_finished
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_save, pre_save
 
 
 class HospitalConfig(AppConfig):
     name = 'hospital'
+
+    def ready(self):
+        from . import queue_state
+        from .db import configure_sqlite
+        from .metrics import install_query_timer
+        from .models import Appointment, Doctor
+        from .warmup import DISPATCH_UID, on_first_request
+        connection_created.connect(configure_sqlite, dispatch_uid='hospital.configure_sqlite')
+        connection_created.connect(install_query_timer, dispatch_uid='hospital.install_query_timer')
+        # Writes the views don't apply to the cached queues themselves
+        pre_save.connect(queue_state.appointment_pre_save, sender=Appointment, dispatch_uid='hospital.queue.appt_pre')
+        post_save.connect(queue_state.appointment_saved, sender=Appointment, dispatch_uid='hospital.queue.appt_save')
+        post_delete.connect(queue_state.appointment_deleted, sender=Appointment, dispatch_uid='hospital.queue.appt_del')
+        pre_save.connect(queue_state.doctor_pre_save, sender=Doctor, dispatch_uid='hospital.queue.doctor_pre')
+        post_save.connect(queue_state.doctor_saved, sender=Doctor, dispatch_uid='hospital.queue.doctor_save')
+        post_delete.connect(queue_state.doctor_deleted, sender=Doctor, dispatch_uid='hospital.queue.doctor_del')
+        if settings.WARMUP_AFTER_FIRST_REQUEST:
+            request_finished.connect(on_first_request, dispatch_uid=DISPATCH_UID)
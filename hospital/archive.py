@@ -0,0 +1,71 @@
+"""
+Hot/cold split for appointments.
+
+Finished (completed / cancelled) appointments older than ARCHIVE_AFTER_DAYS are
+moved from Appointment into ArchivedAppointment in bounded batches. Each batch
+is one transaction: copy, then delete. The live table that every queue query
+touches therefore stays at "today plus a few days". Patient history and the
+admin read both tables.
+"""
+import time
+from datetime import timedelta
+from itertools import chain
+from operator import attrgetter
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .models import Appointment, ArchivedAppointment
+from .pdf import remove_token_pdfs
+
+FINISHED = ('completed', 'cancelled')
+COPIED_FIELDS = [
+    'id', 'patient_name', 'patient_email', 'doctor_id', 'booked_at', 'booked_date', 'ticket_id',
+    'token_number', 'status', 'estimated_start_time', 'actual_start_time', 'actual_end_time',
+]
+
+
+def archive_cutoff(days=None, today=None):
+    """Rows booked before this day are archivable. Never today: tokens are still counted from it."""
+    days = settings.ARCHIVE_AFTER_DAYS if days is None else days
+    return (today or timezone.localdate()) - timedelta(days=max(days, 1))
+
+
+def archive_batch(cutoff, batch_size=1000):
+    """Moves up to `batch_size` finished rows booked before `cutoff`. Returns how many moved."""
+    with transaction.atomic():
+        rows = list(Appointment.objects.filter(
+            status__in=FINISHED, booked_date__lt=cutoff
+        ).order_by('id').values(*COPIED_FIELDS)[:batch_size])
+        if not rows:
+            return 0
+        # ignore_conflicts: a batch that was copied but not deleted (crash) can be replayed
+        ArchivedAppointment.objects.bulk_create(
+            [ArchivedAppointment(**row) for row in rows], ignore_conflicts=True
+        )
+        Appointment.objects.filter(id__in=[row['id'] for row in rows]).delete()
+    # Archived tickets can't be downloaded any more: drop their cached PDFs
+    remove_token_pdfs(row['ticket_id'] for row in rows)
+    return len(rows)
+
+
+def archive_appointments(cutoff, batch_size=1000, pause=0):
+    """
+    Archives batch after batch until nothing is left; returns the total moved.
+    `pause` sleeps between batches so bookings never wait long for the write lock.
+    """
+    total = 0
+    while True:
+        moved = archive_batch(cutoff, batch_size)
+        total += moved
+        if moved < batch_size:
+            return total
+        time.sleep(pause)
+
+
+def patient_history(email):
+    """Live and archived appointments for the email, newest first."""
+    live = Appointment.objects.filter(patient_email=email).select_related('doctor__user')
+    archived = ArchivedAppointment.objects.filter(patient_email=email).select_related('doctor__user')
+    return sorted(chain(live, archived), key=attrgetter('booked_at'), reverse=True)
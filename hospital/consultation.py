@@ -0,0 +1,81 @@
+"""
+Race-free call / complete for a doctor's room.
+
+The actions used to read the current patient with .first(), change it and
+save() it, outside any transaction. A double click or a second tab could
+then leave two patients in consultation, or complete the same one twice.
+
+Each action is now one transaction around conditional UPDATEs:
+waiting -> in_consultation for the called patient, in_consultation ->
+completed for whoever was inside. The UPDATE that matches no row is the
+answer to "did someone beat me to it?": the action becomes a no-op and
+returns None. Repeating a click is therefore harmless. The doctor row is
+locked first, so two different calls for one room queue up instead of
+both succeeding. (SQLite needs no lock: its IMMEDIATE transactions already
+take the write lock at BEGIN.)
+
+Event log rows (AppointmentEvent) and the duration statistics are written in
+the same transaction. The caches, Firebase and live screens are updated
+by the views once it has committed.
+"""
+from django.db import transaction
+from django.utils import timezone
+
+from .models import Appointment, AppointmentEvent, Doctor
+
+
+def _lock_room(doctor):
+    list(Doctor.objects.select_for_update().filter(pk=doctor.pk).values_list('pk', flat=True))
+
+
+def _finish(doctor, appointments, now):
+    """Bookkeeping for appointments just UPDATEd to completed: the in-memory copy, statistics, events."""
+    for appointment in appointments:
+        appointment.status, appointment.actual_end_time = 'completed', now
+        if appointment.actual_start_time:
+            duration_minutes = (now - appointment.actual_start_time).total_seconds() / 60
+            doctor.update_average_time(duration_minutes, now)
+        AppointmentEvent.record(appointment, 'completed')
+
+
+def call_in(doctor, appointment_id, now=None):
+    """
+    Calls the doctor's waiting patient in and completes whoever was inside.
+    Returns (called appointment, [completed appointments]), or None when the
+    patient is no longer waiting (already called, finished, cancelled).
+    """
+    now = now or timezone.now()
+    with transaction.atomic():
+        _lock_room(doctor)
+        if not Appointment.objects.filter(pk=appointment_id, doctor=doctor, status='waiting').update(
+            status='in_consultation', actual_start_time=now,
+        ):
+            return None
+
+        # Whoever was inside. More than one only if an older race left them there
+        inside = Appointment.objects.filter(doctor=doctor, status='in_consultation').exclude(pk=appointment_id)
+        finished = list(inside.select_related('doctor'))
+        if finished:
+            inside.update(status='completed', actual_end_time=now)
+            _finish(doctor, finished, now)
+
+        called = Appointment.objects.select_related('doctor').get(pk=appointment_id)
+        AppointmentEvent.record(called, 'called')
+    return called, finished
+
+
+def complete(doctor, appointment_id, now=None):
+    """
+    Completes the patient in the doctor's room. Returns the appointment, or
+    None when it is not in consultation (already completed, never called).
+    """
+    now = now or timezone.now()
+    with transaction.atomic():
+        _lock_room(doctor)
+        if not Appointment.objects.filter(pk=appointment_id, doctor=doctor, status='in_consultation').update(
+            status='completed', actual_end_time=now,
+        ):
+            return None
+        appointment = Appointment.objects.select_related('doctor').get(pk=appointment_id)
+        _finish(doctor, [appointment], now)
+    return appointment
@@ -0,0 +1,18 @@
+"""
+Per-connection database tuning.
+
+With SQLite's defaults (rollback journal, synchronous=FULL, no busy timeout),
+check-ins and doctor actions arriving together fail with "database is
+locked". settings.SQLITE_PRAGMAS (WAL, synchronous=NORMAL, busy_timeout, mmap)
+is applied to every new connection. The statements go straight to the driver
+connection, so they never show up in query logs or counts.
+"""
+from django.conf import settings
+
+
+def configure_sqlite(sender, connection, **kwargs):
+    """connection_created receiver (wired in HospitalConfig.ready)."""
+    if connection.vendor != 'sqlite':
+        return
+    for pragma, value in settings.SQLITE_PRAGMAS.items():
+        connection.connection.execute(f"PRAGMA {pragma} = {value}")
@@ -0,0 +1,56 @@
+"""
+Wait-time estimation engine.
+
+`estimated_start_time` used to be set once at check-in and never touched again,
+so a few slow consultations made every ticket wrong. reestimate_queue() runs on
+every queue transition (call / complete) and recomputes the doctor's whole
+waiting queue in one pass, then writes it back with a single bulk_update.
+"""
+from datetime import timedelta
+
+from django.utils import timezone
+
+from .models import Appointment, DoctorStats
+from .queue_state import get_queue_state
+
+
+def queue_start_times(now, remaining_minutes, count, minutes_per_patient):
+    """Start time for each waiting position: now + time left inside + position * duration."""
+    first = now + timedelta(minutes=remaining_minutes)
+    step = timedelta(minutes=minutes_per_patient)
+    return [first + step * position for position in range(count)]
+
+
+def reestimate_queue(doctor, now=None, batch_size=500):
+    """
+    Re-estimates every waiting patient of the doctor. Returns how many were updated.
+
+    Queue order comes from the cached QueueState, so the only reads are the
+    duration model and the current patient's start time; the write is one
+    UPDATE ... CASE per batch.
+    """
+    now = now or timezone.now()
+    state = get_queue_state(doctor)
+    if not state.total_waiting:
+        return 0
+
+    # Duration model: hour-of-day average when known, else the doctor's EWMA
+    minutes_per_patient = DoctorStats.expected_minutes(doctor, at=now)
+
+    # How long until the room is free: whatever is left of the current consultation
+    remaining = 0
+    if state.current_id is not None:
+        started = Appointment.objects.filter(id=state.current_id).values_list('actual_start_time', flat=True).first()
+        if started:
+            elapsed = (now - started).total_seconds() / 60
+            remaining = max(minutes_per_patient - elapsed, 0)  # Overdue: assume it ends now
+        else:
+            remaining = minutes_per_patient
+
+    start_times = queue_start_times(now, remaining, state.total_waiting, minutes_per_patient)
+    appointments = [
+        Appointment(id=appointment_id, estimated_start_time=start)
+        for appointment_id, start in zip(state.ids, start_times)
+    ]
+    Appointment.objects.bulk_update(appointments, ['estimated_start_time'], batch_size=batch_size)
+    return len(appointments)
@@ -0,0 +1,140 @@
+"""
+In-process pub/sub for queue changes, streamed to screens as Server-Sent Events.
+
+The state-changing views publish one small JSON delta per change (patient booked,
+token called, patient completed, duty toggled). `sse_application` is a bare ASGI
+app mounted in config/asgi.py at /events/: lobby displays and doctor dashboards
+render once, keep one connection open and apply the deltas, so a connected
+screen costs no DB reads at all.
+"""
+import asyncio
+import itertools
+import json
+import threading
+from urllib.parse import parse_qs
+
+SSE_PATH = '/events/'
+
+
+class Subscription:
+    """One connected screen. Lives on the event loop that serves it."""
+
+    def __init__(self, broker, loop, doctor_id=None, max_backlog=100):
+        self.broker = broker
+        self.loop = loop
+        self.doctor_id = doctor_id
+        self.queue = asyncio.Queue(maxsize=max_backlog)
+
+    def push(self, event):
+        """Called from any thread (request threads publish, the loop consumes)."""
+        if self.doctor_id is not None and event['data'].get('doctor_id') != self.doctor_id:
+            return
+        try:
+            self.loop.call_soon_threadsafe(self._put, event)
+        except RuntimeError:
+            pass  # Loop already closed; the screen is gone
+
+    def _put(self, event):
+        if self.queue.full():
+            # Too slow to keep up: drop the backlog and ask the screen to re-render once
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            event = {'id': event['id'], 'type': 'resync', 'data': {}}
+        self.queue.put_nowait(event)
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+
+class EventBroker:
+    def __init__(self, max_backlog=100):
+        self.max_backlog = max_backlog
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+
+    def subscribe(self, doctor_id=None):
+        """Must be called from the event loop that will read the subscription."""
+        subscription = Subscription(self, asyncio.get_running_loop(), doctor_id, self.max_backlog)
+        with self._lock:
+            self._subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscribers.discard(subscription)
+
+    def publish(self, event_type, data):
+        with self._lock:
+            event = {'id': next(self._ids), 'type': event_type, 'data': data}
+            subscribers = list(self._subscribers)
+        for subscription in subscribers:
+            subscription.push(event)
+        return event
+
+    @property
+    def subscriber_count(self):
+        with self._lock:
+            return len(self._subscribers)
+
+
+broker = EventBroker()
+
+
+def publish(event_type, data):
+    return broker.publish(event_type, data)
+
+
+def format_event(event):
+    return f"id: {event['id']}\nevent: {event['type']}\ndata: {json.dumps(event['data'])}\n\n".encode()
+
+
+async def _wait_for_disconnect(receive):
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return
+
+
+async def sse_application(scope, receive, send, keepalive=15):
+    """ASGI app for GET /events/[?doctor=<id>]: one SSE stream per screen."""
+    if scope['method'] != 'GET':
+        await send({'type': 'http.response.start', 'status': 405, 'headers': [(b'allow', b'GET')]})
+        await send({'type': 'http.response.body', 'body': b''})
+        return
+
+    params = parse_qs(scope.get('query_string', b'').decode())
+    doctor = params.get('doctor', [''])[0]
+    subscription = broker.subscribe(int(doctor) if doctor.isdigit() else None)
+
+    disconnected = asyncio.ensure_future(_wait_for_disconnect(receive))
+    try:
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': [
+                (b'content-type', b'text/event-stream'),
+                (b'cache-control', b'no-cache'),
+                (b'x-accel-buffering', b'no'),
+            ],
+        })
+        await send({'type': 'http.response.body', 'body': b'retry: 3000\n\n', 'more_body': True})
+
+        while True:
+            getter = asyncio.ensure_future(subscription.queue.get())
+            done, _ = await asyncio.wait(
+                {getter, disconnected}, timeout=keepalive, return_when=asyncio.FIRST_COMPLETED
+            )
+            if getter in done:
+                chunk = format_event(getter.result())
+            else:
+                getter.cancel()
+                if disconnected in done:
+                    break
+                chunk = b': keep-alive\n\n'
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+    except OSError:
+        pass  # Client vanished mid-write
+    finally:
+        subscription.close()
+        disconnected.cancel()
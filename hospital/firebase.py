@@ -0,0 +1,200 @@
+"""
+Write-behind sync of the live queue state to the Firebase Realtime Database.
+
+Views never talk to Firebase directly any more: update_firebase() records the
+change in an in-memory outbox and returns. A single background worker coalesces
+pending changes per doctor (last write wins per field) and flushes everything as
+one multi-path PATCH over a pooled keep-alive session.
+
+`requests` is imported by the worker on its first flush rather than at module
+import, so a cold-started process doesn't load an HTTP stack before its first response.
+"""
+import atexit
+import json
+import threading
+import time
+
+from django.conf import settings
+from django.utils import timezone
+
+from . import metrics
+
+
+class FirebaseOutbox:
+    """
+    Bounded, coalescing outbox for doctor live-state updates.
+
+    Memory is bounded by the number of distinct doctors with unsent changes
+    (`max_doctors`), not by the number of updates, because repeated updates for
+    the same doctor overwrite each other field by field.
+    """
+
+    def __init__(self, base_url=None, max_doctors=1000, linger=0.05,
+                 max_retries=4, backoff=0.5, timeout=5, autostart=True):
+        self.base_url = base_url
+        self.max_doctors = max_doctors
+        self.linger = linger
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.autostart = autostart
+        self.dropped = 0
+
+        self._pending = {}  # doctor_id -> {field: value}
+        self._cond = threading.Condition()
+        self._in_flight = False
+        self._closed = False
+        self._thread = None
+        self._session = None
+
+    # ---------- producer side (request threads) ----------
+
+    def enqueue(self, doctor_id, fields):
+        """Records a change; never blocks on the network."""
+        with self._cond:
+            if doctor_id not in self._pending and len(self._pending) >= self.max_doctors:
+                self.dropped += 1
+                print(f"⚠️ Firebase outbox full, dropping update for doctor {doctor_id}")
+                return False
+            self._pending.setdefault(doctor_id, {}).update(fields)
+            self._cond.notify()
+        if self.autostart:
+            self._ensure_worker()
+        return True
+
+    # ---------- consumer side (worker thread) ----------
+
+    def flush(self):
+        """Sends everything pending as one PATCH. Returns True if the batch was delivered."""
+        with self._cond:
+            if not self._pending:
+                return True
+            batch, self._pending = self._pending, {}
+            self._in_flight = True
+
+        delivered = False
+        try:
+            delivered = self._send(batch)
+        finally:
+            with self._cond:
+                if not delivered:
+                    # Put the batch back *under* anything newer that arrived meanwhile
+                    for doctor_id, fields in batch.items():
+                        self._pending[doctor_id] = {**fields, **self._pending.get(doctor_id, {})}
+                self._in_flight = False
+                self._cond.notify_all()
+        return delivered
+
+    def drain(self, timeout=5):
+        """Waits until the outbox is empty (used by tests and at shutdown)."""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while self._pending or self._in_flight:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def close(self, timeout=2):
+        self.drain(timeout)
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def _ensure_worker(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._cond:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="firebase-outbox", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if self._closed:
+                    return
+            # Give bursts (e.g. call + complete) a moment to coalesce
+            time.sleep(self.linger)
+            if not self.flush():
+                time.sleep(self.backoff)
+
+    def _send(self, batch):
+        base_url = self.base_url or settings.FIREBASE_DB_URL
+        if not base_url:
+            return True
+        import requests
+
+        # Multi-path update: {"doctors/5/status": "Live", "doctors/5/current_token": 12, ...}
+        payload = {
+            f"doctors/{doctor_id}/{field}": value
+            for doctor_id, fields in batch.items()
+            for field, value in fields.items()
+        }
+        for attempt in range(self.max_retries + 1):
+            started = time.perf_counter()
+            try:
+                response = self._get_session().patch(
+                    f"{base_url}/.json", data=json.dumps(payload), timeout=self.timeout
+                )
+                ok = response.status_code < 400
+                metrics.record_firebase(time.perf_counter() - started, None if ok else f"http_{response.status_code}")
+                if response.status_code < 500:
+                    if not ok:
+                        # Client errors won't fix themselves on retry
+                        print(f"⚠️ Firebase Sync Error: HTTP {response.status_code} {response.text[:200]}")
+                    return True
+                error = f"HTTP {response.status_code}"
+            except requests.RequestException as e:
+                metrics.record_firebase(time.perf_counter() - started, type(e).__name__.lower())
+                error = e
+            if attempt < self.max_retries:
+                time.sleep(self.backoff * (2 ** attempt))
+        print(f"⚠️ Firebase Sync Error: {error} (will retry {len(batch)} doctor(s))")
+        return False
+
+    @property
+    def pending(self):
+        with self._cond:
+            return len(self._pending)
+
+    def _get_session(self):
+        if self._session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+
+            session = requests.Session()
+            session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=2))
+            session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=2))
+            self._session = session
+        return self._session
+
+
+outbox = FirebaseOutbox()
+atexit.register(outbox.close)
+
+
+def update_firebase(doctor_id, current_serving, status, doctor_name, update_last_issued=None):
+    """
+    Queues live updates for the doctor's card.
+    If update_last_issued is a number, it updates the 'high water mark' counter.
+    """
+    # Base data for the doctor's live card
+    data = {
+        "status": status,
+        "doctor_name": doctor_name,
+        "last_updated": str(timezone.now())
+    }
+
+    # Only update current_token if a doctor is calling a patient
+    if current_serving > 0:
+        data["current_token"] = current_serving
+
+    # Update the counter ONLY if we are booking (pass the new token number here)
+    if update_last_issued is not None:
+        data["last_issued_token"] = update_last_issued
+
+    outbox.enqueue(doctor_id, data)
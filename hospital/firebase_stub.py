@@ -0,0 +1,120 @@
+"""
+Local stand-in for the Firebase Realtime Database REST API.
+
+Speaks just enough of the protocol for our sync code (GET, PUT, and multi-path
+PATCH on `<path>.json`) and records every request, so tests and benchmarks can
+check ordering and coalescing without touching the network.
+"""
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FirebaseStub:
+    def __init__(self, fail_first=0, delay=0):
+        self.fail_first = fail_first  # answer the first N writes with HTTP 503
+        self.delay = delay            # seconds to sleep before each response
+        self.data = {}
+        self.requests = []            # [(method, path, body), ...] in arrival order
+        self._lock = threading.Lock()
+        self._server = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                stub._handle(self, "GET")
+
+            def do_PUT(self):
+                stub._handle(self, "PUT")
+
+            def do_PATCH(self):
+                stub._handle(self, "PATCH")
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def get(self, path):
+        """Returns the stored value at a slash-separated path (None if missing)."""
+        node = self.data
+        for key in filter(None, path.strip("/").split("/")):
+            if not isinstance(node, dict) or key not in node:
+                return None
+            node = node[key]
+        return node
+
+    # ---------- request handling ----------
+
+    def _handle(self, handler, method):
+        if self.delay:
+            time.sleep(self.delay)
+        path = handler.path.split("?")[0]
+        if not path.endswith(".json"):
+            return self._reply(handler, 404, {"error": "not found"})
+        path = path[:-len(".json")]
+
+        body = None
+        if method != "GET":
+            length = int(handler.headers.get("Content-Length") or 0)
+            body = json.loads(handler.rfile.read(length) or b"null")
+
+        with self._lock:
+            self.requests.append((method, path, body))
+            if method != "GET" and self.fail_first > 0:
+                self.fail_first -= 1
+                return self._reply(handler, 503, {"error": "unavailable"})
+            if method == "GET":
+                result = self.get(path)
+            elif method == "PUT":
+                self._set(path, body)
+                result = body
+            else:
+                # Multi-path update: every key is a path relative to the target
+                for key, value in body.items():
+                    self._set(f"{path}/{key}", value)
+                result = body
+        self._reply(handler, 200, result)
+
+    def _set(self, path, value):
+        keys = [k for k in path.strip("/").split("/") if k]
+        if not keys:
+            self.data = value if isinstance(value, dict) else {}
+            return
+        node = self.data
+        for key in keys[:-1]:
+            if not isinstance(node.get(key), dict):
+                node[key] = {}
+            node = node[key]
+        node[keys[-1]] = value
+
+    def _reply(self, handler, status, payload):
+        body = json.dumps(payload).encode()
+        handler.send_response(status)
+        handler.send_header("Content-Type", "application/json")
+        handler.send_header("Content-Length", str(len(body)))
+        handler.end_headers()
+        handler.wfile.write(body)
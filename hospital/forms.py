@@ -1,7 +1,16 @@
 from django import forms
-from .models import Appointment
+from django.forms import ModelChoiceField
+from .models import Appointment, Department, Doctor
+from . import queue_state
 
 class AppointmentForm(forms.ModelForm):
+    # Leave the doctor empty to be routed to the department's earliest free doctor
+    doctor = forms.ModelChoiceField(
+        queryset=Doctor.objects.select_related('user'), required=False,
+        widget=forms.Select(attrs={'class': 'form-control'}),
+    )
+    department = forms.ModelChoiceField(queryset=Department.objects.all(), required=False)
+
     class Meta:
         model = Appointment
         # ADD 'patient_email' HERE
@@ -10,5 +19,50 @@ class AppointmentForm(forms.ModelForm):
             'patient_name': forms.TextInput(attrs={'class': 'form-control', 'placeholder': 'Enter Name'}),
             # Add widget for email
             'patient_email': forms.EmailInput(attrs={'class': 'form-control', 'placeholder': 'Enter Email'}),
-            'doctor': forms.Select(attrs={'class': 'form-control'}),
-        }
\ No newline at end of file
+        }
+
+    def clean(self):
+        cleaned_data = super().clean()
+        if cleaned_data.get('doctor') is None and 'doctor' not in self.errors:
+            department = cleaned_data.get('department')
+            if department is None:
+                raise forms.ValidationError("Select a doctor, or a department to see any available doctor.")
+            cleaned_data['doctor'] = self._any_available_doctor(department)
+        return cleaned_data
+
+    @staticmethod
+    def _any_available_doctor(department):
+        doctor_id = queue_state.earliest_doctor(department.id)
+        # Re-checked on the row: the doctor may have gone off duty a moment ago
+        doctor = doctor_id and Doctor.objects.select_related('user').filter(pk=doctor_id, is_on_duty=True).first()
+        if not doctor:
+            raise forms.ValidationError(f"No doctors are currently on duty in {department.name}.")
+        return doctor
+
+class BulkAppointmentForm(AppointmentForm):
+    """
+    One row of a bulk check-in, with the same rules as AppointmentForm.
+    The doctor is picked from a dict loaded once for the whole batch,
+    instead of one lookup query per row.
+    """
+    doctor = forms.IntegerField()
+    department = None  # Rows always name their doctor
+
+    class Meta(AppointmentForm.Meta):
+        fields = ['patient_name', 'patient_email']
+
+    def __init__(self, *args, doctors, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.doctors = doctors
+
+    def clean_doctor(self):
+        doctor = self.doctors.get(self.cleaned_data['doctor'])
+        if doctor is None:
+            raise forms.ValidationError(
+                ModelChoiceField.default_error_messages['invalid_choice'], code='invalid_choice'
+            )
+        return doctor
+
+    def save(self, commit=True):
+        self.instance.doctor = self.cleaned_data['doctor']
+        return super().save(commit=commit)
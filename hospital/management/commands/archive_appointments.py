@@ -0,0 +1,26 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from hospital.archive import archive_appointments, archive_cutoff
+
+
+class Command(BaseCommand):
+    help = "Moves finished appointments older than --days into the archive table, in batches."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, help="Keep this many days live (default: ARCHIVE_AFTER_DAYS).")
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--pause', type=float, default=0.1, help="Seconds to sleep between batches.")
+        parser.add_argument('--loop', action='store_true', help="Keep running, archiving every --interval seconds.")
+        parser.add_argument('--interval', type=int, default=3600)
+
+    def handle(self, *args, **options):
+        while True:
+            cutoff = archive_cutoff(options['days'])
+            moved = archive_appointments(cutoff, options['batch_size'], options['pause'])
+            self.stdout.write(f"Archived {moved} appointments booked before {cutoff}.")
+
+            if not options['loop']:
+                return
+            time.sleep(options['interval'])
@@ -0,0 +1,333 @@
+"""
+Load generator for the hospital views.
+
+Seeds a throwaway test database, drives a weighted mix of real requests through
+the Django test client and writes per-endpoint latency percentiles, throughput
+and queries per request to a JSON file that can be diffed between releases.
+Firebase sync goes to a local FirebaseStub, so nothing leaves the machine.
+
+    python manage.py benchmark --doctors 5 --requests 2000 --output bench.json
+
+`--mix write-cycle` runs only check-in / call / complete, for comparing write
+throughput between database modes (e.g. DB_ENGINE=postgres, or
+SQLITE_JOURNAL_MODE=DELETE against the default WAL) with --threads > 1.
+"""
+import json
+import math
+import random
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from contextlib import ExitStack
+
+import django
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Max, Min
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.urls import reverse
+
+from hospital.firebase import outbox
+from hospital.firebase_stub import FirebaseStub
+from hospital.notify import notifier
+from hospital.models import Appointment, Department, Doctor
+from hospital.queue_state import get_queue_state
+
+DEFAULT_MIX = 'checkin=3,call=1,complete=1,live=10,display=4,pdf=1'
+MIX_PRESETS = {
+    'default': DEFAULT_MIX,
+    'write-cycle': 'checkin=1,call=1,complete=1',
+}
+
+
+def parse_mix(mix):
+    """'checkin=3,live=10' -> {'checkin': 3, 'live': 10}; also accepts a MIX_PRESETS name."""
+    mix = MIX_PRESETS.get(mix, mix)
+    weights = {}
+    for part in mix.split(','):
+        name, _, weight = part.partition('=')
+        if name not in SCENARIOS:
+            raise CommandError(f"Unknown scenario '{name}'. Choose from: {', '.join(SCENARIOS)}")
+        try:
+            weights[name] = int(weight or 1)
+        except ValueError:
+            raise CommandError(f"Weight for '{name}' must be an integer")
+    return weights
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    rank = max(math.ceil(pct / 100 * len(sorted_values)), 1)
+    return sorted_values[rank - 1]
+
+
+# ==========================================
+# SEEDING
+# ==========================================
+
+def database_mode():
+    """What the run is comparing: SQLite journal mode, or Postgres connection reuse."""
+    if connection.vendor == 'sqlite':
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA journal_mode')
+            return f"journal_mode={cursor.fetchone()[0]}"
+    return f"conn_max_age={connection.settings_dict['CONN_MAX_AGE']}"
+
+
+def seed(departments, doctors_per_department, waiting_per_doctor):
+    """Creates the hospital in bulk; returns the list of Doctor rows."""
+    password = make_password('benchmark')  # Hash once, not per user
+    depts = Department.objects.bulk_create(
+        [Department(name=f"Department {d + 1}") for d in range(departments)]
+    )
+    users = User.objects.bulk_create([
+        User(username=f"bench-doctor-{dept.id}-{i}", first_name=f"Doctor{dept.id}x{i}", password=password)
+        for dept in depts for i in range(doctors_per_department)
+    ])
+    user_depts = [dept for dept in depts for _ in range(doctors_per_department)]
+    doctors = Doctor.objects.bulk_create([
+        Doctor(user=user, department=dept, is_on_duty=True) for user, dept in zip(users, user_depts)
+    ])
+    Appointment.objects.bulk_create([
+        Appointment(
+            patient_name=f"Patient {doctor.id}-{token}", patient_email=f"p{doctor.id}-{token}@example.com",
+            doctor=doctor, token_number=token, ticket_id=f"BENCH-{doctor.id}-{token}",
+        )
+        for doctor in doctors for token in range(1, waiting_per_doctor + 1)
+    ], batch_size=500)
+    return list(Doctor.objects.select_related('user'))
+
+
+# ==========================================
+# SCENARIOS: each returns a response, or None when it has nothing to do
+# ==========================================
+
+def _checkin(ctx):
+    doctor = ctx.rng.choice(ctx.doctors)
+    n = ctx.rng.randrange(10 ** 6)
+    return ctx.public.post(reverse('patient_check_in'), {
+        'patient_name': f"Walk-in {n}", 'patient_email': f"walkin{n}@example.com", 'doctor': doctor.id,
+    })
+
+
+def _call(ctx):
+    doctor = ctx.rng.choice(ctx.doctors)
+    waiting = get_queue_state(doctor).waiting(limit=1)
+    if not waiting:
+        return None
+    # As the dashboard sends it: the JSON state comes back instead of a redirect + re-render
+    return ctx.client_for(doctor).post(reverse('call_patient', args=[waiting[0]['id']]), HTTP_ACCEPT='application/json')
+
+
+def _complete(ctx):
+    doctor = ctx.rng.choice(ctx.doctors)
+    current = get_queue_state(doctor).current
+    if current is None:
+        return None
+    return ctx.client_for(doctor).post(reverse('complete_appointment', args=[current['id']]), HTTP_ACCEPT='application/json')
+
+
+def _live(ctx):
+    return ctx.public.get(reverse('patient_live_status', args=[ctx.random_appointment()]))
+
+
+def _display(ctx):
+    return ctx.public.get(reverse('public_display'))
+
+
+def _pdf(ctx):
+    response = ctx.public.get(reverse('download_pdf', args=[ctx.random_appointment()]))
+    if response.streaming:
+        b''.join(response.streaming_content)  # Read the file like a client would
+    return response
+
+
+SCENARIOS = {
+    'checkin': _checkin,
+    'call': _call,
+    'complete': _complete,
+    'live': _live,
+    'display': _display,
+    'pdf': _pdf,
+}
+
+
+class Context:
+    """Per-thread clients and random source (test clients aren't thread-safe)."""
+
+    def __init__(self, doctors, seed_value):
+        self.doctors = doctors
+        self.rng = random.Random(seed_value)
+        self.public = Client()
+        self._doctor_clients = {}
+        ids = Appointment.objects.aggregate(first=Min('id'), last=Max('id'))
+        self._first_id, self._last_id = ids['first'], ids['last']
+
+    def client_for(self, doctor):
+        if doctor.id not in self._doctor_clients:
+            client = Client()
+            client.force_login(doctor.user)
+            self._doctor_clients[doctor.id] = client
+        return self._doctor_clients[doctor.id]
+
+    def random_appointment(self):
+        return self.rng.randint(self._first_id, self._last_id)
+
+
+# ==========================================
+# DRIVER
+# ==========================================
+
+def run_mix(doctors, weights, total_requests, threads=1, seed_value=0):
+    """
+    Fires `total_requests` requests split across `threads`, each picking scenarios
+    by weight. Returns {scenario: [(seconds, queries, status), ...]} and the wall time.
+    """
+    names = list(weights)
+    results = defaultdict(list)
+    lock = threading.Lock()
+
+    def worker(index, count):
+        ctx = Context(doctors, seed_value + index)
+        local = defaultdict(list)
+        for _ in range(count):
+            name = ctx.rng.choices(names, weights=[weights[n] for n in names])[0]
+            with CaptureQueriesContext(connection) as queries:
+                started = time.perf_counter()
+                try:
+                    status = getattr(SCENARIOS[name](ctx), 'status_code', None)
+                except Exception as e:
+                    print(f"⚠️ Benchmark {name} failed: {e}")
+                    status = 500  # Count it as an error and keep the load going
+                elapsed = time.perf_counter() - started
+            if status is not None:
+                local[name].append((elapsed, len(queries), status))
+        with lock:
+            for name, samples in local.items():
+                results[name].extend(samples)
+
+    shares = [total_requests // threads + (1 if i < total_requests % threads else 0) for i in range(threads)]
+    started = time.perf_counter()
+    if threads == 1:
+        worker(0, shares[0])
+    else:
+        def thread_main(index, count):
+            try:
+                worker(index, count)
+            finally:
+                connection.close()  # Each thread opened its own connection
+
+        pool = [threading.Thread(target=thread_main, args=(i, share)) for i, share in enumerate(shares)]
+        for thread in pool:
+            thread.start()
+        for thread in pool:
+            thread.join()
+    return results, time.perf_counter() - started
+
+
+def summarize(results, wall_seconds):
+    def stats(samples, seconds):
+        latencies = sorted(s[0] * 1000 for s in samples)
+        return {
+            'requests': len(samples),
+            'errors': sum(1 for s in samples if s[2] >= 400),
+            'p50_ms': round(percentile(latencies, 50), 3),
+            'p95_ms': round(percentile(latencies, 95), 3),
+            'p99_ms': round(percentile(latencies, 99), 3),
+            'mean_ms': round(sum(latencies) / len(latencies), 3),
+            'throughput_rps': round(len(samples) / seconds, 1) if seconds else None,
+            'queries_per_request': round(sum(s[1] for s in samples) / len(samples), 2),
+        }
+
+    endpoints = {name: stats(samples, wall_seconds) for name, samples in sorted(results.items()) if samples}
+    everything = [sample for samples in results.values() for sample in samples]
+    return {'endpoints': endpoints, 'total': stats(everything, wall_seconds) if everything else {}}
+
+
+class Command(BaseCommand):
+    help = (
+        "Seeds a temporary database, drives a mix of check-in / call / complete / live-status / "
+        "display / PDF requests and writes latency percentiles, throughput and queries per request as JSON."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--departments', type=int, default=3)
+        parser.add_argument('--doctors', type=int, default=4, help="Doctors per department.")
+        parser.add_argument('--waiting', type=int, default=30, help="Seeded waiting patients per doctor.")
+        parser.add_argument('--requests', type=int, default=1000)
+        parser.add_argument('--threads', type=int, default=1)
+        parser.add_argument('--mix', default=DEFAULT_MIX, help=f"Scenario weights, or one of {', '.join(MIX_PRESETS)} (default: {DEFAULT_MIX}).")
+        parser.add_argument('--firebase-delay', type=float, default=0,
+                            help="Seconds the local Firebase stub waits before answering.")
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', default='benchmark.json')
+
+    def handle(self, *args, **options):
+        weights = parse_mix(options['mix'])
+        if options['threads'] < 1 or options['requests'] < 1:
+            raise CommandError("--threads and --requests must be at least 1")
+
+        with ExitStack() as stack:
+            stub = stack.enter_context(FirebaseStub(delay=options['firebase_delay']))
+            pdf_dir = stack.enter_context(tempfile.TemporaryDirectory())
+            stack.enter_context(override_settings(
+                FIREBASE_DB_URL=stub.url,
+                TOKEN_PDF_DIR=pdf_dir,
+                ALLOWED_HOSTS=['*'],
+                ADMISSION_LANES={},  # Measure the views, not the rate limiter (all requests are one client)
+                EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend',  # Turn notices stay in memory
+                # Private cache: never mix benchmark queues with a shared production cache
+                CACHES={'default': {
+                    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                    'LOCATION': 'benchmark',
+                    'OPTIONS': {'MAX_ENTRIES': 100000},
+                }},
+            ))
+
+            # Throwaway database; the real one is never touched
+            old_name = connection.settings_dict['NAME']
+            if connection.vendor == 'sqlite':
+                # On disk, not shared-cache memory, so threads get normal file locking
+                db_dir = stack.enter_context(tempfile.TemporaryDirectory())
+                connection.settings_dict.setdefault('TEST', {})['NAME'] = f"{db_dir}/benchmark.sqlite3"
+            connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+            stack.callback(connection.creation.destroy_test_db, old_name, verbosity=0)
+
+            mode = database_mode()
+            self.stdout.write(f"Seeding ({connection.vendor}, {mode})...")
+            doctors = seed(options['departments'], options['doctors'], options['waiting'])
+            self.stdout.write(f"Running {options['requests']} requests on {options['threads']} thread(s)...")
+            results, wall_seconds = run_mix(
+                doctors, weights, options['requests'], options['threads'], options['seed']
+            )
+            outbox.drain()
+            notifier.drain()  # Before the throwaway database goes
+            firebase_requests = len(stub.requests)
+
+        report = {
+            'django': django.get_version(),
+            'database': connection.vendor,
+            'database_mode': mode,
+            'options': {key: options[key] for key in (
+                'departments', 'doctors', 'waiting', 'requests', 'threads', 'mix', 'firebase_delay', 'seed'
+            )},
+            'wall_seconds': round(wall_seconds, 3),
+            'firebase_requests': firebase_requests,
+            **summarize(results, wall_seconds),
+        }
+        with open(options['output'], 'w') as f:
+            json.dump(report, f, indent=2)
+
+        self.stdout.write(f"{'endpoint':<10} {'reqs':>6} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'rps':>8} {'queries':>8}")
+        for name, row in report['endpoints'].items():
+            self.stdout.write(
+                f"{name:<10} {row['requests']:>6} {row['p50_ms']:>8} {row['p95_ms']:>8} "
+                f"{row['p99_ms']:>8} {row['throughput_rps']:>8} {row['queries_per_request']:>8}"
+            )
+        self.stdout.write(self.style.SUCCESS(f"Report written to {options['output']}"))
@@ -0,0 +1,43 @@
+import os
+from datetime import date
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from hospital.models import Appointment
+from hospital.pdf import day_tokens_pdf
+
+
+class Command(BaseCommand):
+    help = "Renders every token of one day into a single PDF for printing at the reception desk."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--date', help="Day to print (YYYY-MM-DD). Defaults to today.")
+        parser.add_argument('--doctor', type=int, help="Only this doctor's tokens.")
+        parser.add_argument('--output', help="Where to write the PDF. Defaults to TOKEN_PDF_DIR.")
+
+    def handle(self, *args, **options):
+        try:
+            day = date.fromisoformat(options['date']) if options['date'] else timezone.localdate()
+        except ValueError:
+            raise CommandError("--date must look like YYYY-MM-DD")
+
+        appointments = Appointment.objects.filter(booked_date=day).select_related(
+            'doctor__user', 'doctor__department'
+        ).order_by('doctor__department__name', 'doctor_id', 'token_number')
+        if options['doctor']:
+            appointments = appointments.filter(doctor_id=options['doctor'])
+        appointments = list(appointments)
+        if not appointments:
+            raise CommandError(f"No appointments booked on {day}.")
+
+        output = options['output']
+        if not output:
+            os.makedirs(settings.TOKEN_PDF_DIR, exist_ok=True)
+            suffix = f"-doctor{options['doctor']}" if options['doctor'] else ""
+            output = os.path.join(settings.TOKEN_PDF_DIR, f"day-{day}{suffix}.pdf")
+
+        with open(output, 'wb') as f:
+            f.write(day_tokens_pdf(appointments))
+        self.stdout.write(self.style.SUCCESS(f"Rendered {len(appointments)} tokens to {output}"))
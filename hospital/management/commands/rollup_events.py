@@ -0,0 +1,23 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from hospital.analytics import roll_up
+
+
+class Command(BaseCommand):
+    help = "Folds new appointment events into the hourly and daily analytics rollups."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--loop', action='store_true', help="Keep running, rolling up every --interval seconds.")
+        parser.add_argument('--interval', type=int, default=300)
+
+    def handle(self, *args, **options):
+        while True:
+            folded = roll_up(options['batch_size'])
+            self.stdout.write(f"Rolled up {folded} events.")
+
+            if not options['loop']:
+                return
+            time.sleep(options['interval'])
@@ -0,0 +1,114 @@
+"""
+Replays a date range of appointment history through estimation and
+assignment policies (see hospital/simulation.py) and compares them.
+
+    python manage.py simulate_queue --start 2025-01-01 --end 2025-12-31 \
+        --estimator ewma --estimator hourly --assignment as-booked --assignment earliest
+
+One row per policy pair, plus 'history' for what really happened.
+"""
+import json
+import time
+from datetime import date, timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from hospital.management.commands.benchmark import percentile
+from hospital.simulation import ASSIGNMENTS, ESTIMATORS, load_history, observed, replay
+
+
+def _day(value):
+    try:
+        return date.fromisoformat(value)
+    except ValueError:
+        raise CommandError(f"Expected a YYYY-MM-DD date, got '{value}'")
+
+
+def _mean(values):
+    return round(sum(values) / len(values), 2) if values else None
+
+
+def error_summary(errors):
+    """Signed errors in minutes -> bias plus absolute-error percentiles."""
+    absolute = sorted(abs(error) for error in errors)
+    return {
+        'samples': len(errors),
+        'bias_min': _mean(errors),
+        'mae_min': _mean(absolute),
+        'p50_abs_min': round(percentile(absolute, 50), 2) if absolute else None,
+        'p90_abs_min': round(percentile(absolute, 90), 2) if absolute else None,
+    }
+
+
+def summarize(samples):
+    waits = sorted(samples['waits'])
+    summary = {
+        'patients': len(waits),
+        'wait_p50_min': round(percentile(waits, 50), 2) if waits else None,
+        'wait_p90_min': round(percentile(waits, 90), 2) if waits else None,
+        'wait_p99_min': round(percentile(waits, 99), 2) if waits else None,
+        'start_estimate': error_summary(samples['start_errors']),
+    }
+    if 'duration_errors' in samples:
+        summary['duration_estimate'] = error_summary(samples['duration_errors'])
+        utilization = [u for u in samples['utilization'].values() if u is not None]
+        summary['utilization_mean'] = _mean(utilization)
+        summary['utilization_per_doctor'] = {
+            str(doctor_id): round(u, 3) for doctor_id, u in sorted(samples['utilization'].items()) if u is not None
+        }
+    return summary
+
+
+class Command(BaseCommand):
+    help = (
+        "Replays appointment history through estimation and assignment policies and reports "
+        "estimate errors, wait percentiles and doctor utilization."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--start', type=_day, help="First booking day (default: 30 days ago).")
+        parser.add_argument('--end', type=_day, help="Last booking day (default: yesterday).")
+        parser.add_argument('--estimator', action='append', choices=sorted(ESTIMATORS),
+                            help="Repeat to compare several (default: ewma).")
+        parser.add_argument('--assignment', action='append', choices=sorted(ASSIGNMENTS),
+                            help="Repeat to compare several (default: as-booked).")
+        parser.add_argument('--initial', type=float, default=15,
+                            help="Minutes an estimator assumes before it has seen a doctor.")
+        parser.add_argument('--output', help="Also write the full report (with per-doctor utilization) as JSON.")
+
+    def handle(self, *args, **options):
+        end = options['end'] or timezone.localdate() - timedelta(days=1)
+        start = options['start'] or end - timedelta(days=29)
+        if start > end:
+            raise CommandError("--start must not be after --end")
+
+        started = time.perf_counter()
+        visits, shifts = load_history(start, end)
+        self.stdout.write(f"Loaded {len(visits)} visits ({start} to {end}) in {time.perf_counter() - started:.2f}s")
+        if not visits:
+            return
+
+        report = {'start': str(start), 'end': str(end), 'runs': {'history': summarize(observed(visits))}}
+        for estimator in options['estimator'] or ['ewma']:
+            for assignment in options['assignment'] or ['as-booked']:
+                started = time.perf_counter()
+                samples = replay(visits, shifts, ESTIMATORS[estimator](options['initial']), ASSIGNMENTS[assignment])
+                report['runs'][f"{estimator}/{assignment}"] = summary = summarize(samples)
+                summary['replay_seconds'] = round(time.perf_counter() - started, 3)
+
+        self.stdout.write(
+            f"{'policy':<20} {'wait p50':>9} {'wait p90':>9} {'start MAE':>10} {'start bias':>11} "
+            f"{'length MAE':>11} {'utilization':>12}"
+        )
+        for name, row in report['runs'].items():
+            duration = row.get('duration_estimate', {})
+            self.stdout.write(
+                f"{name:<20} {row['wait_p50_min']!s:>9} {row['wait_p90_min']!s:>9} "
+                f"{row['start_estimate']['mae_min']!s:>10} {row['start_estimate']['bias_min']!s:>11} "
+                f"{duration.get('mae_min', '-')!s:>11} {row.get('utilization_mean', '-')!s:>12}"
+            )
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(report, f, indent=2)
+            self.stdout.write(self.style.SUCCESS(f"Report written to {options['output']}"))
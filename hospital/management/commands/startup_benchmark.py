@@ -0,0 +1,171 @@
+"""
+Cold-start benchmark: time from process start to the first served request.
+
+Each run starts a fresh interpreter (`python -X importtime`), imports the ASGI
+application the server would load and sends it one GET, with no server in
+between. The parent times the run from spawning the process to receiving
+the response. The child's import log gives import time per package and the
+slowest modules.
+
+    python manage.py startup_benchmark --runs 5 --max-ms 1500 --output startup.json
+
+It fails when a module in hospital.warmup.MODULES was already loaded when the
+first response went out, or when the median is over --max-ms. A heavy import
+that creeps back onto the startup path is caught before it ships.
+"""
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from hospital.warmup import MODULES as LAZY_MODULES
+
+# Runs in the child. Prints one line as soon as the response is complete, then
+# the details; sys.modules is captured before request_finished starts any warm-up.
+CHILD = r'''
+import asyncio, json, sys
+from importlib import import_module
+
+module_name, _, attribute = sys.argv[1].partition(':')
+path = sys.argv[2]
+application = getattr(import_module(module_name), attribute)
+result = {}
+pending = [{'type': 'http.request', 'body': b'', 'more_body': False}]
+
+async def receive():
+    if pending:
+        return pending.pop()
+    while 'modules' not in result:  # Client disconnects once it has the response
+        await asyncio.sleep(0.01)
+    return {'type': 'http.disconnect'}
+
+async def send(message):
+    if message['type'] == 'http.response.start':
+        result['status'] = message['status']
+    elif not message.get('more_body') and 'modules' not in result:
+        result['modules'] = sorted(sys.modules)
+        print('served', flush=True)
+
+scope = {
+    'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET',
+    'scheme': 'http', 'path': path, 'raw_path': path.encode(), 'query_string': b'', 'root_path': '',
+    'headers': [(b'host', b'localhost')], 'client': ('127.0.0.1', 0), 'server': ('localhost', 80),
+}
+asyncio.run(application(scope, receive, send))
+print(json.dumps(result), flush=True)
+'''
+
+
+def parse_importtime(text):
+    """`-X importtime` output -> [(module, self_us, cumulative_us), ...] in log order."""
+    rows = []
+    for line in text.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        parts = line[len('import time:'):].split('|')
+        if len(parts) != 3 or not parts[0].strip().isdigit():
+            continue  # The header line
+        rows.append((parts[2].strip(), int(parts[0]), int(parts[1])))
+    return rows
+
+
+def import_report(rows, top=15):
+    """Self time summed per top-level package, plus the slowest modules by cumulative time."""
+    packages = defaultdict(int)
+    for module, self_us, _ in rows:
+        packages[module.split('.')[0]] += self_us
+    return {
+        'total_ms': round(sum(packages.values()) / 1000, 1),
+        'packages_ms': {
+            name: round(us / 1000, 1)
+            for name, us in sorted(packages.items(), key=lambda item: -item[1])[:top]
+        },
+        'slowest_modules_ms': {
+            module: round(cumulative / 1000, 1)
+            for module, _, cumulative in sorted(rows, key=lambda row: -row[2])[:top]
+        },
+    }
+
+
+def cold_start(application, path):
+    """One fresh process. Returns (ms to first response, child result, importtime log)."""
+    env = dict(os.environ, DJANGO_SETTINGS_MODULE=settings.SETTINGS_MODULE, PYTHONDONTWRITEBYTECODE='1')
+    with tempfile.TemporaryFile(mode='w+') as log:  # A pipe could fill up and stall the child
+        started = time.perf_counter()
+        child = subprocess.Popen(
+            [sys.executable, '-X', 'importtime', '-c', CHILD, application, path],
+            cwd=settings.BASE_DIR, env=env, stdout=subprocess.PIPE, stderr=log, text=True,
+        )
+        first_line = child.stdout.readline()
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        rest, _ = child.communicate()
+        log.seek(0)
+        importtime = log.read()
+    if child.returncode or first_line.strip() != 'served':
+        raise CommandError(f"Cold start failed (exit {child.returncode}):\n{importtime[-2000:]}")
+    return elapsed_ms, json.loads(rest), importtime
+
+
+class Command(BaseCommand):
+    help = (
+        "Starts fresh processes that import the ASGI app and serve one request; reports time to "
+        "first response and import time per package, and fails on lazy modules loaded too early."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--application', default='config.asgi:application')
+        parser.add_argument('--path', default='/', help="URL of the first request.")
+        parser.add_argument('--runs', type=int, default=3)
+        parser.add_argument('--top', type=int, default=15, help="Packages / modules listed in the report.")
+        parser.add_argument('--max-ms', type=float, help="Fail if the median time to first response is above this.")
+        parser.add_argument('--output', help="Also write the report as JSON.")
+
+    def handle(self, *args, **options):
+        if options['runs'] < 1:
+            raise CommandError("--runs must be at least 1")
+
+        timings = []
+        for _ in range(options['runs']):
+            elapsed_ms, result, importtime = cold_start(options['application'], options['path'])
+            timings.append(elapsed_ms)
+        # The last run's imports: by then the OS file cache is as warm as a real cold start's
+        loaded = set(result['modules'])
+        early = [name for name in LAZY_MODULES if name in loaded]
+        report = {
+            'application': options['application'],
+            'path': options['path'],
+            'status': result['status'],
+            'first_response_ms': {
+                'runs': [round(ms, 1) for ms in timings],
+                'min': round(min(timings), 1),
+                'median': round(statistics.median(timings), 1),
+            },
+            'modules_loaded': len(result['modules']),
+            'lazy_modules_loaded': early,
+            'imports': import_report(parse_importtime(importtime), options['top']),
+        }
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(report, f, indent=2)
+
+        first = report['first_response_ms']
+        self.stdout.write(
+            f"First response ({options['path']} -> {report['status']}): "
+            f"median {first['median']} ms, min {first['min']} ms over {options['runs']} run(s)"
+        )
+        self.stdout.write(f"Imports: {report['imports']['total_ms']} ms in {report['modules_loaded']} modules")
+        for name, ms in report['imports']['packages_ms'].items():
+            self.stdout.write(f"  {name:<30} {ms:>8} ms")
+
+        if early:
+            raise CommandError(f"Loaded before the first response, should be lazy: {', '.join(early)}")
+        if options['max_ms'] is not None and first['median'] > options['max_ms']:
+            raise CommandError(f"Median first response {first['median']} ms is over the {options['max_ms']} ms budget")
+        self.stdout.write(self.style.SUCCESS("Startup is within budget."))
@@ -0,0 +1,258 @@
+"""
+Request instrumentation, exported at /metrics (staff or METRICS_TOKEN) in Prometheus text format.
+
+MetricsMiddleware times every request per URL name and counts the DB queries
+and DB time spent inside it through an execute wrapper that every connection
+gets when it opens. The Firebase outbox reports each HTTP attempt. That is
+enough to tell whether a slow check-in is spent in the database, waiting on
+Firebase or in Python/templates.
+
+Hot-path cost is a few dict updates. Every thread writes only to its own
+shard, so recording takes no lock. The scrape sums all shards; a value
+written during a scrape just shows up in the next one.
+"""
+import threading
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+
+# Upper bounds in seconds (Prometheus "le" buckets; +Inf is implicit)
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Histogram:
+    __slots__ = ('counts', 'sum')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)  # Per bucket, not cumulative; last one is +Inf
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+
+    def merge(self, other):
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+        self.sum += other.sum
+
+
+class Shard:
+    """One thread's aggregates. Only its owner thread ever writes to it."""
+
+    __slots__ = ('latency', 'responses', 'db_queries', 'db_seconds', 'firebase', 'firebase_errors')
+
+    def __init__(self):
+        self.latency = {}          # (view, method) -> Histogram
+        self.responses = {}        # (view, status) -> count
+        self.db_queries = {}       # view -> count
+        self.db_seconds = {}       # view -> seconds
+        self.firebase = {}         # outcome -> Histogram
+        self.firebase_errors = {}  # reason -> count
+
+
+_local = threading.local()
+_shards = []
+_shards_lock = threading.Lock()  # Only taken when a thread records for the first time
+
+
+def _shard():
+    try:
+        return _local.shard
+    except AttributeError:
+        shard = _local.shard = Shard()
+        with _shards_lock:
+            _shards.append(shard)
+        return shard
+
+
+def _histogram(table, key):
+    histogram = table.get(key)
+    if histogram is None:
+        histogram = table[key] = Histogram()
+    return histogram
+
+
+# ==========================================
+# RECORDING
+# ==========================================
+
+def record_request(view, method, status, seconds, queries, query_seconds):
+    shard = _shard()
+    _histogram(shard.latency, (view, method)).observe(seconds)
+    shard.responses[view, status] = shard.responses.get((view, status), 0) + 1
+    shard.db_queries[view] = shard.db_queries.get(view, 0) + queries
+    shard.db_seconds[view] = shard.db_seconds.get(view, 0.0) + query_seconds
+
+
+def record_firebase(seconds, error=None):
+    """One HTTP attempt to Firebase; `error` is a short reason like 'http_503' or 'timeout'."""
+    shard = _shard()
+    _histogram(shard.firebase, 'error' if error else 'ok').observe(seconds)
+    if error:
+        shard.firebase_errors[error] = shard.firebase_errors.get(error, 0) + 1
+
+
+def reset():
+    """Forgets everything recorded so far (tests). Shards stay registered to their threads."""
+    with _shards_lock:
+        for shard in _shards:
+            shard.__init__()
+
+
+class QueryTimer:
+    """Counts the queries of one request and their time."""
+
+    __slots__ = ('count', 'seconds')
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+
+# The request being timed. A ContextVar (not the connection) because async views
+# run their ORM calls on another thread; the context travels with sync_to_async.
+_query_timer = ContextVar('hospital_query_timer', default=None)
+
+
+def _time_query(execute, sql, params, many, context):
+    timer = _query_timer.get()
+    if timer is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        timer.count += 1
+        timer.seconds += time.perf_counter() - started
+
+
+def install_query_timer(sender, connection, **kwargs):
+    """connection_created receiver: puts the execute wrapper on every new connection."""
+    if _time_query not in connection.execute_wrappers:
+        connection.execute_wrappers.insert(0, _time_query)
+
+
+class MetricsMiddleware:
+    """
+    Put it first in MIDDLEWARE so the timing covers the whole stack.
+    Works on both stacks, so it never forces async views onto a thread.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        timer = QueryTimer()
+        token = _query_timer.set(timer)
+        started = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            _query_timer.reset(token)
+        self._record(request, response, time.perf_counter() - started, timer)
+        return response
+
+    async def __acall__(self, request):
+        timer = QueryTimer()
+        token = _query_timer.set(timer)
+        started = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _query_timer.reset(token)
+        self._record(request, response, time.perf_counter() - started, timer)
+        return response
+
+    @staticmethod
+    def _record(request, response, elapsed, timer):
+        match = getattr(request, 'resolver_match', None)
+        view = match.view_name if match else 'unresolved'  # e.g. static files, 404s
+        record_request(view, request.method, response.status_code, elapsed, timer.count, timer.seconds)
+
+
+# ==========================================
+# EXPORT
+# ==========================================
+
+def _merged():
+    with _shards_lock:
+        shards = list(_shards)
+    total = Shard()
+    for shard in shards:
+        # list(): the owner thread may add keys while we iterate
+        for key, histogram in list(shard.latency.items()):
+            _histogram(total.latency, key).merge(histogram)
+        for key, histogram in list(shard.firebase.items()):
+            _histogram(total.firebase, key).merge(histogram)
+        for mine, theirs in ((total.responses, shard.responses), (total.db_queries, shard.db_queries),
+                             (total.db_seconds, shard.db_seconds), (total.firebase_errors, shard.firebase_errors)):
+            for key, value in list(theirs.items()):
+                mine[key] = mine.get(key, 0) + value
+    return total
+
+
+def _labels(**labels):
+    return '{' + ','.join(f'{name}="{value}"' for name, value in labels.items()) + '}'
+
+
+def _histogram_lines(name, histogram, **labels):
+    cumulative = 0
+    for bound, count in zip(BUCKETS + ('+Inf',), histogram.counts):
+        cumulative += count
+        yield f"{name}_bucket{_labels(**labels, le=bound)} {cumulative}"
+    yield f"{name}_sum{_labels(**labels)} {histogram.sum}"
+    yield f"{name}_count{_labels(**labels)} {cumulative}"
+
+
+def render(extra=()):
+    """
+    Prometheus text exposition of everything recorded.
+    `extra` adds single-value metrics as (name, type, help, value).
+    """
+    total = _merged()
+    lines = [
+        "# HELP hospital_http_request_duration_seconds Time spent serving the request.",
+        "# TYPE hospital_http_request_duration_seconds histogram",
+    ]
+    for (view, method), histogram in sorted(total.latency.items()):
+        lines.extend(_histogram_lines('hospital_http_request_duration_seconds', histogram, view=view, method=method))
+
+    lines += ["# HELP hospital_http_responses_total Responses by status code.",
+              "# TYPE hospital_http_responses_total counter"]
+    lines += [f"hospital_http_responses_total{_labels(view=view, status=status)} {count}"
+              for (view, status), count in sorted(total.responses.items())]
+
+    lines += ["# HELP hospital_db_queries_total Database queries run while serving requests.",
+              "# TYPE hospital_db_queries_total counter"]
+    lines += [f"hospital_db_queries_total{_labels(view=view)} {count}"
+              for view, count in sorted(total.db_queries.items())]
+
+    lines += ["# HELP hospital_db_query_seconds_total Time spent in database queries.",
+              "# TYPE hospital_db_query_seconds_total counter"]
+    lines += [f"hospital_db_query_seconds_total{_labels(view=view)} {seconds}"
+              for view, seconds in sorted(total.db_seconds.items())]
+
+    lines += ["# HELP hospital_firebase_request_duration_seconds Firebase HTTP attempts made by the sync outbox.",
+              "# TYPE hospital_firebase_request_duration_seconds histogram"]
+    for outcome, histogram in sorted(total.firebase.items()):
+        lines.extend(_histogram_lines('hospital_firebase_request_duration_seconds', histogram, outcome=outcome))
+
+    lines += ["# HELP hospital_firebase_errors_total Failed Firebase HTTP attempts by reason.",
+              "# TYPE hospital_firebase_errors_total counter"]
+    lines += [f"hospital_firebase_errors_total{_labels(reason=reason)} {count}"
+              for reason, count in sorted(total.firebase_errors.items())]
+
+    for name, kind, help_text, value in extra:
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}", f"{name} {value}"]
+    return '\n'.join(lines) + '\n'
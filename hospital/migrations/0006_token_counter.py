@@ -0,0 +1,26 @@
+# Generated by Django 6.0.1 on 2026-10-18 18:02
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hospital', '0005_appointment_patient_email'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TokenCounter',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('last_token', models.PositiveIntegerField(default=0)),
+                ('doctor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='token_counters', to='hospital.doctor')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('doctor', 'day'), name='unique_token_counter_per_doctor_day')],
+            },
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 6.0.1 on 2026-10-18 18:10
+
+import django.utils.timezone
+from django.db import migrations, models
+from django.db.models.functions import TruncDate
+
+
+def backfill_booked_date(apps, schema_editor):
+    # One UPDATE for the whole table, in the active time zone like booked_at__date
+    Appointment = apps.get_model('hospital', 'Appointment')
+    Appointment.objects.update(booked_date=TruncDate('booked_at'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hospital', '0006_token_counter'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='appointment',
+            name='booked_date',
+            field=models.DateField(default=django.utils.timezone.localdate, editable=False),
+        ),
+        migrations.RunPython(backfill_booked_date, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='appointment',
+            index=models.Index(fields=['doctor', 'status', 'token_number'], name='appt_doctor_status_token_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='appointment',
+            index=models.Index(fields=['doctor', 'booked_date'], name='appt_doctor_booked_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='appointment',
+            index=models.Index(fields=['patient_email'], name='appt_patient_email_idx'),
+        ),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 6.0.1 on 2026-10-18 18:13
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hospital', '0007_appointment_booked_date_and_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DoctorStats',
+            fields=[
+                ('doctor', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='stats', serialize=False, to='hospital.doctor')),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('total', models.FloatField(default=0)),
+                ('total_sq', models.FloatField(default=0)),
+                ('ewma', models.FloatField(default=15)),
+                ('p50', models.FloatField(default=15)),
+                ('p90', models.FloatField(default=15)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='DoctorHourStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('hour', models.PositiveSmallIntegerField()),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('total', models.FloatField(default=0)),
+                ('doctor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='hour_stats', to='hospital.doctor')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('doctor', 'hour'), name='unique_hour_stats_per_doctor_hour')],
+            },
+        ),
+    ]
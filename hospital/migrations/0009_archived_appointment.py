@@ -0,0 +1,35 @@
+# Generated by Django 6.0.1 on 2026-10-18 18:28
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hospital', '0008_doctor_stats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedAppointment',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('patient_name', models.CharField(max_length=100)),
+                ('patient_email', models.EmailField(blank=True, max_length=254, null=True)),
+                ('booked_at', models.DateTimeField()),
+                ('booked_date', models.DateField()),
+                ('ticket_id', models.CharField(max_length=20, unique=True)),
+                ('token_number', models.PositiveIntegerField(blank=True, null=True)),
+                ('status', models.CharField(choices=[('waiting', 'Waiting'), ('in_consultation', 'In Consultation'), ('completed', 'Completed'), ('cancelled', 'Cancelled')], max_length=20)),
+                ('estimated_start_time', models.DateTimeField(blank=True, null=True)),
+                ('actual_start_time', models.DateTimeField(blank=True, null=True)),
+                ('actual_end_time', models.DateTimeField(blank=True, null=True)),
+                ('archived_at', models.DateTimeField(auto_now_add=True)),
+                ('doctor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archived_appointments', to='hospital.doctor')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['patient_email'], name='archived_patient_email_idx'), models.Index(fields=['doctor', 'booked_date'], name='archived_doctor_date_idx')],
+            },
+        ),
+    ]
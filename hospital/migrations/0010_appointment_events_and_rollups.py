@@ -0,0 +1,74 @@
+# Generated by Django 6.0.1 on 2026-10-18 19:11
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hospital', '0009_archived_appointment'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RollupCheckpoint',
+            fields=[
+                ('name', models.CharField(max_length=40, primary_key=True, serialize=False)),
+                ('last_event_id', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='AppointmentEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('appointment_id', models.BigIntegerField(db_index=True)),
+                ('kind', models.CharField(choices=[('booked', 'Booked'), ('called', 'Called in'), ('completed', 'Completed'), ('cancelled', 'Cancelled'), ('reassigned', 'Reassigned')], max_length=12)),
+                ('at', models.DateTimeField()),
+                ('wait_minutes', models.FloatField(blank=True, null=True)),
+                ('duration_minutes', models.FloatField(blank=True, null=True)),
+                ('department', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='events', to='hospital.department')),
+                ('doctor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='events', to='hospital.doctor')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='DepartmentRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period', models.CharField(choices=[('hour', 'Hour'), ('day', 'Day')], max_length=4)),
+                ('start', models.DateTimeField()),
+                ('booked', models.PositiveIntegerField(default=0)),
+                ('called', models.PositiveIntegerField(default=0)),
+                ('completed', models.PositiveIntegerField(default=0)),
+                ('cancelled', models.PositiveIntegerField(default=0)),
+                ('wait_minutes', models.FloatField(default=0)),
+                ('consultations', models.PositiveIntegerField(default=0)),
+                ('consultation_minutes', models.FloatField(default=0)),
+                ('department', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='rollups', to='hospital.department')),
+            ],
+            options={
+                'verbose_name_plural': 'department analytics',
+                'indexes': [models.Index(fields=['period', 'start'], name='department_rollup_period_idx')],
+                'constraints': [models.UniqueConstraint(fields=('department', 'period', 'start'), name='unique_department_rollup')],
+            },
+        ),
+        migrations.CreateModel(
+            name='DoctorRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period', models.CharField(choices=[('hour', 'Hour'), ('day', 'Day')], max_length=4)),
+                ('start', models.DateTimeField()),
+                ('booked', models.PositiveIntegerField(default=0)),
+                ('called', models.PositiveIntegerField(default=0)),
+                ('completed', models.PositiveIntegerField(default=0)),
+                ('cancelled', models.PositiveIntegerField(default=0)),
+                ('wait_minutes', models.FloatField(default=0)),
+                ('consultations', models.PositiveIntegerField(default=0)),
+                ('consultation_minutes', models.FloatField(default=0)),
+                ('doctor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='rollups', to='hospital.doctor')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('doctor', 'period', 'start'), name='unique_doctor_rollup')],
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 6.0.1 on 2026-10-18 19:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hospital', '0010_appointment_events_and_rollups'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='appointment',
+            name='turn_notified_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+    ]
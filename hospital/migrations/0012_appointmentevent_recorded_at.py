@@ -0,0 +1,19 @@
+# Generated by Django 6.0.1 on 2026-10-18 19:41
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hospital', '0011_appointment_turn_notified_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='appointmentevent',
+            name='recorded_at',
+            field=models.DateTimeField(default=django.utils.timezone.now, editable=False),
+        ),
+    ]
@@ -1,8 +1,30 @@
-from django.db import models
+from django.db import models, transaction, IntegrityError
+from django.db.models import Case, F, Max, OuterRef, Subquery, When
+from django.db.models.functions import Ceil, Greatest, Least
 from django.contrib.auth.models import User
 from django.utils import timezone
 import uuid
-import math
+
+def new_ticket_id():
+    """Public ticket code, e.g. 20251020-A1B2."""
+    today_str = timezone.now().strftime('%Y%m%d')
+    random_code = str(uuid.uuid4())[:4].upper()
+    return f"{today_str}-{random_code}"
+
+def new_ticket_ids(count):
+    """
+    `count` distinct ticket codes for bulk_create, which bypasses save().
+    Unique within the batch and checked against the table in one query.
+    """
+    ticket_ids = set()
+    while len(ticket_ids) < count:
+        candidates = set()
+        while len(ticket_ids) + len(candidates) < count:
+            candidates.add(new_ticket_id())
+        candidates -= ticket_ids
+        taken = set(Appointment.objects.filter(ticket_id__in=candidates).values_list('ticket_id', flat=True))
+        ticket_ids |= candidates - taken
+    return list(ticket_ids)
 
 class Department(models.Model):
     name = models.CharField(max_length=100)
@@ -23,21 +45,25 @@ class Doctor(models.Model):
     def __str__(self):
         return f"Dr. {self.user.first_name} ({self.department.name})"
 
-    def update_average_time(self, actual_duration_minutes):
+    def update_average_time(self, actual_duration_minutes, finished_at=None):
         """
         AI ALGORITHM: Recalculates doctor's average speed based on real performance.
         Weighted Average: 70% historical data, 30% most recent patient.
+
+        The statistics live in DoctorStats and are updated with atomic SQL, so
+        concurrent completions never overwrite each other. avg_consultation_time
+        is then re-derived from the stored average in the same way.
         """
         if actual_duration_minutes < 1: return # Ignore accidental clicks
 
-        # Calculate new weighted average
-        new_avg = (self.avg_consultation_time * 0.7) + (actual_duration_minutes * 0.3)
-        
+        DoctorStats.record(self, actual_duration_minutes, finished_at)
+
         # Enforce limits (Min 5 mins, Max 45 mins) to prevent errors
-        new_avg = max(5, min(45, new_avg))
-        
-        self.avg_consultation_time = math.ceil(new_avg)
-        self.save()
+        new_avg = DoctorStats.objects.filter(doctor=OuterRef('pk')).values(
+            rounded=Ceil(Greatest(Least(F('ewma'), 45.0), 5.0))
+        )[:1]
+        Doctor.objects.filter(pk=self.pk).update(avg_consultation_time=Subquery(new_avg))
+        self.refresh_from_db(fields=['avg_consultation_time'])
 
 class Appointment(models.Model):
     STATUS_CHOICES = [
@@ -53,6 +79,8 @@ class Appointment(models.Model):
     patient_email = models.EmailField(null=True, blank=True) 
     doctor = models.ForeignKey(Doctor, on_delete=models.CASCADE, related_name='appointments')
     booked_at = models.DateTimeField(auto_now_add=True)
+    # Stored day of booked_at: `booked_at__date` wraps the column in a function and can't use an index
+    booked_date = models.DateField(default=timezone.localdate, editable=False)
     
     # Unique ID (e.g., 20251020-A1B2)
     ticket_id = models.CharField(max_length=20, unique=True, blank=True)
@@ -63,6 +91,18 @@ class Appointment(models.Model):
     estimated_start_time = models.DateTimeField(null=True, blank=True) 
     actual_start_time = models.DateTimeField(null=True, blank=True)
     actual_end_time = models.DateTimeField(null=True, blank=True)
+    # "Your turn is near" email sent (hospital/notify.py); set once, so it is sent once
+    turn_notified_at = models.DateTimeField(null=True, blank=True, editable=False)
+
+    class Meta:
+        indexes = [
+            # Queue reads: WHERE doctor = ? AND status = ? ORDER BY token_number
+            models.Index(fields=['doctor', 'status', 'token_number'], name='appt_doctor_status_token_idx'),
+            # Today's tokens / history: WHERE doctor = ? AND booked_date = ?
+            models.Index(fields=['doctor', 'booked_date'], name='appt_doctor_booked_date_idx'),
+            # Patient history lookup
+            models.Index(fields=['patient_email'], name='appt_patient_email_idx'),
+        ]
 
     def __str__(self):
         return f"Token {self.token_number} - {self.patient_name}"
@@ -70,11 +110,321 @@ class Appointment(models.Model):
     def save(self, *args, **kwargs):
         # 1. Generate Unique Ticket ID if missing
         if not self.ticket_id:
-            today_str = timezone.now().strftime('%Y%m%d')
-            random_code = str(uuid.uuid4())[:4].upper()
-            self.ticket_id = f"{today_str}-{random_code}"
+            self.ticket_id = new_ticket_id()
         
         super().save(*args, **kwargs)
 
     def __str__(self):
-        return f"Token {self.token_number} - {self.patient_name}"
\ No newline at end of file
+        return f"Token {self.token_number} - {self.patient_name}"
+
+class TokenCounter(models.Model):
+    """
+    Per-doctor, per-day high water mark for issued tokens.
+    Lives in our own database so booking never waits on Firebase.
+    """
+    doctor = models.ForeignKey(Doctor, on_delete=models.CASCADE, related_name='token_counters')
+    day = models.DateField()
+    last_token = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['doctor', 'day'], name='unique_token_counter_per_doctor_day'),
+        ]
+
+    def __str__(self):
+        return f"{self.doctor} - {self.day}: {self.last_token}"
+
+    @classmethod
+    def allocate(cls, doctor, count=1, day=None):
+        """
+        Reserves `count` consecutive tokens for the doctor and returns the first one.
+        Call it inside transaction.atomic() together with the save, so a failed
+        booking rolls the counter back and tokens stay gap-free.
+        """
+        day = day or timezone.localdate()
+        counters = cls.objects.filter(doctor=doctor, day=day)
+
+        # 1. Atomic increment: the UPDATE takes the row (or SQLite write) lock first
+        if not counters.update(last_token=F('last_token') + count):
+            # 2. First booking of the day: seed from tokens already issued locally
+            seed = Appointment.objects.filter(
+                doctor=doctor, booked_date=day
+            ).aggregate(last=Max('token_number'))['last'] or 0
+            try:
+                with transaction.atomic():
+                    cls.objects.create(doctor=doctor, day=day, last_token=seed + count)
+                return seed + 1
+            except IntegrityError:
+                # Someone else created today's row between our UPDATE and INSERT
+                counters.update(last_token=F('last_token') + count)
+
+        # 3. We hold the lock until commit, so this read sees our own increment
+        last_token = counters.values_list('last_token', flat=True).get()
+        return last_token - count + 1
+
+class DoctorStats(models.Model):
+    """
+    Streaming consultation-duration statistics for one doctor.
+
+    Every completion updates the row in O(1) with a single UPDATE built from F()
+    expressions, so there is no read-modify-write and nothing scans history:
+    - ewma: the 70/30 weighted average that drives avg_consultation_time
+    - count / total / total_sq: running mean and variance
+    - p50 / p90: streaming quantile estimates (stochastic gradient steps)
+    Hour-of-day averages live in DoctorHourStats.
+    """
+    QUANTILE_STEP = 0.5   # minutes moved per sample by the p50/p90 estimators
+    MAX_SAMPLE = 180      # clip forgotten "complete" clicks to 3 hours
+    MIN_HOUR_SAMPLES = 5  # trust an hour bucket once it has this many samples
+
+    doctor = models.OneToOneField(Doctor, on_delete=models.CASCADE, primary_key=True, related_name='stats')
+    count = models.PositiveIntegerField(default=0)
+    total = models.FloatField(default=0)
+    total_sq = models.FloatField(default=0)
+    ewma = models.FloatField(default=15)
+    p50 = models.FloatField(default=15)
+    p90 = models.FloatField(default=15)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.doctor}: {self.ewma:.1f} min (n={self.count})"
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else self.ewma
+
+    @property
+    def variance(self):
+        if self.count < 2:
+            return 0.0
+        return max(self.total_sq - self.total * self.total / self.count, 0.0) / (self.count - 1)
+
+    @classmethod
+    def record(cls, doctor, minutes, finished_at=None):
+        """Folds one finished consultation into the doctor's stats (two atomic UPDATEs)."""
+        x = float(min(minutes, cls.MAX_SAMPLE))
+        hour = timezone.localtime(finished_at or timezone.now()).hour
+        step = cls.QUANTILE_STEP
+
+        def quantile(field, q):
+            # q-quantile estimate: up by step*q when the sample is above, down by step*(1-q) otherwise
+            return Case(When(**{f"{field}__lte": x}, then=F(field) + step * q), default=F(field) - step * (1 - q))
+
+        fields = dict(
+            count=F('count') + 1,
+            total=F('total') + x,
+            total_sq=F('total_sq') + x * x,
+            ewma=F('ewma') * 0.7 + x * 0.3,
+            p50=quantile('p50', 0.5),
+            p90=quantile('p90', 0.9),
+            updated_at=timezone.now(),
+        )
+        if not cls.objects.filter(doctor=doctor).update(**fields):
+            seed = float(doctor.avg_consultation_time)
+            try:
+                with transaction.atomic():
+                    cls.objects.create(doctor=doctor, ewma=seed, p50=seed, p90=seed)
+            except IntegrityError:
+                pass  # Created concurrently
+            cls.objects.filter(doctor=doctor).update(**fields)
+
+        hours = DoctorHourStats.objects.filter(doctor=doctor, hour=hour)
+        if not hours.update(count=F('count') + 1, total=F('total') + x):
+            try:
+                with transaction.atomic():
+                    DoctorHourStats.objects.create(doctor=doctor, hour=hour, count=1, total=x)
+            except IntegrityError:
+                hours.update(count=F('count') + 1, total=F('total') + x)
+
+    @classmethod
+    def expected_minutes(cls, doctor, at=None):
+        """
+        Best guess for the next consultation's length: the hour-of-day average once
+        that bucket has enough samples, else the EWMA. One primary-key lookup.
+        """
+        return cls._pick_minutes(doctor, cls._expected_minutes_rows([doctor], at).first())
+
+    @classmethod
+    async def aexpected_minutes(cls, doctor, at=None):
+        """Async twin of expected_minutes() for async views."""
+        return cls._pick_minutes(doctor, await cls._expected_minutes_rows([doctor], at).afirst())
+
+    @classmethod
+    def expected_minutes_many(cls, doctors, at=None):
+        """expected_minutes() for several doctors in one query: {doctor id: minutes}."""
+        doctors = list(doctors)
+        rows = {row[0]: row for row in cls._expected_minutes_rows(doctors, at)}
+        return {doctor.id: cls._pick_minutes(doctor, rows.get(doctor.id)) for doctor in doctors}
+
+    @classmethod
+    def _expected_minutes_rows(cls, doctors, at):
+        hour = timezone.localtime(at or timezone.now()).hour
+        bucket = DoctorHourStats.objects.filter(doctor=OuterRef('doctor'), hour=hour)
+        return cls.objects.filter(doctor__in=doctors).annotate(
+            hour_count=Subquery(bucket.values('count')[:1]),
+            hour_total=Subquery(bucket.values('total')[:1]),
+        ).values_list('doctor_id', 'ewma', 'hour_count', 'hour_total')
+
+    @classmethod
+    def _pick_minutes(cls, doctor, row):
+        if row is None:
+            return float(doctor.avg_consultation_time)
+        _, ewma, hour_count, hour_total = row
+        if hour_count and hour_count >= cls.MIN_HOUR_SAMPLES:
+            return hour_total / hour_count
+        return ewma
+
+
+class DoctorHourStats(models.Model):
+    """Consultation count and total minutes per doctor per hour of the day (0-23)."""
+    doctor = models.ForeignKey(Doctor, on_delete=models.CASCADE, related_name='hour_stats')
+    hour = models.PositiveSmallIntegerField()
+    count = models.PositiveIntegerField(default=0)
+    total = models.FloatField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['doctor', 'hour'], name='unique_hour_stats_per_doctor_hour'),
+        ]
+
+    def __str__(self):
+        return f"{self.doctor} @ {self.hour:02d}:00"
+
+class ArchivedAppointment(models.Model):
+    """
+    Cold storage for finished appointments (see hospital/archive.py).
+    Same columns as Appointment and the same id, so the live table only holds
+    today plus a few days and every queue query stays small.
+    """
+    id = models.BigIntegerField(primary_key=True)  # The original Appointment id
+    patient_name = models.CharField(max_length=100)
+    patient_email = models.EmailField(null=True, blank=True)
+    doctor = models.ForeignKey(Doctor, on_delete=models.CASCADE, related_name='archived_appointments')
+    booked_at = models.DateTimeField()
+    booked_date = models.DateField()
+    ticket_id = models.CharField(max_length=20, unique=True)
+    token_number = models.PositiveIntegerField(null=True, blank=True)
+    status = models.CharField(max_length=20, choices=Appointment.STATUS_CHOICES)
+    estimated_start_time = models.DateTimeField(null=True, blank=True)
+    actual_start_time = models.DateTimeField(null=True, blank=True)
+    actual_end_time = models.DateTimeField(null=True, blank=True)
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['patient_email'], name='archived_patient_email_idx'),
+            models.Index(fields=['doctor', 'booked_date'], name='archived_doctor_date_idx'),
+        ]
+
+    def __str__(self):
+        return f"Token {self.token_number} - {self.patient_name} (archived)"
+
+
+class AppointmentEvent(models.Model):
+    """
+    Append-only log of appointment status transitions, written in the same
+    transaction as the change itself. Waits and consultation lengths are
+    worked out at write time, so the rollups (hospital/analytics.py) only
+    ever add numbers and never join back to Appointment. The appointment id
+    is kept without a foreign key: it must survive the row being archived.
+    """
+    KIND_CHOICES = [
+        ('booked', 'Booked'),
+        ('called', 'Called in'),
+        ('completed', 'Completed'),
+        ('cancelled', 'Cancelled'),
+        ('reassigned', 'Reassigned'),
+    ]
+
+    appointment_id = models.BigIntegerField(db_index=True)
+    doctor = models.ForeignKey(Doctor, on_delete=models.CASCADE, related_name='events')
+    department = models.ForeignKey(Department, on_delete=models.CASCADE, related_name='events')
+    kind = models.CharField(max_length=12, choices=KIND_CHOICES)
+    at = models.DateTimeField()
+    wait_minutes = models.FloatField(null=True, blank=True)      # called: booked -> called in
+    duration_minutes = models.FloatField(null=True, blank=True)  # completed: called in -> done
+    recorded_at = models.DateTimeField(default=timezone.now, editable=False)  # Written, not happened: see analytics
+
+    def __str__(self):
+        return f"#{self.appointment_id} {self.kind} at {self.at:%Y-%m-%d %H:%M}"
+
+    @classmethod
+    def for_appointment(cls, appointment, kind, at=None):
+        """The (unsaved) event for `appointment` having just become `kind`; see record()."""
+        start, end = appointment.actual_start_time, appointment.actual_end_time
+        if at is None:
+            at = {'booked': appointment.booked_at, 'called': start, 'completed': end}.get(kind) or timezone.now()
+        wait = duration = None
+        if kind == 'called' and start and appointment.booked_at:
+            wait = max((start - appointment.booked_at).total_seconds() / 60, 0.0)
+        if kind == 'completed' and start and end and end > start:
+            duration = (end - start).total_seconds() / 60
+        return cls(
+            appointment_id=appointment.id, doctor_id=appointment.doctor_id,
+            department_id=appointment.doctor.department_id, kind=kind, at=at,
+            wait_minutes=wait, duration_minutes=duration,
+        )
+
+    @classmethod
+    def record(cls, appointment, kind, at=None):
+        """Call inside the transaction that saves the status change."""
+        event = cls.for_appointment(appointment, kind, at)
+        event.save()
+        return event
+
+
+class RollupCounts(models.Model):
+    """Additive counters for one period of one doctor or department (see hospital/analytics.py)."""
+    PERIOD_CHOICES = [('hour', 'Hour'), ('day', 'Day')]
+    COUNTERS = ('booked', 'called', 'completed', 'cancelled', 'wait_minutes', 'consultations', 'consultation_minutes')
+
+    period = models.CharField(max_length=4, choices=PERIOD_CHOICES)
+    start = models.DateTimeField()  # Local start of the hour / day
+    booked = models.PositiveIntegerField(default=0)
+    called = models.PositiveIntegerField(default=0)
+    completed = models.PositiveIntegerField(default=0)
+    cancelled = models.PositiveIntegerField(default=0)
+    wait_minutes = models.FloatField(default=0)           # Summed over `called`
+    consultations = models.PositiveIntegerField(default=0)  # Completions with a measured length
+    consultation_minutes = models.FloatField(default=0)
+
+    class Meta:
+        abstract = True
+
+
+class DoctorRollup(RollupCounts):
+    doctor = models.ForeignKey(Doctor, on_delete=models.CASCADE, related_name='rollups')
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['doctor', 'period', 'start'], name='unique_doctor_rollup'),
+        ]
+
+    def __str__(self):
+        return f"{self.doctor} {self.period} {self.start:%Y-%m-%d %H:%M}"
+
+
+class DepartmentRollup(RollupCounts):
+    department = models.ForeignKey(Department, on_delete=models.CASCADE, related_name='rollups')
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['department', 'period', 'start'], name='unique_department_rollup'),
+        ]
+        indexes = [
+            # Reports: WHERE period = ? AND start BETWEEN ? AND ?, all departments
+            models.Index(fields=['period', 'start'], name='department_rollup_period_idx'),
+        ]
+        verbose_name_plural = 'department analytics'  # Its admin page is the analytics report
+
+    def __str__(self):
+        return f"{self.department} {self.period} {self.start:%Y-%m-%d %H:%M}"
+
+
+class RollupCheckpoint(models.Model):
+    """How far into AppointmentEvent the rollups have got."""
+    name = models.CharField(max_length=40, primary_key=True)
+    last_event_id = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.name}: {self.last_event_id}"
@@ -0,0 +1,214 @@
+"""
+"Your turn is near" emails, sent when a doctor calls the next patient.
+
+Patients used to poll patient_live_status to find out when to walk back to
+the room. Now call_patient() runs queue_advanced(). It finds the waiting
+patients who have just come within TURN_NOTIFY_PATIENTS_AHEAD places or
+TURN_NOTIFY_MINUTES_AWAY minutes of their turn, in one indexed query, and
+hands their ids to the notifier. The request never touches SMTP (unless
+TURN_NOTIFY_IN_BACKGROUND is off, which sends inline).
+
+A single background worker sends the emails in batches over one SMTP
+connection. The connection stays open while there is work and is closed once
+the worker has been idle for a while. Each appointment is claimed with a
+conditional UPDATE on turn_notified_at before its email goes out, so the
+patient gets one email however many calls, workers or processes see them
+cross the threshold. A batch that fails to send is unclaimed, and the next
+call picks those patients up again.
+"""
+import atexit
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.db import close_old_connections
+from django.db.models import Q
+from django.template.loader import render_to_string
+from django.utils import timezone
+
+from .models import Appointment
+from .queue_state import get_queue_state
+
+
+def due_for_notice(doctor, now=None):
+    """
+    {appointment id: people ahead} for the doctor's waiting patients who are
+    within either threshold, have an email and haven't been notified yet.
+    """
+    now = now or timezone.now()
+    state = get_queue_state(doctor)
+    if not state.total_waiting:
+        return {}
+    near = Q(id__in=state.ids[:settings.TURN_NOTIFY_PATIENTS_AHEAD + 1])
+    near |= Q(estimated_start_time__lte=now + timedelta(minutes=settings.TURN_NOTIFY_MINUTES_AWAY))
+    due = Appointment.objects.filter(
+        near, doctor=doctor, status='waiting', turn_notified_at__isnull=True, patient_email__gt='',
+    ).values_list('id', flat=True)
+    position = {appointment_id: i for i, appointment_id in enumerate(state.ids)}
+    return {appointment_id: position.get(appointment_id, 0) for appointment_id in due}
+
+
+def queue_advanced(doctor, now=None):
+    """Queues the emails for everyone the last call brought close to their turn."""
+    due = due_for_notice(doctor, now)
+    if due:
+        notifier.enqueue(due)
+    return len(due)
+
+
+def turn_near_message(appointment, people_ahead):
+    context = {'appointment': appointment, 'doctor': appointment.doctor, 'people_ahead': people_ahead}
+    return EmailMessage(
+        subject=f"Token {appointment.token_number}: your turn is near",
+        body=render_to_string('hospital/email/turn_near.txt', context),
+        to=[appointment.patient_email],
+    )
+
+
+class TurnNotifier:
+    """
+    Pending notices ({appointment id: people ahead}, so a patient queued
+    twice is still one entry) and the worker that sends them.
+    """
+
+    def __init__(self, batch_size=None, linger=0.2, idle_close=30, autostart=True):
+        self.batch_size = batch_size
+        self.linger = linger
+        self.idle_close = idle_close
+        self.autostart = autostart
+        self.sent = 0
+        self.failed = 0
+
+        self._pending = {}
+        self._cond = threading.Condition()
+        self._in_flight = False
+        self._closed = False
+        self._thread = None
+        self._connection = None
+
+    # ---------- producer side (request threads) ----------
+
+    def enqueue(self, notices):
+        with self._cond:
+            self._pending.update(notices)
+            self._cond.notify()
+        if not settings.TURN_NOTIFY_IN_BACKGROUND:
+            while self.pending:  # Send right here, in the request (tests, single-threaded servers)
+                self.flush()
+            self._close_connection()
+        elif self.autostart:
+            self._ensure_worker()
+
+    @property
+    def pending(self):
+        with self._cond:
+            return len(self._pending)
+
+    # ---------- consumer side (worker thread) ----------
+
+    def flush(self):
+        """Claims and sends one batch over the shared connection. Returns how many emails went out."""
+        batch_size = self.batch_size or settings.TURN_NOTIFY_BATCH_SIZE
+        with self._cond:
+            if not self._pending:
+                return 0
+            ids = list(self._pending)[:batch_size]
+            batch = {appointment_id: self._pending.pop(appointment_id) for appointment_id in ids}
+            self._in_flight = True
+        try:
+            return self._send(batch)
+        finally:
+            with self._cond:
+                self._in_flight = False
+                self._cond.notify_all()
+
+    def _send(self, batch):
+        now = timezone.now()
+        # One conditional UPDATE claims the batch: a row another worker already
+        # flipped keeps its own timestamp, so reading back `now` finds ours only
+        Appointment.objects.filter(
+            pk__in=list(batch), status='waiting', turn_notified_at__isnull=True, patient_email__gt='',
+        ).update(turn_notified_at=now)
+        appointments = list(
+            Appointment.objects.filter(pk__in=list(batch), turn_notified_at=now).select_related('doctor__user')
+        )
+        if not appointments:
+            return 0
+        claimed = [appointment.id for appointment in appointments]
+        messages = [turn_near_message(appointment, batch[appointment.id]) for appointment in appointments]
+        try:
+            if self._connection is None:
+                self._connection = get_connection()
+                self._connection.open()
+            sent = self._connection.send_messages(messages) or 0
+        except Exception as e:
+            self._close_connection()
+            # Unclaim: the next call_patient finds these patients again
+            Appointment.objects.filter(pk__in=claimed, turn_notified_at=now).update(turn_notified_at=None)
+            self.failed += len(messages)
+            print(f"⚠️ Turn notification error: {e} ({len(messages)} email(s) will be retried)")
+            return 0
+        self.sent += sent
+        return sent
+
+    def drain(self, timeout=5):
+        """Waits until every pending notice is handled (used by tests and at shutdown)."""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while self._pending or self._in_flight:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def close(self, timeout=2):
+        self.drain(timeout)
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._close_connection()
+
+    def _close_connection(self):
+        connection, self._connection = self._connection, None
+        if connection is not None:
+            try:
+                connection.close()
+            except Exception:
+                pass
+
+    def _ensure_worker(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._cond:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="turn-notifier", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._pending and not self._closed:
+                    self._cond.wait(self.idle_close)
+                if self._closed:
+                    return
+                idle = not self._pending
+            if idle:
+                # Nothing for a while: let the SMTP server and the database have their connections back
+                self._close_connection()
+                close_old_connections()
+                continue
+            # Let calls from several rooms land in the same batch
+            time.sleep(self.linger)
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"⚠️ Turn notifier error: {e}")
+            finally:
+                close_old_connections()
+
+
+notifier = TurnNotifier()
+atexit.register(notifier.close)
@@ -0,0 +1,187 @@
+"""
+Pre-rendered, cached token PDFs.
+
+xhtml2pdf costs hundreds of milliseconds of CPU per token, and patients download
+the same ticket again and again. Each appointment version is rendered once:
+right after booking in a background process pool, or on the first download if
+the pool hasn't finished yet. The file is stored on disk as
+`<ticket_id>-<content hash>.pdf`, and the hash doubles as the download's ETag.
+
+A "version" is the rendered HTML. A booking change that shows on the ticket
+(e.g. the doctor's average speed) produces a new hash and a fresh file, and
+writing it deletes the ticket's older versions. Archiving an appointment
+deletes its PDFs too (remove_token_pdfs), so TOKEN_PDF_DIR only holds live
+tickets, one file each.
+
+xhtml2pdf, pypdf and the process pool machinery are imported on first use, not
+at startup: see hospital/warmup.py.
+"""
+import atexit
+import hashlib
+import io
+import os
+import re
+import tempfile
+import threading
+
+from django.conf import settings
+from django.template.loader import get_template
+
+TEMPLATE = 'hospital/pdf_token.html'
+BULK_CHUNK = 50  # tokens per worker job when rendering a whole day
+FILE_NAME = re.compile(r'^(?P<ticket_id>.+)-[0-9a-f]{16}\.pdf$')
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+class PDFRenderError(Exception):
+    pass
+
+
+def render_token_html(appointments):
+    return get_template(TEMPLATE).render({'appointments': appointments})
+
+
+def html_to_pdf(html):
+    """HTML -> PDF bytes. Runs in pool workers, so it must not need Django."""
+    from xhtml2pdf import pisa
+
+    out = io.BytesIO()
+    if pisa.CreatePDF(html, dest=out).err:
+        raise PDFRenderError(html)
+    return out.getvalue()
+
+
+def write_pdf(html, path):
+    """
+    Renders and atomically publishes the file (readers never see half a PDF),
+    then deletes the ticket's older versions.
+    """
+    pdf = html_to_pdf(html)
+    directory = os.path.dirname(path)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    with os.fdopen(fd, 'wb') as tmp:
+        tmp.write(pdf)
+    os.replace(tmp_path, path)
+    ticket_id = FILE_NAME.match(os.path.basename(path))['ticket_id']
+    _remove(directory, {ticket_id}, keep=path)
+    return path
+
+
+def _remove(directory, ticket_ids, keep=None):
+    """Deletes the PDFs of `ticket_ids` in `directory` (except `keep`). Returns how many went."""
+    removed = 0
+    try:
+        entries = list(os.scandir(directory))
+    except FileNotFoundError:
+        return 0
+    for entry in entries:
+        match = FILE_NAME.match(entry.name)
+        if match and match['ticket_id'] in ticket_ids and entry.path != keep:
+            try:
+                os.remove(entry.path)
+                removed += 1
+            except FileNotFoundError:
+                pass  # A concurrent writer got there first
+    return removed
+
+
+def remove_token_pdfs(ticket_ids):
+    """Deletes every cached version of these tickets (e.g. once they are archived)."""
+    ticket_ids = set(ticket_ids)
+    return _remove(settings.TOKEN_PDF_DIR, ticket_ids) if ticket_ids else 0
+
+
+def get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+
+            # 'spawn': forking a multi-threaded server process is unsafe
+            _pool = ProcessPoolExecutor(
+                max_workers=settings.TOKEN_PDF_WORKERS,
+                mp_context=multiprocessing.get_context('spawn'),
+            )
+            # Imported after this module, concurrent.futures is torn down first at
+            # exit; drop the pool while it can still clean up after itself
+            atexit.register(shutdown_pool)
+        return _pool
+
+
+def shutdown_pool():
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.shutdown(cancel_futures=True)
+
+
+def _token_path(appointment, html):
+    digest = hashlib.sha256(html.encode()).hexdigest()[:16]
+    os.makedirs(settings.TOKEN_PDF_DIR, exist_ok=True)
+    return os.path.join(settings.TOKEN_PDF_DIR, f"{appointment.ticket_id}-{digest}.pdf"), digest
+
+
+def prerender_token_pdf(appointment):
+    """
+    Queues the token PDF for rendering in the pool; returns the Future, or None
+    if it is already cached or the pool is disabled (TOKEN_PDF_WORKERS = 0).
+    """
+    if not settings.TOKEN_PDF_WORKERS:
+        return None
+    html = render_token_html([appointment])
+    path, _ = _token_path(appointment, html)
+    if os.path.exists(path):
+        return None
+    pool = get_pool()
+    try:
+        return pool.submit(write_pdf, html, path)
+    except RuntimeError as e:  # BrokenProcessPool (a worker died) or a pool already shut down
+        # The booking has committed: never fail it. The download renders the PDF on demand
+        print(f"⚠️ Token PDF prerender skipped: {e}")
+        _discard_pool(pool)
+        return None
+
+
+def _discard_pool(pool):
+    """Drops a broken pool so the next prerender starts a fresh one."""
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def token_pdf(appointment):
+    """Returns (path, etag) for the appointment's current PDF, rendering it now if needed."""
+    html = render_token_html([appointment])
+    path, digest = _token_path(appointment, html)
+    if not os.path.exists(path):
+        write_pdf(html, path)
+    return path, digest
+
+
+def day_tokens_pdf(appointments):
+    """
+    Renders many tokens (e.g. a whole day for the reception desk) as one PDF.
+    Chunks are rendered in parallel in the pool and merged in order.
+    """
+    from pypdf import PdfWriter
+
+    appointments = list(appointments)
+    chunks = [appointments[i:i + BULK_CHUNK] for i in range(0, len(appointments), BULK_CHUNK)]
+    if settings.TOKEN_PDF_WORKERS:
+        jobs = [get_pool().submit(html_to_pdf, render_token_html(chunk)) for chunk in chunks]
+        parts = (job.result() for job in jobs)
+    else:
+        parts = (html_to_pdf(render_token_html(chunk)) for chunk in chunks)
+
+    writer = PdfWriter()
+    for part in parts:
+        writer.append(io.BytesIO(part))
+    out = io.BytesIO()
+    writer.write(out)
+    return out.getvalue()
@@ -0,0 +1,507 @@
+"""
+Per-doctor queue state shared by all read views.
+
+`patient_live_status`, `public_display`, `doctor_dashboard` and `get_doctors_ajax`
+used to rebuild the same facts from the Appointment table on every hit. Now each
+doctor's queue lives in Django's cache as a QueueState: the state-changing views
+apply their change to it in place, and readers rebuild it lazily from the DB
+only after eviction. Any other write (admin, shell, management commands) is
+caught by the signal handlers at the bottom, which invalidate the doctors it
+touched once it commits.
+
+Consistency comes from a per-doctor version counter (also in the cache). Every
+change bumps it, and a cached state is only trusted when it carries the current
+version. A racing writer or reader therefore causes an extra rebuild at worst,
+never a stale answer.
+"""
+import heapq
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import sync_to_async
+from django.core.cache import cache
+from django.db import transaction
+
+from .models import Appointment, Doctor, DoctorStats
+
+# Bump when the pickled QueueState layout changes so old entries are ignored
+STATE_LAYOUT = 2
+
+
+def _state_key(doctor_id):
+    return f"queue_state:{doctor_id}"
+
+
+def _version_key(doctor_id):
+    return f"queue_version:{doctor_id}"
+
+
+class QueueState:
+    """Current token, ordered waiting tokens and expected speed for one doctor."""
+
+    __slots__ = (
+        'doctor_id', 'version', 'on_duty', 'minutes_per_patient',
+        'current_id', 'current_token', 'current_name',
+        'tokens', 'ids', 'names',
+    )
+
+    def __init__(self, doctor, version, minutes_per_patient=None):
+        self.doctor_id = doctor.id
+        self.version = version
+        self.on_duty = doctor.is_on_duty
+        # DoctorStats.expected_minutes(), as the booking and live-status estimates use
+        self.minutes_per_patient = (
+            float(doctor.avg_consultation_time) if minutes_per_patient is None else minutes_per_patient
+        )
+        self.current_id = None
+        self.current_token = None
+        self.current_name = None
+        # Waiting queue as parallel arrays, sorted by token (compact to pickle)
+        self.tokens = array('I')
+        self.ids = []
+        self.names = []
+
+    # ---------- queries ----------
+
+    @property
+    def total_waiting(self):
+        return len(self.tokens)
+
+    def people_ahead(self, token_number):
+        """Waiting patients with a smaller token: a bisect instead of a COUNT query."""
+        return bisect_left(self.tokens, token_number or 0)
+
+    def waiting(self, limit=None):
+        """Waiting patients in token order, as dicts the templates can read."""
+        count = len(self.tokens) if limit is None else min(limit, len(self.tokens))
+        return [
+            {'id': self.ids[i], 'token_number': self.tokens[i], 'patient_name': self.names[i]}
+            for i in range(count)
+        ]
+
+    @property
+    def drain_minutes(self):
+        """Predicted minutes until this doctor is free: everyone queued, plus whoever is inside."""
+        return (self.total_waiting + (self.current_id is not None)) * self.minutes_per_patient
+
+    @property
+    def current(self):
+        if self.current_id is None:
+            return None
+        return {'id': self.current_id, 'token_number': self.current_token, 'patient_name': self.current_name}
+
+    # ---------- in-place changes ----------
+
+    def add_waiting(self, appointment_id, token_number, patient_name):
+        """Inserts in token order. Already there (a rebuild read the committed row first): no change."""
+        if appointment_id in self.ids or appointment_id == self.current_id:
+            return False
+        token_number = token_number or 0
+        i = bisect_right(self.tokens, token_number)
+        self.tokens.insert(i, token_number)
+        self.ids.insert(i, appointment_id)
+        self.names.insert(i, patient_name)
+        return True
+
+    def remove_waiting(self, appointment_id, token_number):
+        i = bisect_left(self.tokens, token_number or 0)
+        while i < len(self.tokens) and self.tokens[i] == (token_number or 0):
+            if self.ids[i] == appointment_id:
+                del self.tokens[i]
+                del self.ids[i]
+                del self.names[i]
+                return True
+            i += 1
+        return False
+
+    def set_current(self, appointment):
+        if appointment is None:
+            self.current_id = self.current_token = self.current_name = None
+        else:
+            self.current_id = appointment.id
+            self.current_token = appointment.token_number
+            self.current_name = appointment.patient_name
+
+
+# ==========================================
+# VERSIONS
+# ==========================================
+# Besides the per-doctor counter, every change also bumps its department's
+# roster counter and the hospital-wide board counter. Read views turn these
+# into ETags (see views.py), so polling screens get a 304 without any query.
+
+BOARD_VERSION_KEY = "board_version"
+
+
+def _roster_key(department_id):
+    return f"roster_version:{department_id}"
+
+
+def _versions(keys):
+    """Returns {key: version}, creating missing counters."""
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            # Seed from the clock so an evicted counter never reuses an old version
+            cache.add(key, int(time.time() * 1000), timeout=None)
+            versions[key] = cache.get(key)
+    return versions
+
+
+def _bump(key):
+    try:
+        return cache.incr(key)
+    except ValueError:
+        cache.add(key, int(time.time() * 1000), timeout=None)
+        return cache.incr(key)
+
+
+def current_versions(doctor_ids):
+    """Returns {doctor_id: version}, creating missing counters."""
+    keys = {_version_key(doctor_id): doctor_id for doctor_id in doctor_ids}
+    return {keys[key]: version for key, version in _versions(list(keys)).items()}
+
+
+def doctor_version(doctor_id):
+    return current_versions([doctor_id])[doctor_id]
+
+
+def roster_version(department_id):
+    key = _roster_key(department_id)
+    return _versions([key])[key]
+
+
+def board_version():
+    return _versions([BOARD_VERSION_KEY])[BOARD_VERSION_KEY]
+
+
+def bump_version(doctor_id, department_id=None):
+    """Bumps the doctor's counter (returned) and the roster and board counters above it."""
+    if department_id is None:
+        department_id = Doctor.objects.filter(pk=doctor_id).values_list('department_id', flat=True).first()
+    return _bump_versions(doctor_id, department_id)[0]
+
+
+def _bump_versions(doctor_id, department_id):
+    """Returns the new (doctor, roster) versions."""
+    version = _bump(_version_key(doctor_id))
+    roster = _bump(_roster_key(department_id))
+    _bump(BOARD_VERSION_KEY)
+    return version, roster
+
+
+# Appointment -> doctor, so the live-status ETag can be computed without a query
+
+def _appointment_key(appointment_id):
+    return f"appointment_doctor:{appointment_id}"
+
+
+def remember_doctors(appointments):
+    cache.set_many({_appointment_key(a.id): a.doctor_id for a in appointments}, timeout=86400)
+
+
+def doctor_of(appointment_id):
+    """The appointment's doctor id if known to the cache, else None."""
+    return cache.get(_appointment_key(appointment_id))
+
+
+# ==========================================
+# READS
+# ==========================================
+
+def get_queue_state(doctor):
+    return get_queue_states([doctor])[doctor.id]
+
+
+async def aget_queue_state(doctor):
+    return (await aget_queue_states([doctor]))[doctor.id]
+
+
+async def aget_queue_states(doctors):
+    """
+    get_queue_states() for async views. A single hop to the sync thread: the
+    cache lookups and the rare rebuild query run together instead of one hop each.
+    """
+    return await sync_to_async(get_queue_states)(doctors)
+
+
+def get_queue_states(doctors):
+    """
+    Returns {doctor_id: QueueState} for the given Doctor instances.
+    Evicted or outdated states are rebuilt together in a single query.
+    """
+    doctors = list(doctors)
+    if not doctors:
+        return {}
+    versions = current_versions(doctor.id for doctor in doctors)
+    cached = cache.get_many([_state_key(doctor.id) for doctor in doctors], version=STATE_LAYOUT)
+
+    states, stale = {}, []
+    for doctor in doctors:
+        state = cached.get(_state_key(doctor.id))
+        if state is not None and state.version == versions[doctor.id]:
+            states[doctor.id] = state
+        else:
+            stale.append(doctor)
+
+    if stale:
+        rebuilt = _build_states(stale, versions)
+        cache.set_many({_state_key(doctor_id): state for doctor_id, state in rebuilt.items()},
+                       timeout=None, version=STATE_LAYOUT)
+        states.update(rebuilt)
+    return states
+
+
+def _build_states(doctors, versions):
+    minutes = DoctorStats.expected_minutes_many(doctors)
+    states = {doctor.id: QueueState(doctor, versions[doctor.id], minutes[doctor.id]) for doctor in doctors}
+    rows = Appointment.objects.filter(
+        doctor_id__in=states.keys(), status__in=['waiting', 'in_consultation']
+    ).order_by('doctor_id', 'token_number', 'pk').values_list(
+        'doctor_id', 'id', 'token_number', 'patient_name', 'status'
+    )
+    for doctor_id, appointment_id, token_number, patient_name, status in rows:
+        state = states[doctor_id]
+        if status == 'waiting':
+            state.tokens.append(token_number or 0)
+            state.ids.append(appointment_id)
+            state.names.append(patient_name)
+        elif state.current_id is None:
+            state.current_id, state.current_token, state.current_name = appointment_id, token_number, patient_name
+    return states
+
+
+# ==========================================
+# DEPARTMENT INDEX ("any available doctor")
+# ==========================================
+# Booking by department picks the on-duty doctor with the earliest predicted
+# start. Each department keeps a min-heap of its doctors keyed by drain time,
+# cached next to the queue states and versioned by the department's roster
+# counter. _apply() moves the changed doctor in it, so picking a doctor costs
+# O(log n) instead of looking at every queue.
+
+def _index_key(department_id):
+    return f"department_index:{department_id}"
+
+
+class DepartmentIndex:
+    """
+    On-duty doctors of one department by predicted drain time.
+    A moved doctor is pushed again and its old heap entry is skipped lazily.
+    """
+
+    __slots__ = ('version', 'drain', 'heap')
+
+    def __init__(self, version, states=()):
+        self.version = version
+        self.drain = {state.doctor_id: state.drain_minutes for state in states}  # doctor_id -> live key
+        self.heap = [(minutes, doctor_id) for doctor_id, minutes in self.drain.items()]
+        heapq.heapify(self.heap)
+
+    def update(self, doctor_id, minutes):
+        """New drain time for the doctor; None takes it out (off duty)."""
+        if minutes is None:
+            self.drain.pop(doctor_id, None)
+        else:
+            self.drain[doctor_id] = minutes
+            heapq.heappush(self.heap, (minutes, doctor_id))
+        if len(self.heap) > 2 * len(self.drain) + 8:
+            # Mostly dead entries: start over from the live keys
+            self.heap = [(minutes, doctor_id) for doctor_id, minutes in self.drain.items()]
+            heapq.heapify(self.heap)
+
+    def earliest(self):
+        """The doctor id with the shortest predicted wait (lowest id on ties), or None."""
+        heap = self.heap
+        while heap and self.drain.get(heap[0][1]) != heap[0][0]:
+            heapq.heappop(heap)
+        return heap[0][1] if heap else None
+
+
+def earliest_doctor(department_id):
+    """
+    Id of the department's on-duty doctor who is predicted to be free first,
+    or None if nobody is on duty. A rebuild (after eviction or a change this
+    index could not follow) costs one doctor query plus get_queue_states().
+    """
+    version = roster_version(department_id)
+    key = _index_key(department_id)
+    index = cache.get(key, version=STATE_LAYOUT)
+    if index is None or index.version != version:
+        doctors = Doctor.objects.filter(department_id=department_id, is_on_duty=True)
+        index = DepartmentIndex(version, get_queue_states(doctors).values())
+        cache.set(key, index, timeout=None, version=STATE_LAYOUT)
+    return index.earliest()
+
+
+# ==========================================
+# WRITES (call after the DB change is committed)
+# ==========================================
+
+def _apply(doctor, change):
+    """
+    Bumps the doctor's version and applies `change` to the cached state in place,
+    then moves the doctor to its new place in the department index.
+    """
+    version, roster = _bump_versions(doctor.id, doctor.department_id)
+    key = _state_key(doctor.id)
+    state = cache.get(key, version=STATE_LAYOUT)
+    if state is None or state.version != version - 1:
+        # Missing, or someone else changed it concurrently: rebuild on next read
+        cache.delete(key, version=STATE_LAYOUT)
+        cache.delete(_index_key(doctor.department_id), version=STATE_LAYOUT)
+        return
+    change(state)
+    state.version = version
+    state.on_duty = doctor.is_on_duty
+    state.minutes_per_patient = DoctorStats.expected_minutes(doctor)  # Follows new samples and the hour of day
+    cache.set(key, state, timeout=None, version=STATE_LAYOUT)
+    _reindex(doctor, state, roster)
+
+
+def _reindex(doctor, state, roster):
+    index_key = _index_key(doctor.department_id)
+    index = cache.get(index_key, version=STATE_LAYOUT)
+    if index is None or index.version != roster - 1:
+        cache.delete(index_key, version=STATE_LAYOUT)
+        return
+    index.update(doctor.id, state.drain_minutes if doctor.is_on_duty else None)
+    index.version = roster
+    cache.set(index_key, index, timeout=None, version=STATE_LAYOUT)
+
+
+def invalidate(doctor_id, department_id=None):
+    bump_version(doctor_id, department_id)
+    cache.delete(_state_key(doctor_id), version=STATE_LAYOUT)
+
+
+def on_booked(appointment):
+    on_booked_many(appointment.doctor, [appointment])
+
+
+def on_booked_many(doctor, appointments):
+    """A batch of new bookings for one doctor, applied under a single version bump."""
+    def change(state):
+        for appointment in appointments:
+            state.add_waiting(appointment.id, appointment.token_number, appointment.patient_name)
+    _apply(doctor, change)
+    remember_doctors(appointments)
+
+
+def on_reassigned(doctor, moved):
+    """`doctor`'s waiting patients went to colleagues: {colleague: [appointments]} (see rebalance.py)."""
+    if not moved:
+        return
+    invalidate(doctor.id, doctor.department_id)
+    for colleague, appointments in moved.items():
+        on_booked_many(colleague, appointments)
+
+
+def on_called(doctor, appointment):
+    """
+    `appointment` went in; whoever was inside before is now completed. It is
+    always the doctor's own patient: consultation.call_in() claims it by doctor.
+    """
+    def change(state):
+        state.remove_waiting(appointment.id, appointment.token_number)
+        state.set_current(appointment)
+    _apply(doctor, change)
+
+
+def on_completed(appointment):
+    def change(state):
+        if state.current_id == appointment.id:
+            state.set_current(None)
+        else:
+            state.remove_waiting(appointment.id, appointment.token_number)
+    _apply(appointment.doctor, change)
+
+
+def on_duty_changed(doctor):
+    _apply(doctor, lambda state: None)
+
+
+# ==========================================
+# WRITES FROM ANYWHERE ELSE (signal handlers, connected in apps.py)
+# ==========================================
+# An admin cancel or reassignment, a Doctor edit or a save in the shell never
+# passes through the functions above. These handlers invalidate every doctor
+# such a write touched, once it has committed, so the states and ETags move
+# on. The views that already apply their change in place wrap the write in
+# applied_by_caller(), which skips the handlers and keeps the cached state.
+
+LIVE_STATUSES = ('waiting', 'in_consultation')
+
+_applied_by_caller = ContextVar('queue_state_applied_by_caller', default=False)
+
+
+@contextmanager
+def applied_by_caller():
+    token = _applied_by_caller.set(True)
+    try:
+        yield
+    finally:
+        _applied_by_caller.reset(token)
+
+
+def _skip(raw):
+    return raw or _applied_by_caller.get()  # raw: loaddata
+
+
+def _invalidate_on_commit(doctor_ids):
+    doctor_ids = {doctor_id for doctor_id in doctor_ids if doctor_id is not None}
+
+    def run():
+        for doctor_id in doctor_ids:
+            invalidate(doctor_id)
+    transaction.on_commit(run)
+
+
+def appointment_pre_save(sender, instance, raw=False, **kwargs):
+    if _skip(raw) or instance.pk is None:
+        return
+    # Reassigned: the old doctor's queue changes too
+    instance._previous_doctor_id = Appointment.objects.filter(pk=instance.pk).values_list(
+        'doctor_id', flat=True
+    ).first()
+
+
+def appointment_saved(sender, instance, raw=False, **kwargs):
+    if _skip(raw):
+        return
+    _invalidate_on_commit([instance.doctor_id, instance.__dict__.pop('_previous_doctor_id', None)])
+
+
+def appointment_deleted(sender, instance, **kwargs):
+    # Finished rows (the archive job deletes those in batches) aren't in any queue
+    if instance.status in LIVE_STATUSES and not _applied_by_caller.get():
+        _invalidate_on_commit([instance.doctor_id])
+
+
+def doctor_pre_save(sender, instance, raw=False, **kwargs):
+    if _skip(raw) or instance.pk is None:
+        return
+    instance._previous_department_id = Doctor.objects.filter(pk=instance.pk).values_list(
+        'department_id', flat=True
+    ).first()
+
+
+def doctor_saved(sender, instance, raw=False, **kwargs):
+    if _skip(raw):
+        return
+    doctor_id, department_id = instance.pk, instance.department_id
+    previous = instance.__dict__.pop('_previous_department_id', None)
+
+    def run():
+        invalidate(doctor_id, department_id)
+        if previous is not None and previous != department_id:
+            _bump(_roster_key(previous))  # Out of the old department's index
+    transaction.on_commit(run)
+
+
+def doctor_deleted(sender, instance, **kwargs):
+    doctor_id, department_id = instance.pk, instance.department_id
+    transaction.on_commit(lambda: invalidate(doctor_id, department_id))
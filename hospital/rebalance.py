@@ -0,0 +1,87 @@
+"""
+Queue rebalancing when a doctor goes off duty.
+
+Without this, an off-duty doctor's waiting patients stay in that queue while
+department colleagues sit idle. rebalance_off_duty() hands them to the on-duty
+doctors of the same department. Each patient, in queue order, goes to whichever
+doctor is predicted to be free first: a min-heap keyed on predicted free time,
+so O(P log D) for P patients and D doctors. Each receiving doctor reserves one
+token range and everything is written in one transaction. Patients keep
+their relative order: they join the end of their new queue in the order they had.
+"""
+import heapq
+from collections import defaultdict
+from datetime import timedelta
+
+from django.db import transaction
+from django.utils import timezone
+
+from .models import Appointment, AppointmentEvent, Doctor, TokenCounter
+from .queue_state import get_queue_states
+
+
+def plan(patients, doctors):
+    """
+    Spreads `patients` (in queue order) over `doctors`, given as
+    (free_in_minutes, minutes_per_patient, doctor_id) tuples.
+    Returns [(patient, doctor_id, starts_in_minutes), ...] in patient order.
+    """
+    # The index breaks ties deterministically (and keeps ids out of comparisons)
+    heap = [(free_in, index, minutes, doctor_id) for index, (free_in, minutes, doctor_id) in enumerate(doctors)]
+    heapq.heapify(heap)
+    assignments = []
+    for patient in patients:
+        free_in, index, minutes, doctor_id = heap[0]
+        assignments.append((patient, doctor_id, free_in))
+        heapq.heapreplace(heap, (free_in + minutes, index, minutes, doctor_id))
+    return assignments
+
+
+def rebalance_off_duty(doctor, now=None):
+    """
+    Moves the doctor's waiting patients to on-duty colleagues in the same
+    department. Returns {colleague: [moved appointments in token order]}; empty
+    when there is no one to move or nobody to take them. The caller passes
+    that to queue_state.on_reassigned() once the transaction has committed.
+    """
+    now = now or timezone.now()
+    colleagues = list(Doctor.objects.filter(
+        department_id=doctor.department_id, is_on_duty=True
+    ).exclude(pk=doctor.pk).select_related('user'))
+    if not colleagues:
+        return {}
+
+    states = get_queue_states(colleagues)
+    by_id = {colleague.id: colleague for colleague in colleagues}
+    doctors = [
+        (states[c.id].drain_minutes, states[c.id].minutes_per_patient, c.id)
+        for c in colleagues
+    ]
+
+    moved = defaultdict(list)
+    with transaction.atomic():
+        patients = list(Appointment.objects.select_for_update().filter(
+            doctor=doctor, status='waiting'
+        ).order_by('token_number', 'pk'))
+        if not patients:
+            return {}
+
+        for patient, doctor_id, starts_in in plan(patients, doctors):
+            patient.doctor = by_id[doctor_id]
+            patient.estimated_start_time = now + timedelta(minutes=starts_in)
+            moved[patient.doctor].append(patient)
+
+        # One token range per receiving doctor, handed out in the old queue order
+        for colleague, batch in moved.items():
+            first_token = TokenCounter.allocate(colleague, count=len(batch))
+            for offset, patient in enumerate(batch):
+                patient.token_number = first_token + offset
+
+        Appointment.objects.bulk_update(
+            patients, ['doctor', 'token_number', 'estimated_start_time'], batch_size=500
+        )
+        AppointmentEvent.objects.bulk_create(
+            [AppointmentEvent.for_appointment(patient, 'reassigned', now) for patient in patients]
+        )
+
+    return dict(moved)
@@ -0,0 +1,278 @@
+"""
+Offline queue simulator: replays appointment history through what-if policies.
+
+Every finished visit has booked_at, actual_start_time and actual_end_time.
+That is enough to replay a date range through a different estimation policy
+(how long will the next consultation take?) or assignment policy (which doctor
+gets the patient?) and measure the result. The outputs are wait-estimate
+errors, consultation-length errors, patient waits and doctor utilization.
+
+Each patient keeps their real consultation length and arrival time. Each
+doctor opens at their first real start of the day and works their queue in
+token order. Arrivals are walked in order and completions come off a heap,
+so a run is O(N log N) in the number of visits: a year for 100 doctors
+replays in seconds.
+"""
+import heapq
+import math
+from collections import defaultdict, deque, namedtuple
+from datetime import datetime, time
+
+from django.utils import timezone
+
+from .models import Appointment, ArchivedAppointment, DoctorStats
+
+# Times are minutes since the first arrival; `midnight` is the visit day's local midnight
+Visit = namedtuple('Visit', 'arrival doctor_id department_id day midnight service actual_start estimated_start')
+
+
+def load_history(start, end):
+    """
+    Completed visits booked between `start` and `end` (dates, inclusive), live
+    and archived, as (visits sorted by arrival, {(doctor_id, day): opens_at}).
+    """
+    rows = []
+    for model in (Appointment, ArchivedAppointment):
+        rows.extend(model.objects.filter(
+            status='completed', booked_date__range=(start, end),
+            actual_start_time__isnull=False, actual_end_time__isnull=False,
+        ).values_list(
+            'booked_at', 'doctor_id', 'doctor__department_id', 'booked_date',
+            'actual_start_time', 'actual_end_time', 'estimated_start_time',
+        ).iterator(chunk_size=5000))
+    if not rows:
+        return [], {}
+    rows.sort(key=lambda row: row[0])
+
+    origin = rows[0][0]
+    midnights = {}
+
+    def minutes(moment):
+        return (moment - origin).total_seconds() / 60
+
+    visits, shifts = [], {}
+    for booked_at, doctor_id, department_id, day, started, ended, estimated in rows:
+        if day not in midnights:
+            midnights[day] = minutes(timezone.make_aware(datetime.combine(day, time.min)))
+        started_at = minutes(started)
+        visits.append(Visit(
+            minutes(booked_at), doctor_id, department_id, day, midnights[day],
+            max((ended - started).total_seconds() / 60, 0.0), started_at,
+            minutes(estimated) if estimated else None,
+        ))
+        key = (doctor_id, day)
+        shifts[key] = min(shifts.get(key, started_at), started_at)
+    return visits, shifts
+
+
+# ==========================================
+# ESTIMATION POLICIES
+# ==========================================
+# predict() is the consultation length the app would assume for the doctor's
+# next patient; observe() feeds it each finished consultation, like a completion does.
+
+class EWMAEstimator:
+    """Doctor.update_average_time: 70% history, 30% latest; whole minutes clipped to 5-45."""
+
+    def __init__(self, initial=15):
+        self.ewma = defaultdict(lambda: float(initial))
+
+    def predict(self, doctor_id, hour):
+        return max(5, min(45, math.ceil(self.ewma[doctor_id])))
+
+    def observe(self, doctor_id, hour, minutes):
+        if minutes < 1:
+            return  # Ignored by the app as an accidental click
+        self.ewma[doctor_id] = self.ewma[doctor_id] * 0.7 + min(minutes, DoctorStats.MAX_SAMPLE) * 0.3
+
+
+class HourlyEstimator(EWMAEstimator):
+    """DoctorStats.expected_minutes: the hour-of-day average once sampled enough, else the raw EWMA."""
+
+    def __init__(self, initial=15):
+        super().__init__(initial)
+        self.hours = defaultdict(lambda: [0, 0.0])  # (doctor_id, hour) -> [count, total]
+
+    def predict(self, doctor_id, hour):
+        count, total = self.hours[doctor_id, hour]
+        if count >= DoctorStats.MIN_HOUR_SAMPLES:
+            return total / count
+        return self.ewma[doctor_id]
+
+    def observe(self, doctor_id, hour, minutes):
+        if minutes < 1:
+            return
+        super().observe(doctor_id, hour, minutes)
+        bucket = self.hours[doctor_id, hour]
+        bucket[0] += 1
+        bucket[1] += min(minutes, DoctorStats.MAX_SAMPLE)
+
+
+class MeanEstimator:
+    """Plain running mean of every consultation so far."""
+
+    def __init__(self, initial=15):
+        self.initial = initial
+        self.totals = defaultdict(lambda: [0, 0.0])
+
+    def predict(self, doctor_id, hour):
+        count, total = self.totals[doctor_id]
+        return total / count if count else self.initial
+
+    def observe(self, doctor_id, hour, minutes):
+        if minutes < 1:
+            return
+        entry = self.totals[doctor_id]
+        entry[0] += 1
+        entry[1] += min(minutes, DoctorStats.MAX_SAMPLE)
+
+
+class FixedEstimator:
+    """Baseline: the default 15 minutes for everyone, never learning."""
+
+    def __init__(self, initial=15):
+        self.initial = initial
+
+    def predict(self, doctor_id, hour):
+        return self.initial
+
+    def observe(self, doctor_id, hour, minutes):
+        pass
+
+
+ESTIMATORS = {
+    'ewma': EWMAEstimator,
+    'hourly': HourlyEstimator,
+    'mean': MeanEstimator,
+    'fixed': FixedEstimator,
+}
+
+
+# ==========================================
+# ASSIGNMENT POLICIES
+# ==========================================
+# Called on arrival with the doctors of the visit's department working that
+# day (ascending ids) and quote(doctor_id), the start time the app would quote.
+
+def as_booked(visit, candidates, quote):
+    """Whoever the patient really saw."""
+    return visit.doctor_id
+
+
+def earliest_start(visit, candidates, quote):
+    """The "any available doctor" booking: earliest quoted start, lowest id on ties."""
+    return min(candidates, key=quote)
+
+
+ASSIGNMENTS = {
+    'as-booked': as_booked,
+    'earliest': earliest_start,
+}
+
+
+# ==========================================
+# REPLAY
+# ==========================================
+
+class _Room:
+    __slots__ = ('queue', 'current', 'started', 'waiting_for_shift')
+
+    def __init__(self):
+        self.queue = deque()        # (visit, quoted start), in token order
+        self.current = None         # The visit being seen
+        self.started = 0.0
+        self.waiting_for_shift = False
+
+
+def replay(visits, shifts, estimator, assign=as_booked):
+    """
+    Runs the visits through the policies. Returns a dict of raw samples:
+    waits, start_errors (quoted minus simulated start), duration_errors
+    (predicted minus real length) and utilization per doctor (busy / open time).
+    """
+    rooms = {doctor_id: _Room() for doctor_id, _ in shifts}
+    candidates = defaultdict(list)  # (department_id, day) -> doctor ids working that day
+    departments = {visit.doctor_id: visit.department_id for visit in visits}
+    for doctor_id, day in sorted(shifts):
+        candidates[departments[doctor_id], day].append(doctor_id)
+
+    predict, observe = estimator.predict, estimator.observe
+    push, pop = heapq.heappush, heapq.heappop
+    waits, start_errors, duration_errors = [], [], []
+    busy = dict.fromkeys(rooms, 0.0)
+    closes = {}                 # (doctor_id, day) -> last finish
+    events, order = [], 0       # Heap of (time, order, doctor_id); order keeps it FIFO on ties
+    now = arrival_hour = 0      # Of the patient being booked, read by quote()
+
+    def quote(doctor_id):
+        # What the check-in view would say: what is left of the current patient, then everyone waiting
+        room = rooms[doctor_id]
+        if room.current is None:
+            return now + len(room.queue) * predict(doctor_id, arrival_hour) if room.queue else now
+        minutes = predict(doctor_id, arrival_hour)
+        return now + max(minutes - (now - room.started), 0) + len(room.queue) * minutes
+
+    def start_next(doctor_id, at):
+        nonlocal order
+        room = rooms[doctor_id]
+        if room.current is not None or room.waiting_for_shift or not room.queue:
+            return
+        visit, quoted = room.queue[0]
+        opens = shifts[doctor_id, visit.day]
+        if opens > at:
+            room.waiting_for_shift = True
+            push(events, (opens, order, doctor_id))
+        else:
+            room.queue.popleft()
+            room.current, room.started = visit, at
+            waits.append(at - visit.arrival)
+            start_errors.append(quoted - at)
+            duration_errors.append(predict(doctor_id, int((at - visit.midnight) // 60) % 24) - visit.service)
+            push(events, (at + visit.service, order, doctor_id))
+        order += 1
+
+    def advance(until):
+        while events and events[0][0] <= until:
+            at, _, doctor_id = pop(events)
+            room = rooms[doctor_id]
+            if room.waiting_for_shift:
+                room.waiting_for_shift = False
+            else:
+                visit = room.current
+                observe(doctor_id, int((at - visit.midnight) // 60) % 24, visit.service)
+                busy[doctor_id] += visit.service
+                closes[doctor_id, visit.day] = at
+                room.current = None
+            start_next(doctor_id, at)
+
+    for visit in visits:
+        now = visit.arrival
+        advance(now)  # Everything that happens before this patient walks in
+        arrival_hour = int((now - visit.midnight) // 60) % 24
+        doctor_id = assign(visit, candidates[visit.department_id, visit.day], quote)
+        rooms[doctor_id].queue.append((visit, quote(doctor_id)))
+        start_next(doctor_id, now)
+    advance(math.inf)
+
+    open_minutes = defaultdict(float)
+    for (doctor_id, day), closed in closes.items():
+        open_minutes[doctor_id] += closed - shifts[doctor_id, day]
+    utilization = {
+        doctor_id: busy[doctor_id] / minutes if minutes > 0 else None
+        for doctor_id, minutes in open_minutes.items()
+    }
+    return {
+        'waits': waits,
+        'start_errors': start_errors,
+        'duration_errors': duration_errors,
+        'utilization': utilization,
+    }
+
+
+def observed(visits):
+    """What really happened: the waits and the recorded estimates' errors, as replay() reports them."""
+    return {
+        'waits': [visit.actual_start - visit.arrival for visit in visits],
+        'start_errors': [visit.estimated_start - visit.actual_start
+                         for visit in visits if visit.estimated_start is not None],
+    }
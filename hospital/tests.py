@@ -1,3 +1,1694 @@
-from django.test import TestCase
+import asyncio
+import csv
+import gzip
+import io
+import json
+import os
+import re
+import tempfile
+import threading
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, time, timedelta
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib import admin
+from django.contrib.auth.models import User
+from django.core.handlers.asgi import ASGIHandler
+from django.core import mail
+from django.core.cache import cache, caches
+from django.core.management import call_command
+from django.core.signals import request_finished
+from django.forms import modelform_factory
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings, skipUnlessDBFeature
+from django.test.utils import CaptureQueriesContext
+from django.db import OperationalError, connection, connections
+from django.http import HttpResponse
+from django.urls import reverse
+from django.utils import timezone
+
+from . import admission, analytics, events, export, firebase, metrics, notify
+from .events import EventBroker, sse_application
+from .firebase import FirebaseOutbox
+from .firebase_stub import FirebaseStub
+from .models import (
+    Appointment, AppointmentEvent, ArchivedAppointment, Department, DepartmentRollup, Doctor, DoctorRollup, DoctorStats,
+    RollupCheckpoint, TokenCounter,
+)
+from . import queue_state
+from .admin import AppointmentAdmin
+from .queue_state import get_queue_state, get_queue_states
+from .estimation import reestimate_queue
+from . import pdf
+from .archive import archive_appointments, archive_cutoff
+from . import rebalance, simulation, warmup
+from .management.commands import benchmark, startup_benchmark
+
+
+def make_doctor(username, department=None, on_duty=True, **kwargs):
+    """Creates a doctor (and its login) for tests."""
+    department = department or Department.objects.create(name="General Medicine")
+    user = User.objects.create_user(username=username, password="pass", first_name=username.title())
+    return Doctor.objects.create(user=user, department=department, is_on_duty=on_duty, **kwargs)
+
+
+@override_settings(TOKEN_PDF_WORKERS=0, ADMISSION_LANES={}, TURN_NOTIFY_IN_BACKGROUND=False)
+class HospitalTestCase(TestCase):
+    """Clears the caches so state never leaks between tests; no PDF pool, no rate limits, emails sent inline."""
+
+    def setUp(self):
+        cache.clear()
+        caches['admission'].clear()
+
+
+class TokenCounterTests(TestCase):
+    def setUp(self):
+        self.doctor = make_doctor("house")
+
+    def test_tokens_are_sequential_per_doctor(self):
+        other = make_doctor("wilson", department=self.doctor.department)
+        self.assertEqual([TokenCounter.allocate(self.doctor) for _ in range(3)], [1, 2, 3])
+        self.assertEqual(TokenCounter.allocate(other), 1)
+
+    def test_each_day_starts_from_one(self):
+        yesterday = timezone.localdate() - timedelta(days=1)
+        TokenCounter.allocate(self.doctor, day=yesterday)
+        TokenCounter.allocate(self.doctor, day=yesterday)
+        self.assertEqual(TokenCounter.allocate(self.doctor), 1)
+
+    def test_range_reservation_returns_first_token(self):
+        self.assertEqual(TokenCounter.allocate(self.doctor, count=5), 1)
+        self.assertEqual(TokenCounter.allocate(self.doctor), 6)
+
+    def test_seeds_from_tokens_issued_before_the_counter_existed(self):
+        Appointment.objects.create(patient_name="Early", doctor=self.doctor, token_number=7)
+        self.assertEqual(TokenCounter.allocate(self.doctor), 8)
+
+
+@mock.patch('hospital.views.update_firebase')
+class PatientCheckInTests(HospitalTestCase):
+    def setUp(self):
+        super().setUp()
+        self.doctor = make_doctor("house")
+
+    def book(self, name):
+        return self.client.post(reverse('patient_check_in'), {
+            'patient_name': name,
+            'patient_email': f"{name.lower()}@example.com",
+            'doctor': self.doctor.id,
+        })
+
+    def test_bookings_get_unique_tokens(self, update_firebase):
+        for name in ("Ann", "Ben", "Cat"):
+            self.assertEqual(self.book(name).status_code, 302)
+        tokens = list(Appointment.objects.order_by('id').values_list('token_number', flat=True))
+        self.assertEqual(tokens, [1, 2, 3])
+
+    def test_firebase_sees_committed_token(self, update_firebase):
+        self.book("Ann")
+        update_firebase.assert_called_once_with(self.doctor.id, 0, "Live", "House", update_last_issued=1)
+
+
+@mock.patch('hospital.views.update_firebase')
+class AnyDoctorBookingTests(HospitalTestCase):
+    def setUp(self):
+        super().setUp()
+        self.fast = make_doctor("wilson", avg_consultation_time=5)
+        self.department = self.fast.department
+        self.slow = make_doctor("cuddy", department=self.department, avg_consultation_time=10)
+        make_doctor("grey")  # Other department: never picked
+
+    def book(self, name):
+        return self.client.post(reverse('patient_check_in'), {
+            'patient_name': name,
+            'patient_email': f"{name.lower()}@example.com",
+            'department': self.department.id,
+        })
+
+    def booked_doctors(self):
+        return list(Appointment.objects.order_by('id').values_list('doctor__user__username', flat=True))
+
+    def test_routes_each_booking_to_the_earliest_predicted_start(self, update_firebase):
+        for name in ("Ann", "Ben", "Cat", "Dan"):
+            self.assertEqual(self.book(name).status_code, 302)
+        # Drain times: 0/0 (tie: lowest id), 5/0, 5/10, 10/10
+        self.assertEqual(self.booked_doctors(), ["wilson", "cuddy", "wilson", "wilson"])
+
+    def test_index_follows_calls_without_a_rebuild(self, update_firebase):
+        for name in ("Ann", "Ben", "Cat"):
+            self.book(name)
+        ann = Appointment.objects.get(patient_name="Ann")
+        self.client.force_login(self.fast.user)
+        self.client.get(reverse('call_patient', args=[ann.id]))
+        self.client.get(reverse('complete_appointment', args=[ann.id]))
+        with self.assertNumQueries(0):
+            # Wilson: Cat waiting (5); Cuddy: Ben waiting (10)
+            self.assertEqual(queue_state.earliest_doctor(self.department.id), self.fast.id)
+
+    def test_off_duty_doctors_are_never_picked(self, update_firebase):
+        self.client.force_login(self.fast.user)
+        self.client.post(reverse('toggle_duty'))
+        self.book("Ann")
+        self.assertEqual(self.booked_doctors(), ["cuddy"])
+
+        Doctor.objects.filter(pk=self.slow.pk).update(is_on_duty=False)  # Behind the index's back
+        response = self.book("Ben")
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, "No doctors are currently on duty")
+        self.assertEqual(Appointment.objects.count(), 1)
+
+
+@mock.patch('hospital.views.update_firebase')
+class BulkCheckInTests(HospitalTestCase):
+    def setUp(self):
+        super().setUp()
+        self.house = make_doctor("house")
+        self.wilson = make_doctor("wilson", department=self.house.department)
+        self.client.force_login(self.house.user)
+
+    def post(self, bookings):
+        return self.client.post(
+            reverse('bulk_check_in'), json.dumps({'bookings': bookings}), content_type='application/json'
+        )
+
+    def rows(self, count, doctor):
+        return [{'patient_name': f"P{i}", 'patient_email': f"p{i}@example.com", 'doctor': doctor.id}
+                for i in range(count)]
+
+    def test_each_doctor_gets_a_contiguous_token_range(self, update_firebase):
+        Appointment.objects.create(patient_name="Early", doctor=self.house, token_number=1)
+        response = self.post(self.rows(3, self.house) + self.rows(2, self.wilson))
+        self.assertEqual(response.status_code, 201)
+
+        tickets = response.json()['tickets']
+        self.assertEqual([t['token_number'] for t in tickets], [2, 3, 4, 1, 2])
+        self.assertEqual(len({t['ticket_id'] for t in tickets}), 5)
+        self.assertEqual(Appointment.objects.filter(ticket_id__in=[t['ticket_id'] for t in tickets]).count(), 5)
+        self.assertEqual(get_queue_state(self.house).total_waiting, 4)
+        update_firebase.assert_any_call(self.house.id, 0, "Live", "House", update_last_issued=4)
+
+    def test_one_bad_row_rejects_the_whole_batch(self, update_firebase):
+        rows = self.rows(3, self.house)
+        rows[1]['patient_email'] = "not-an-email"
+        rows[2]['doctor'] = 999999
+        response = self.post(rows)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(set(response.json()['errors']), {'1', '2'})
+        self.assertFalse(Appointment.objects.exists())
+
+    def test_query_count_does_not_grow_with_batch_size(self, update_firebase):
+        self.post(self.rows(1, self.house))  # Counter row and queue state now exist
+        with CaptureQueriesContext(connection) as small:
+            self.assertEqual(self.post(self.rows(5, self.house)).status_code, 201)
+        with CaptureQueriesContext(connection) as large:
+            self.assertEqual(self.post(self.rows(60, self.house)).status_code, 201)
+        self.assertEqual(len(large), len(small))
+
+    def test_requires_login(self, update_firebase):
+        self.client.logout()
+        self.assertEqual(self.post(self.rows(1, self.house)).status_code, 302)
+
+
+class FirebaseOutboxTests(SimpleTestCase):
+    def setUp(self):
+        self.stub = FirebaseStub().start()
+        self.addCleanup(self.stub.stop)
+
+    def make_outbox(self, **kwargs):
+        kwargs.setdefault('backoff', 0.01)
+        return FirebaseOutbox(base_url=self.stub.url, autostart=False, **kwargs)
+
+    def test_updates_coalesce_into_one_multi_path_patch(self):
+        outbox = self.make_outbox()
+        outbox.enqueue(1, {'status': 'Live', 'current_token': 3})
+        outbox.enqueue(2, {'status': 'Live'})
+        outbox.enqueue(1, {'current_token': 4})
+        self.assertTrue(outbox.flush())
+
+        self.assertEqual(len(self.stub.requests), 1)
+        method, path, body = self.stub.requests[0]
+        self.assertEqual((method, path), ('PATCH', '/'))
+        self.assertEqual(body, {
+            'doctors/1/status': 'Live',
+            'doctors/1/current_token': 4,
+            'doctors/2/status': 'Live',
+        })
+        self.assertEqual(self.stub.get('doctors/1'), {'status': 'Live', 'current_token': 4})
+
+    def test_retries_with_backoff_until_delivered(self):
+        self.stub.fail_first = 2
+        outbox = self.make_outbox()
+        outbox.enqueue(1, {'current_token': 5})
+        self.assertTrue(outbox.flush())
+        self.assertEqual(len(self.stub.requests), 3)
+        self.assertEqual(self.stub.get('doctors/1/current_token'), 5)
+
+    def test_failed_batch_never_overwrites_newer_updates(self):
+        self.stub.fail_first = 1
+        outbox = self.make_outbox(max_retries=0)
+        outbox.enqueue(1, {'current_token': 5, 'status': 'Live'})
+        self.assertFalse(outbox.flush())
+        outbox.enqueue(1, {'current_token': 6})
+        self.assertTrue(outbox.flush())
+        self.assertEqual(self.stub.get('doctors/1'), {'current_token': 6, 'status': 'Live'})
+
+    def test_queue_is_bounded_by_doctor_count(self):
+        outbox = self.make_outbox(max_doctors=2)
+        self.assertTrue(outbox.enqueue(1, {'status': 'Live'}))
+        self.assertTrue(outbox.enqueue(2, {'status': 'Live'}))
+        self.assertTrue(outbox.enqueue(1, {'status': 'Offline'}))
+        self.assertFalse(outbox.enqueue(3, {'status': 'Live'}))
+        self.assertEqual(outbox.dropped, 1)
+
+    def test_background_worker_flushes_in_order(self):
+        outbox = FirebaseOutbox(base_url=self.stub.url, linger=0)
+        outbox.enqueue(1, {'current_token': 1})
+        self.assertTrue(outbox.drain())
+        outbox.enqueue(1, {'current_token': 2})
+        self.assertTrue(outbox.drain())
+        outbox.close()
+        tokens = [body['doctors/1/current_token'] for _, _, body in self.stub.requests]
+        self.assertEqual(tokens, [1, 2])
+
+
+class PublicDisplayTests(HospitalTestCase):
+    def make_board(self, doctor_count, waiting_per_doctor=5):
+        """Bulk-creates on-duty doctors, each with one patient inside and a waiting queue."""
+        department = Department.objects.create(name="Cardiology")
+        users = User.objects.bulk_create(
+            User(username=f"doc{department.id}-{i}", first_name=f"Doc{i}") for i in range(doctor_count)
+        )
+        doctors = Doctor.objects.bulk_create(
+            Doctor(user=user, department=department, is_on_duty=True) for user in users
+        )
+        Appointment.objects.bulk_create(
+            Appointment(
+                patient_name=f"P{doctor.id}-{token}", doctor=doctor, token_number=token,
+                ticket_id=f"T{doctor.id}-{token}",
+                status='in_consultation' if token == 1 else 'waiting',
+            )
+            for doctor in doctors for token in range(1, waiting_per_doctor + 2)
+        )
+        return doctors
+
+    def count_queries(self):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(reverse('public_display'))
+        self.assertEqual(response.status_code, 200)
+        return len(ctx.captured_queries), response
+
+    def test_query_count_is_flat_from_1_to_200_doctors(self):
+        self.make_board(1)
+        small, _ = self.count_queries()
+        self.make_board(199)
+        large, response = self.count_queries()
+        self.assertEqual(small, large)
+        self.assertEqual(len(response.context['doctors']), 200)
+
+        warm, _ = self.count_queries()
+        self.assertEqual(warm, 1)  # Queues now served from the cache
+
+    def test_board_shows_current_patient_and_next_three(self):
+        doctor = self.make_board(1)[0]
+        Doctor.objects.create(
+            user=User.objects.create(username="idle"), department=doctor.department, is_on_duty=True
+        )
+        _, response = self.count_queries()
+        busy, idle = sorted(response.context['doctors'], key=lambda item: item['doctor'].id)
+
+        self.assertEqual(busy['current_token'], 1)
+        self.assertEqual(busy['current_name'], f"P{doctor.id}-1")
+        self.assertEqual([p['token_number'] for p in busy['waiting']], [2, 3, 4])
+        self.assertEqual(busy['total_waiting'], 5)
+        self.assertEqual((idle['current_token'], idle['current_name']), ("--", "Available"))
+        self.assertEqual((list(idle['waiting']), idle['total_waiting']), ([], 0))
+
+
+class EventBrokerTests(SimpleTestCase):
+    async def test_subscribers_only_see_their_doctor(self):
+        broker = EventBroker()
+        everything, mine = broker.subscribe(), broker.subscribe(doctor_id=2)
+        broker.publish('booked', {'doctor_id': 1})
+        broker.publish('called', {'doctor_id': 2})
+        await asyncio.sleep(0)
+
+        self.assertEqual([everything.queue.get_nowait()['type'] for _ in range(2)], ['booked', 'called'])
+        self.assertEqual(mine.queue.qsize(), 1)
+        self.assertEqual(mine.queue.get_nowait()['data'], {'doctor_id': 2})
+
+    async def test_slow_subscriber_is_told_to_resync(self):
+        broker = EventBroker(max_backlog=2)
+        screen = broker.subscribe()
+        for token in range(3):
+            broker.publish('booked', {'doctor_id': 1, 'token': token})
+        await asyncio.sleep(0)
+        self.assertEqual(screen.queue.qsize(), 1)
+        self.assertEqual(screen.queue.get_nowait()['type'], 'resync')
+
+    async def test_sse_stream_delivers_events_until_disconnect(self):
+        sent, disconnect = [], asyncio.Event()
+
+        async def receive():
+            await disconnect.wait()
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            sent.append(message)
+
+        scope = {'type': 'http', 'method': 'GET', 'path': '/events/', 'query_string': b'doctor=7'}
+        stream = asyncio.create_task(sse_application(scope, receive, send))
+        while events.broker.subscriber_count == 0:
+            await asyncio.sleep(0)
+        events.publish('called', {'doctor_id': 7, 'current_token': 4})
+        events.publish('called', {'doctor_id': 8, 'current_token': 9})
+        while len(sent) < 3:
+            await asyncio.sleep(0.01)
+        disconnect.set()
+        await asyncio.wait_for(stream, timeout=1)
+
+        self.assertEqual(sent[0]['status'], 200)
+        self.assertIn((b'content-type', b'text/event-stream'), sent[0]['headers'])
+        body = b''.join(m.get('body', b'') for m in sent[1:])
+        self.assertIn(b'event: called\ndata: {"doctor_id": 7, "current_token": 4}', body)
+        self.assertNotIn(b'"doctor_id": 8', body)
+        self.assertEqual(events.broker.subscriber_count, 0)
+
+
+@mock.patch('hospital.views.update_firebase')
+@mock.patch.object(events.EventBroker, 'subscriber_count', new_callable=mock.PropertyMock, return_value=1)
+@mock.patch('hospital.views.events.publish')
+class QueueEventPublishingTests(HospitalTestCase):
+    def setUp(self):
+        super().setUp()
+        self.doctor = make_doctor("house")
+        self.client.login(username="house", password="pass")
+
+    def test_call_publishes_the_doctors_new_card(self, publish, *mocks):
+        first = Appointment.objects.create(patient_name="Ann", doctor=self.doctor, token_number=1)
+        Appointment.objects.create(patient_name="Ben", doctor=self.doctor, token_number=2)
+        self.client.get(reverse('call_patient', args=[first.id]))
+
+        event_type, data = publish.call_args.args
+        self.assertEqual(event_type, 'called')
+        self.assertEqual(data['current_token'], 1)
+        self.assertEqual(data['waiting'], [{'token': 2, 'name': "Ben"}])
+        self.assertEqual(data['total_waiting'], 1)
+        self.assertEqual(data['appointment']['status'], 'in_consultation')
+
+    def test_duty_toggle_publishes(self, publish, *mocks):
+        self.client.get(reverse('toggle_duty'))
+        event_type, data = publish.call_args.args
+        self.assertEqual((event_type, data['doctor_id'], data['on_duty']), ('duty', self.doctor.id, False))
+
+
+@mock.patch('hospital.views.update_firebase')
+class QueueStateTests(HospitalTestCase):
+    def setUp(self):
+        super().setUp()
+        self.doctor = make_doctor("house")
+        self.client.login(username="house", password="pass")
+        self.first = self.book("Ann", 1)
+        self.second = self.book("Ben", 2)
+
+    def book(self, name, token):
+        return Appointment.objects.create(patient_name=name, doctor=self.doctor, token_number=token)
+
+    def snapshot(self, state):
+        return (state.current, state.waiting(), state.total_waiting)
+
+    def assertMatchesDatabase(self):
+        cached = get_queue_state(self.doctor)
+        queue_state.invalidate(self.doctor.id)
+        rebuilt = get_queue_state(self.doctor)
+        self.assertEqual(self.snapshot(cached), self.snapshot(rebuilt))
+
+    def test_booking_seen_by_a_rebuild_is_not_added_twice(self, update_firebase):
+        get_queue_state(self.doctor)
+        third = self.book("Cat", 3)
+        # A reader rebuilds after the booking commits but before on_booked() bumps the version
+        queue_state.invalidate(self.doctor.id)
+        self.assertEqual(get_queue_state(self.doctor).ids, [self.first.id, self.second.id, third.id])
+        queue_state.on_booked(third)
+        self.assertEqual(get_queue_state(self.doctor).ids, [self.first.id, self.second.id, third.id])
+        self.assertMatchesDatabase()
+
+    def test_writes_outside_the_views_invalidate_after_commit(self, update_firebase):
+        colleague = make_doctor("wilson", department=self.doctor.department)
+        get_queue_states([self.doctor, colleague])
+        version = queue_state.doctor_version(self.doctor.id)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.first.status = 'cancelled'  # An admin cancel
+            self.first.save()
+            self.assertEqual(queue_state.doctor_version(self.doctor.id), version)  # Not before the commit
+        self.assertNotEqual(queue_state.doctor_version(self.doctor.id), version)
+        self.assertEqual(get_queue_state(self.doctor).total_waiting, 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.second.doctor = colleague  # An admin reassignment: both queues change
+            self.second.save()
+        self.assertEqual(get_queue_state(self.doctor).total_waiting, 0)
+        self.assertEqual(get_queue_state(colleague).waiting()[0]['id'], self.second.id)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.second.delete()
+        self.assertEqual(get_queue_state(colleague).total_waiting, 0)
+
+    def test_doctor_edits_reach_the_department_index(self, update_firebase):
+        self.assertEqual(queue_state.earliest_doctor(self.doctor.department_id), self.doctor.id)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.doctor.is_on_duty = False
+            self.doctor.save()
+        self.assertIsNone(queue_state.earliest_doctor(self.doctor.department_id))
+        self.assertFalse(get_queue_state(self.doctor).on_duty)
+
+    def test_check_in_keeps_its_in_place_update(self, update_firebase):
+        get_queue_state(self.doctor)
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            self.client.post(reverse('patient_check_in'), {
+                'patient_name': "Cat", 'patient_email': "cat@example.com", 'doctor': self.doctor.id,
+            })
+        self.assertEqual(callbacks, [])
+        with self.assertNumQueries(0):
+            self.assertEqual(get_queue_state(self.doctor).total_waiting, 3)
+
+    def test_people_ahead_uses_bisect(self, update_firebase):
+        state = get_queue_state(self.doctor)
+        self.assertEqual([state.people_ahead(t) for t in (1, 2, 3)], [0, 1, 2])
+
+    def test_views_keep_the_cache_in_step_with_the_database(self, update_firebase):
+        get_queue_state(self.doctor)  # Warm the cache
+        self.client.post(reverse('patient_check_in'), {'patient_name': "Cat", 'doctor': self.doctor.id})
+        self.assertEqual(get_queue_state(self.doctor).total_waiting, 3)
+        self.assertMatchesDatabase()
+
+        self.client.get(reverse('call_patient', args=[self.first.id]))
+        self.assertEqual(get_queue_state(self.doctor).current_id, self.first.id)
+        self.assertMatchesDatabase()
+
+        self.client.get(reverse('complete_appointment', args=[self.first.id]))
+        state = get_queue_state(self.doctor)
+        self.assertIsNone(state.current)
+        self.assertEqual([p['patient_name'] for p in state.waiting()], ["Ben", "Cat"])
+        self.assertMatchesDatabase()
+
+    def test_stale_version_forces_rebuild(self, update_firebase):
+        get_queue_state(self.doctor)
+        # A change that bypassed the hooks, followed by a version bump from elsewhere
+        Appointment.objects.filter(id=self.second.id).update(status='cancelled')
+        queue_state.bump_version(self.doctor.id)
+        self.assertEqual(get_queue_state(self.doctor).total_waiting, 1)
+
+    def test_live_status_needs_no_count_query_when_warm(self, update_firebase):
+        self.client.logout()
+        url = reverse('patient_live_status', args=[self.second.id])
+        self.client.get(url)
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url)
+        self.assertEqual(response.context['people_ahead'], 1)
+        # The appointment itself and the duration model; no COUNT over the queue
+        self.assertEqual(len(ctx), 2)
+        self.assertFalse(any('COUNT(' in q['sql'] for q in ctx.captured_queries))
+
+
+class AppointmentIndexTests(HospitalTestCase):
+    """
+    The hot views must hit an index, not scan the Appointment table. After
+    ANALYZE, SQLite already picks the same plans for a few thousand rows as for
+    a million, so the fixture stays small and the test stays fast.
+    """
+
+    ROWS = 5_000
+    DOCTORS = 40
+
+    @classmethod
+    def setUpTestData(cls):
+        department = Department.objects.create(name="General Medicine")
+        users = User.objects.bulk_create(User(username=f"idx{i}") for i in range(cls.DOCTORS))
+        Doctor.objects.bulk_create(Doctor(user=u, department=department, is_on_duty=True) for u in users)
+        cls.doctor = Doctor.objects.order_by('id').first()
+        cls.doctor.user.set_password("pass")
+        cls.doctor.user.save()
+
+        # A year of history, generated inside the database in one statement
+        with connection.cursor() as cursor:
+            cursor.execute(f"""
+                WITH RECURSIVE seq(n) AS (SELECT 1 UNION ALL SELECT n + 1 FROM seq WHERE n < {cls.ROWS})
+                INSERT INTO hospital_appointment
+                    (patient_name, patient_email, doctor_id, booked_at, booked_date, ticket_id, token_number, status)
+                SELECT
+                    'Patient ' || n, 'p' || (n % 50000) || '@example.com',
+                    (SELECT MIN(id) FROM hospital_doctor) + n % {cls.DOCTORS},
+                    datetime('now', '-' || (n % 365) || ' days'), date('now', '-' || (n % 365) || ' days'),
+                    'IDX-' || n, n / {cls.DOCTORS} % 200 + 1,
+                    CASE WHEN n % 365 = 0 THEN 'waiting' ELSE 'completed' END
+                FROM seq
+            """)
+            cursor.execute("ANALYZE")
+
+    def appointment_queries(self, *requests):
+        with CaptureQueriesContext(connection) as ctx:
+            for method, url, data in requests:
+                getattr(self.client, method)(url, data)
+        return [(q['sql'], ()) for q in ctx.captured_queries if 'hospital_appointment' in q['sql']]
+
+    def assertNoFullScan(self, sql, params):
+        with connection.cursor() as cursor:
+            cursor.execute(f"EXPLAIN QUERY PLAN {sql}", params)
+            plan = "\n".join(row[-1] for row in cursor.fetchall())
+        self.assertIsNone(re.search(r"\bSCAN hospital_appointment\b", plan), f"{sql}\n{plan}")
+
+    @skipUnlessDBFeature('supports_explaining_query_execution')
+    @mock.patch('hospital.views.update_firebase')
+    def test_hot_views_use_indexes(self, update_firebase):
+        if connection.vendor != 'sqlite':
+            self.skipTest("EXPLAIN QUERY PLAN output is SQLite-specific")
+        appointment = Appointment.objects.filter(doctor=self.doctor, status='waiting').first()
+        self.client.login(username=self.doctor.user.username, password="pass")
+
+        queries = self.appointment_queries(
+            ('post', reverse('patient_check_in'), {'patient_name': "New", 'doctor': self.doctor.id}),
+            ('get', reverse('patient_live_status', args=[appointment.id]), {}),
+            ('get', reverse('public_display'), {}),
+            ('get', reverse('doctor_dashboard'), {}),
+            ('get', reverse('patient_dashboard'), {'email': "p7@example.com"}),
+        )
+        # History isn't rendered by the dashboard template, so check its query directly
+        queries.append(Appointment.objects.filter(
+            doctor=self.doctor, status='completed', booked_date=timezone.localdate()
+        ).order_by('-actual_end_time').query.sql_with_params())
+
+        self.assertGreaterEqual(len(queries), 5)
+        for sql, params in queries:
+            self.assertNoFullScan(sql, params)
+
+
+@mock.patch('hospital.views.update_firebase')
+class WaitEstimationTests(HospitalTestCase):
+    def setUp(self):
+        super().setUp()
+        self.doctor = make_doctor("house", avg_consultation_time=10)
+        self.client.login(username="house", password="pass")
+        self.queue = [
+            Appointment.objects.create(patient_name=f"P{token}", doctor=self.doctor, token_number=token)
+            for token in range(1, 6)
+        ]
+
+    def estimates(self):
+        return list(Appointment.objects.filter(doctor=self.doctor, status='waiting')
+                    .order_by('token_number').values_list('estimated_start_time', flat=True))
+
+    def test_overrunning_consultation_pushes_nobody_into_the_past(self, update_firebase):
+        now = timezone.now()
+        inside = self.queue[0]
+        Appointment.objects.filter(id=inside.id).update(
+            status='in_consultation', actual_start_time=now - timedelta(minutes=4)
+        )
+        queue_state.invalidate(self.doctor.id)
+
+        self.assertEqual(reestimate_queue(self.doctor, now=now), 4)
+        self.assertEqual(self.estimates(), [now + timedelta(minutes=m) for m in (6, 16, 26, 36)])
+
+        Appointment.objects.filter(id=inside.id).update(actual_start_time=now - timedelta(minutes=25))
+        reestimate_queue(self.doctor, now=now)
+        self.assertEqual(self.estimates()[0], now)
+
+    def test_call_reestimates_whole_queue_in_constant_queries(self, update_firebase):
+        get_queue_state(self.doctor)
+        with CaptureQueriesContext(connection) as small:
+            reestimate_queue(self.doctor)
+        Appointment.objects.bulk_create(
+            Appointment(patient_name=f"P{t}", doctor=self.doctor, token_number=t, ticket_id=f"E-{t}")
+            for t in range(6, 306)
+        )
+        queue_state.invalidate(self.doctor.id)
+        get_queue_state(self.doctor)
+        with CaptureQueriesContext(connection) as large:
+            reestimate_queue(self.doctor)
+        self.assertEqual(len(small), len(large))
+
+    def test_transitions_refresh_estimates(self, update_firebase):
+        self.client.get(reverse('call_patient', args=[self.queue[0].id]))
+        first, *rest = self.estimates()
+        self.assertAlmostEqual((first - timezone.now()).total_seconds() / 60, 10, delta=1)
+        self.assertEqual([(b - a) for a, b in zip([first] + rest, rest)], [timedelta(minutes=10)] * 3)
+
+
+class DoctorStatsTests(HospitalTestCase):
+    def setUp(self):
+        super().setUp()
+        self.doctor = make_doctor("house", avg_consultation_time=10)
+
+    def test_running_mean_variance_and_ewma(self):
+        for minutes in (10, 20, 30):
+            self.doctor.update_average_time(minutes)
+        stats = DoctorStats.objects.get(doctor=self.doctor)
+
+        self.assertEqual(stats.count, 3)
+        self.assertAlmostEqual(stats.mean, 20)
+        self.assertAlmostEqual(stats.variance, 100)
+        # Same 70/30 rule as before, seeded from the doctor's old average
+        ewma = 10
+        for minutes in (10, 20, 30):
+            ewma = ewma * 0.7 + minutes * 0.3
+        self.assertAlmostEqual(stats.ewma, ewma)
+        self.assertEqual(self.doctor.avg_consultation_time, 19)
+
+    def test_average_stays_within_limits(self):
+        self.doctor.update_average_time(0.5)  # Accidental click: ignored
+        self.assertFalse(DoctorStats.objects.exists())
+        for _ in range(10):
+            self.doctor.update_average_time(500)
+        self.assertEqual(self.doctor.avg_consultation_time, 45)
+
+    def test_quantiles_move_towards_the_data(self):
+        for _ in range(40):
+            self.doctor.update_average_time(30)
+        stats = DoctorStats.objects.get(doctor=self.doctor)
+        self.assertGreater(stats.p50, 15)
+        self.assertGreater(stats.p90, stats.p50)
+
+    def test_expected_minutes_prefers_a_well_sampled_hour(self):
+        morning = timezone.now().replace(hour=9, minute=0)
+        evening = morning.replace(hour=18)
+        for _ in range(DoctorStats.MIN_HOUR_SAMPLES):
+            self.doctor.update_average_time(30, finished_at=morning)
+        self.assertAlmostEqual(DoctorStats.expected_minutes(self.doctor, at=morning), 30)
+        ewma = DoctorStats.objects.get(doctor=self.doctor).ewma
+        self.assertAlmostEqual(DoctorStats.expected_minutes(self.doctor, at=evening), ewma)
+
+    def test_concurrent_updates_are_not_lost(self):
+        # Two stale copies of the same doctor, as two request threads would hold
+        first, second = Doctor.objects.get(pk=self.doctor.pk), Doctor.objects.get(pk=self.doctor.pk)
+        first.update_average_time(20)
+        second.update_average_time(20)
+        self.assertEqual(DoctorStats.objects.get(doctor=self.doctor).count, 2)
+
+
+class TokenPDFTests(HospitalTestCase):
+    def setUp(self):
+        super().setUp()
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.enterContext(override_settings(TOKEN_PDF_DIR=tmp.name))
+        self.pdf_dir = tmp.name
+        self.doctor = make_doctor("house")
+        self.appointment = Appointment.objects.create(patient_name="Ann", doctor=self.doctor, token_number=1)
+        self.url = reverse('download_pdf', args=[self.appointment.id])
+
+    @override_settings(TOKEN_PDF_WORKERS=1)
+    @mock.patch('hospital.views.update_firebase')
+    def test_broken_pool_does_not_fail_the_booking(self, update_firebase):
+        broken = mock.Mock(submit=mock.Mock(side_effect=BrokenProcessPool("a worker died")))
+        with mock.patch.object(pdf, '_pool', broken):
+            response = self.client.post(reverse('patient_check_in'), {
+                'patient_name': "Ben", 'patient_email': "ben@example.com", 'doctor': self.doctor.id,
+            })
+            self.assertIsNone(pdf._pool)  # The next prerender starts a new pool
+        self.assertEqual(response.status_code, 302)
+        broken.shutdown.assert_called_once()
+        ben = Appointment.objects.get(patient_name="Ben")
+        self.assertEqual(self.client.get(reverse('download_pdf', args=[ben.id])).status_code, 200)  # On demand
+
+    def test_renders_once_per_version_and_answers_304(self):
+        with mock.patch('hospital.pdf.html_to_pdf', wraps=pdf.html_to_pdf) as render:
+            first = self.client.get(self.url)
+            second = self.client.get(self.url)
+            not_modified = self.client.get(self.url, HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(render.call_count, 1)
+
+        body = b''.join(first.streaming_content)
+        self.assertTrue(body.startswith(b'%PDF'))
+        self.assertEqual(b''.join(second.streaming_content), body)
+        self.assertEqual(first['ETag'], second['ETag'])
+        self.assertEqual(not_modified.status_code, 304)
+        self.assertIn('Token_1.pdf', first['Content-Disposition'])
+
+    def test_changed_ticket_gets_a_new_file_and_etag(self):
+        other = Appointment.objects.create(patient_name="Ben", doctor=self.doctor, token_number=2)
+        pdf.token_pdf(other)
+        before = self.client.get(self.url)['ETag']
+        Doctor.objects.filter(pk=self.doctor.pk).update(avg_consultation_time=25)
+        after = self.client.get(self.url, HTTP_IF_NONE_MATCH=before)
+        self.assertEqual(after.status_code, 200)
+        self.assertNotEqual(after['ETag'], before)
+        # The new version replaces the old one; other tickets keep theirs
+        self.assertEqual(len(os.listdir(self.pdf_dir)), 2)
+        self.assertEqual(len([n for n in os.listdir(self.pdf_dir) if n.startswith(self.appointment.ticket_id + '-')]), 1)
+        self.assertEqual(len([n for n in os.listdir(self.pdf_dir) if n.startswith(other.ticket_id + '-')]), 1)
+
+    @override_settings(TOKEN_PDF_WORKERS=1)
+    def test_booking_prerenders_in_the_process_pool(self):
+        future = pdf.prerender_token_pdf(self.appointment)
+        path = future.result(timeout=60)
+        self.assertEqual(path, pdf.token_pdf(self.appointment)[0])
+        self.assertIsNone(pdf.prerender_token_pdf(self.appointment))  # Already cached
+
+    def test_bulk_day_pdf_has_one_page_per_token(self):
+        from pypdf import PdfReader
+
+        for token in range(2, 4):
+            Appointment.objects.create(patient_name=f"P{token}", doctor=self.doctor, token_number=token)
+        output = os.path.join(self.pdf_dir, "day.pdf")
+        call_command('render_day_tokens', output=output, stdout=io.StringIO())
+        self.assertEqual(len(PdfReader(output).pages), 3)
+
+
+class BenchmarkTests(HospitalTestCase):
+    def test_mix_reports_percentiles_and_queries_per_endpoint(self):
+        doctors = benchmark.seed(departments=1, doctors_per_department=2, waiting_per_doctor=3)
+        self.assertEqual(Appointment.objects.count(), 6)
+
+        with FirebaseStub() as stub, override_settings(FIREBASE_DB_URL=stub.url), \
+                tempfile.TemporaryDirectory() as pdf_dir, override_settings(TOKEN_PDF_DIR=pdf_dir):
+            results, seconds = benchmark.run_mix(doctors, benchmark.parse_mix(benchmark.DEFAULT_MIX), 60)
+            firebase.outbox.drain()  # Deliver to the stub, not the real database
+        report = benchmark.summarize(results, seconds)
+
+        self.assertEqual(report['total']['errors'], 0)
+        for row in report['endpoints'].values():
+            self.assertLessEqual(row['p50_ms'], row['p95_ms'])
+            self.assertLessEqual(row['p95_ms'], row['p99_ms'])
+            self.assertGreater(row['queries_per_request'], 0)
+
+    def test_percentile_is_nearest_rank(self):
+        values = list(range(1, 101))
+        self.assertEqual(benchmark.percentile(values, 50), 50)
+        self.assertEqual(benchmark.percentile(values, 99), 99)
+        self.assertEqual(benchmark.percentile([7], 95), 7)
+
+
+@mock.patch('hospital.views.update_firebase')
+@override_settings(METRICS_TOKEN="scrape-secret")
+class MetricsTests(HospitalTestCase):
+    def setUp(self):
+        super().setUp()
+        metrics.reset()
+        self.doctor = make_doctor("house")
+
+    def scrape(self):
+        response = self.client.get(reverse('metrics'), HTTP_AUTHORIZATION="Bearer scrape-secret")
+        self.assertEqual(response['Content-Type'], metrics.CONTENT_TYPE)
+        return response.content.decode()
+
+    def test_scrape_needs_the_token_or_staff(self, update_firebase):
+        url = reverse('metrics')
+        self.assertEqual(self.client.get(url).status_code, 403)
+        self.assertEqual(self.client.get(url, HTTP_AUTHORIZATION="Bearer guess").status_code, 403)
+        self.client.force_login(self.doctor.user)
+        self.assertEqual(self.client.get(url).status_code, 403)  # Doctors aren't staff
+        User.objects.filter(pk=self.doctor.user.pk).update(is_staff=True)
+        self.assertEqual(self.client.get(url).status_code, 200)
+        with override_settings(METRICS_TOKEN=''):
+            self.client.logout()
+            self.assertEqual(self.client.get(url, HTTP_AUTHORIZATION="Bearer ").status_code, 403)
+
+    def test_requests_are_timed_per_view_with_their_queries(self, update_firebase):
+        for _ in range(3):
+            self.client.get(reverse('public_display'))
+        self.client.get('/no-such-page/')
+        body = self.scrape()
+
+        self.assertIn('hospital_http_request_duration_seconds_count{view="public_display",method="GET"} 3', body)
+        self.assertIn('hospital_http_request_duration_seconds_bucket{view="public_display",method="GET",le="+Inf"} 3', body)
+        self.assertIn('hospital_http_responses_total{view="unresolved",status="404"} 1', body)
+        queries = re.search(r'hospital_db_queries_total\{view="public_display"\} (\d+)', body)
+        self.assertGreaterEqual(int(queries.group(1)), 3)  # At least the doctors query per request
+
+    def test_firebase_attempts_and_errors_are_counted(self, update_firebase):
+        with FirebaseStub(fail_first=1) as stub:
+            outbox = FirebaseOutbox(base_url=stub.url, autostart=False, backoff=0.01)
+            outbox.enqueue(self.doctor.id, {'status': 'Live'})
+            self.assertTrue(outbox.flush())
+        body = self.scrape()
+
+        self.assertIn('hospital_firebase_errors_total{reason="http_503"} 1', body)
+        self.assertIn('hospital_firebase_request_duration_seconds_count{outcome="ok"} 1', body)
+        self.assertIn('hospital_firebase_outbox_pending 0', body)
+
+    def test_histogram_buckets_are_cumulative(self, update_firebase):
+        histogram = metrics.Histogram()
+        for seconds in (0.001, 0.02, 0.02, 30):
+            histogram.observe(seconds)
+        lines = list(metrics._histogram_lines('x', histogram))
+        self.assertIn('x_bucket{le="0.005"} 1', lines)
+        self.assertIn('x_bucket{le="0.025"} 3', lines)
+        self.assertIn('x_bucket{le="10.0"} 3', lines)
+        self.assertIn('x_bucket{le="+Inf"} 4', lines)
+
+
+class ArchiveTests(HospitalTestCase):
+    def setUp(self):
+        super().setUp()
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.enterContext(override_settings(TOKEN_PDF_DIR=tmp.name))
+        self.pdf_dir = tmp.name
+        self.doctor = make_doctor("house")
+        self.today = timezone.localdate()
+
+    def book(self, name, days_ago, status, token=1):
+        appointment = Appointment.objects.create(
+            patient_name=name, patient_email="ann@example.com", doctor=self.doctor, token_number=token,
+            status=status, booked_date=self.today - timedelta(days=days_ago),
+        )
+        Appointment.objects.filter(pk=appointment.pk).update(booked_at=timezone.now() - timedelta(days=days_ago))
+        return appointment
+
+    def test_moves_only_old_finished_rows_in_batches(self):
+        old_done = self.book("Old done", 10, 'completed', token=1)
+        old_cancelled = self.book("Old cancelled", 10, 'cancelled', token=2)
+        still_waiting = self.book("Still waiting", 10, 'waiting', token=3)
+        recent_done = self.book("Recent done", 1, 'completed')
+
+        moved = archive_appointments(archive_cutoff(days=3), batch_size=1)
+
+        self.assertEqual(moved, 2)
+        self.assertEqual(set(Appointment.objects.values_list('id', flat=True)), {still_waiting.id, recent_done.id})
+        archived = ArchivedAppointment.objects.get(id=old_done.id)
+        self.assertEqual((archived.ticket_id, archived.token_number, archived.status),
+                         (old_done.ticket_id, 1, 'completed'))
+        self.assertTrue(ArchivedAppointment.objects.filter(id=old_cancelled.id).exists())
+
+    def test_patient_dashboard_reads_both_tables(self):
+        old = self.book("Ann", 10, 'completed')
+        self.book("Ann", 0, 'waiting', token=2)
+        archive_appointments(archive_cutoff(days=3))
+
+        response = self.client.get(reverse('patient_dashboard'), {'email': "ann@example.com"})
+        history = response.context['history']
+        self.assertEqual([a.status for a in history], ['waiting', 'completed'])
+
+        response = self.client.post(reverse('patient_dashboard'), {'ticket_id': old.ticket_id})
+        self.assertEqual(response.context['error'], "This visit is already completed.")
+
+    def test_only_live_visits_can_be_tracked(self):
+        cancelled = self.book("Ann", 10, 'cancelled')
+        waiting = self.book("Ann", 0, 'waiting', token=2)
+        archive_appointments(archive_cutoff(days=3))
+
+        response = self.client.get(reverse('patient_dashboard'), {'email': "ann@example.com"})
+        self.assertContains(response, reverse('patient_live_status', args=[waiting.id]))
+        self.assertNotContains(response, reverse('patient_live_status', args=[cancelled.id]))
+        self.assertContains(response, "Track Live", count=1)
+
+    def test_archived_tickets_lose_their_pdfs(self):
+        old = self.book("Old", 10, 'completed')
+        live = self.book("Live", 0, 'waiting', token=2)
+        for appointment in (old, live):
+            with open(os.path.join(self.pdf_dir, f"{appointment.ticket_id}-{'0' * 16}.pdf"), 'wb') as f:
+                f.write(b'%PDF')
+        archive_appointments(archive_cutoff(days=3))
+        self.assertEqual(os.listdir(self.pdf_dir), [f"{live.ticket_id}-{'0' * 16}.pdf"])
+
+    def test_command_reports_what_it_moved(self):
+        self.book("Ann", 10, 'completed')
+        out = io.StringIO()
+        call_command('archive_appointments', days=3, pause=0, stdout=out)
+        self.assertIn("Archived 1 appointments", out.getvalue())
+
+
+class SQLiteTuningTests(SimpleTestCase):
+    @skipUnless(connection.vendor == 'sqlite', "SQLite only")
+    def test_new_connections_get_wal_and_busy_timeout(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            settings_dict = {**connections['default'].settings_dict, 'NAME': os.path.join(tmp, 'tuned.sqlite3')}
+            wrapper = type(connections['default'])(settings_dict, alias='tuning-test')
+            wrapper.ensure_connection()
+            try:
+                pragma = lambda name: wrapper.connection.execute(f"PRAGMA {name}").fetchone()[0]
+                self.assertEqual(pragma('journal_mode'), 'wal')
+                self.assertEqual(pragma('synchronous'), 1)  # NORMAL
+                self.assertEqual(pragma('busy_timeout'), 5000)
+            finally:
+                wrapper.close()
+
+
+@mock.patch('hospital.views.update_firebase')
+class AsyncViewTests(HospitalTestCase):
+    def setUp(self):
+        super().setUp()
+        metrics.reset()
+        self.doctor = make_doctor("house")
+        self.first = Appointment.objects.create(patient_name="Ann", doctor=self.doctor, token_number=1)
+        self.second = Appointment.objects.create(patient_name="Ben", doctor=self.doctor, token_number=2)
+
+    def test_middleware_never_forces_the_chain_onto_a_thread(self, update_firebase):
+        # With DEBUG on, Django logs every sync-only middleware it has to adapt
+        with override_settings(DEBUG=True), self.assertNoLogs('django.request', 'DEBUG'):
+            ASGIHandler()
+
+    def test_sync_views_run_side_by_side_under_the_asgi_server(self, update_firebase):
+        # The test AsyncClient runs every sync view on one shared thread. The server's handler
+        # (config.asgi) gives each request its own, so these four must all be inside at once.
+        # (A sync test with its own loop: an async test would pin them to the test's thread.)
+        from config.asgi import application
+        together = threading.Barrier(4, timeout=5)
+
+        def render_when_all_are_in(*args, **kwargs):
+            together.wait()
+            return HttpResponse("ok")
+
+        async def get(path):
+            scope = {'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET',
+                     'scheme': 'http', 'path': path, 'raw_path': path.encode(), 'root_path': '', 'query_string': b'',
+                     'headers': [(b'host', b'testserver')], 'client': ('10.0.0.1', 5000), 'server': ('testserver', 80)}
+            body, sent = [{'type': 'http.request', 'body': b'', 'more_body': False}], []
+
+            async def receive():
+                return body.pop() if body else await asyncio.Event().wait()
+
+            async def send(message):
+                sent.append(message)
+            await application(scope, receive, send)
+            return sent[0]['status']
+
+        async def four_at_once():
+            return await asyncio.wait_for(asyncio.gather(*[get('/') for _ in range(4)]), timeout=10)
+
+        with mock.patch('hospital.views.render', side_effect=render_when_all_are_in):
+            statuses = asyncio.run(four_at_once())
+        self.assertEqual(statuses, [200] * 4)
+
+    async def test_read_views_run_on_the_asgi_stack(self, update_firebase):
+        response = await self.async_client.get(reverse('patient_live_status', args=[self.second.id]))
+        self.assertEqual(response.context['people_ahead'], 1)
+
+        response = await self.async_client.get(reverse('public_display'))
+        self.assertEqual(response.context['doctors'][0]['total_waiting'], 2)
+
+        response = await self.async_client.get(reverse('get_doctors'), {'department_id': self.doctor.department_id})
+        self.assertEqual(response.json()['doctors'][0]['waiting'], 2)
+
+        # Queries made on the ORM's thread are still charged to the request
+        with override_settings(METRICS_TOKEN="scrape-secret"):
+            response = await self.async_client.get(reverse('metrics'), headers={'authorization': "Bearer scrape-secret"})
+        body = response.content.decode()
+        queries = re.search(r'hospital_db_queries_total\{view="patient_live_status"\} (\d+)', body)
+        self.assertGreater(int(queries.group(1)), 0)
+
+
+@mock.patch('hospital.views.update_firebase')
+class ConditionalGetTests(HospitalTestCase):
+    def setUp(self):
+        super().setUp()
+        self.doctor = make_doctor("house")
+        self.other = make_doctor("grey")  # Another department
+        self.appointment = Appointment.objects.create(patient_name="Ann", doctor=self.doctor, token_number=1)
+        queue_state.remember_doctors([self.appointment])  # As check-in does
+
+    def revalidate(self, url, data=None):
+        """GETs the url, then asserts a repeat with its ETag is a 304 that runs no query."""
+        first = self.client.get(url, data)
+        self.assertEqual(first.status_code, 200)
+        with self.assertNumQueries(0):
+            again = self.client.get(url, data, HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(again.status_code, 304)
+        return first['ETag']
+
+    def book(self, doctor):
+        self.client.post(reverse('patient_check_in'), {'patient_name': "Ben", 'doctor': doctor.id})
+
+    def test_display_revalidates_until_any_queue_changes(self, update_firebase):
+        etag = self.revalidate(reverse('public_display'))
+        self.book(self.other)
+        self.assertNotEqual(self.revalidate(reverse('public_display')), etag)
+
+    def test_doctor_list_only_changes_with_its_department(self, update_firebase):
+        url, data = reverse('get_doctors'), {'department_id': self.doctor.department_id}
+        etag = self.revalidate(url, data)
+        self.book(self.other)
+        self.assertEqual(self.revalidate(url, data), etag)
+
+        self.client.force_login(self.doctor.user)
+        self.client.post(reverse('toggle_duty'))
+        self.client.logout()
+        self.assertNotEqual(self.revalidate(url, data), etag)
+
+    def test_live_status_changes_when_the_patient_is_called(self, update_firebase):
+        url = reverse('patient_live_status', args=[self.appointment.id])
+        etag = self.revalidate(url)
+
+        self.client.force_login(self.doctor.user)
+        self.client.get(reverse('call_patient', args=[self.appointment.id]))
+        self.assertNotEqual(self.revalidate(url), etag)  # Logged in and called: new page
+
+
+@mock.patch('hospital.views.update_firebase')
+class RebalanceTests(HospitalTestCase):
+    def setUp(self):
+        super().setUp()
+        self.leaving = make_doctor("house")
+        department = self.leaving.department
+        self.fast = make_doctor("wilson", department=department, avg_consultation_time=5)
+        self.busy = make_doctor("cuddy", department=department, avg_consultation_time=10)
+        self.elsewhere = make_doctor("grey")  # Other department: never receives anyone
+        for token in range(1, 4):
+            Appointment.objects.create(patient_name=f"Busy {token}", doctor=self.busy, token_number=token)
+
+    def queue(self, doctor, count, prefix="P"):
+        return Appointment.objects.bulk_create([
+            Appointment(patient_name=f"{prefix}{i}", doctor=doctor, token_number=i, ticket_id=f"{prefix}-{i}")
+            for i in range(1, count + 1)
+        ])
+
+    def test_plan_always_picks_the_doctor_free_first(self, update_firebase):
+        # Free in 0 (5 min each) and in 32 minutes (10 min each)
+        assignments = rebalance.plan("abcdefghi", [(0, 5, 'fast'), (32, 10, 'busy')])
+        self.assertEqual([doctor for _, doctor, _ in assignments], ['fast'] * 7 + ['busy', 'fast'])
+        self.assertEqual([p for p, _, _ in assignments], list("abcdefghi"))
+        self.assertEqual([start for _, _, start in assignments[6:]], [30, 32, 35])
+
+    def test_going_off_duty_hands_the_queue_to_colleagues(self, update_firebase):
+        patients = self.queue(self.leaving, 8)
+        self.client.force_login(self.leaving.user)
+        self.client.post(reverse('toggle_duty'))
+
+        self.assertFalse(Appointment.objects.filter(doctor=self.leaving, status='waiting').exists())
+        fast = list(Appointment.objects.filter(doctor=self.fast).order_by('token_number'))
+        busy = list(Appointment.objects.filter(doctor=self.busy, patient_name__startswith="P").order_by('token_number'))
+        # Wilson is free at 0, 5, ... 30; Cuddy at 30 (3 waiting x 10). Ties go to the first colleague
+        self.assertEqual([a.patient_name for a in fast], ["P1", "P2", "P3", "P4", "P5", "P6", "P7"])
+        self.assertEqual([(a.patient_name, a.token_number) for a in busy], [("P8", 4)])
+        self.assertEqual([a.token_number for a in fast], list(range(1, 8)))
+        self.assertEqual({a.ticket_id for a in fast + busy}, {p.ticket_id for p in patients})
+
+        self.assertEqual(get_queue_state(self.fast).total_waiting, 7)
+        self.assertEqual(get_queue_state(self.leaving).total_waiting, 0)
+        update_firebase.assert_any_call(self.fast.id, 0, "Live", "Wilson", update_last_issued=7)
+
+    def test_caches_change_only_after_the_hand_over_commits(self, update_firebase):
+        self.queue(self.leaving, 3)
+        before = {doctor.id: queue_state.doctor_version(doctor.id) for doctor in (self.leaving, self.fast, self.busy)}
+        seen = {}
+
+        def rebalance_then_read(doctor):
+            moved = rebalance.rebalance_off_duty(doctor)
+            # Still inside toggle_duty's transaction: nothing may be cached from it yet
+            seen.update({doctor_id: queue_state.doctor_version(doctor_id) for doctor_id in before})
+            return moved
+
+        self.client.force_login(self.leaving.user)
+        with mock.patch('hospital.views.rebalance_off_duty', side_effect=rebalance_then_read):
+            self.client.post(reverse('toggle_duty'))
+
+        self.assertEqual(seen, before)
+        self.assertEqual(get_queue_state(self.leaving).total_waiting, 0)
+        self.assertEqual(get_queue_state(self.fast).total_waiting + get_queue_state(self.busy).total_waiting, 6)
+
+    def test_drain_time_uses_the_expected_consultation_length(self, update_firebase):
+        # Wilson's rounded average still says 5 minutes; his recent consultations took 20
+        DoctorStats.objects.create(doctor=self.fast, ewma=20, p50=20, p90=20)
+        self.assertEqual(get_queue_state(self.fast).minutes_per_patient, 20)
+        self.queue(self.leaving, 3)
+        moved = rebalance.rebalance_off_duty(self.leaving)
+        # Wilson is free at 0 and 20, Cuddy at 30 (3 waiting x 10)
+        self.assertEqual({doctor.id: [a.patient_name for a in batch] for doctor, batch in moved.items()},
+                         {self.fast.id: ["P1", "P2"], self.busy.id: ["P3"]})
+
+    def test_failed_hand_over_leaves_the_doctor_on_duty(self, update_firebase):
+        self.queue(self.leaving, 3)
+        self.client.force_login(self.leaving.user)
+        with mock.patch('hospital.rebalance.TokenCounter.allocate', side_effect=OperationalError("database is locked")):
+            response = self.client.post(reverse('toggle_duty'), follow=True)
+
+        self.assertContains(response, "Your duty status could not be changed")
+        self.assertTrue(Doctor.objects.get(pk=self.leaving.pk).is_on_duty)
+        self.assertEqual(Appointment.objects.filter(doctor=self.leaving, status='waiting').count(), 3)
+        update_firebase.assert_not_called()
+
+    def test_query_count_does_not_grow_with_patients_moved(self, update_firebase):
+        self.queue(self.leaving, 10, prefix="W")
+        rebalance.rebalance_off_duty(self.leaving)  # Both colleagues now have token counters
+        self.queue(self.leaving, 20)
+        with CaptureQueriesContext(connection) as few:
+            rebalance.rebalance_off_duty(self.leaving)
+        self.queue(self.leaving, 120, prefix="Q")  # One batch per bulk write (event rows too), even on SQLite
+        with CaptureQueriesContext(connection) as many:
+            rebalance.rebalance_off_duty(self.leaving)
+        self.assertEqual(len(many), len(few))
+
+    def test_nobody_moves_without_an_on_duty_colleague(self, update_firebase):
+        Doctor.objects.filter(pk__in=[self.fast.pk, self.busy.pk]).update(is_on_duty=False)
+        self.queue(self.leaving, 3)
+        self.assertEqual(rebalance.rebalance_off_duty(self.leaving), {})
+        self.assertEqual(Appointment.objects.filter(doctor=self.leaving).count(), 3)
+
+
+class SimulationTests(HospitalTestCase):
+    day = timezone.localdate()
+
+    def visits(self, *rows):
+        """(arrival, doctor_id, service) rows, all on one day in department 1."""
+        return [simulation.Visit(arrival, doctor_id, 1, self.day, 0.0, service, None, None)
+                for arrival, doctor_id, service in rows]
+
+    def test_replay_quotes_like_the_check_in_view(self):
+        visits = self.visits((0, 1, 10), (0, 1, 10), (0, 1, 10))
+        samples = simulation.replay(visits, {(1, self.day): 0.0}, simulation.FixedEstimator(15))
+        self.assertEqual(samples['waits'], [0, 10, 20])
+        # Quoted 0, 15 and 30 minutes: each 15-minute guess is 5 minutes too long
+        self.assertEqual(samples['start_errors'], [0, 5, 10])
+        self.assertEqual(samples['duration_errors'], [5, 5, 5])
+        self.assertEqual(samples['utilization'], {1: 1.0})
+
+    def test_patients_wait_for_the_doctor_to_open(self):
+        visits = self.visits((0, 1, 10), (5, 2, 10))
+        shifts = {(1, self.day): 30.0, (2, self.day): 0.0}
+        samples = simulation.replay(visits, shifts, simulation.FixedEstimator(10))
+        self.assertEqual(sorted(samples['waits']), [0, 30])
+
+    def test_earliest_assignment_spreads_the_department(self):
+        visits = self.visits((0, 1, 10), (0, 1, 10), (0, 1, 10), (0, 1, 10), (100, 2, 10))
+        shifts = {(1, self.day): 0.0, (2, self.day): 0.0}
+        as_booked = simulation.replay(visits, shifts, simulation.FixedEstimator(10))
+        spread = simulation.replay(visits, shifts, simulation.FixedEstimator(10), simulation.earliest_start)
+        self.assertEqual(as_booked['waits'], [0, 10, 20, 30, 0])
+        self.assertEqual(spread['waits'], [0, 0, 10, 10, 0])
+
+    def test_ewma_policy_matches_the_doctor_model(self):
+        doctor = make_doctor("house")
+        estimator = simulation.EWMAEstimator(doctor.avg_consultation_time)
+        for minutes in (30, 0.5, 8, 60, 12):
+            doctor.update_average_time(minutes)
+            estimator.observe(doctor.id, 10, minutes)
+            self.assertEqual(estimator.predict(doctor.id, 10), doctor.avg_consultation_time)
+
+    def test_command_replays_live_and_archived_history(self):
+        yesterday = self.day - timedelta(days=1)
+        doctor = make_doctor("house")
+        opened = timezone.make_aware(datetime.combine(yesterday, time(9)))
+        Appointment.objects.bulk_create([
+            Appointment(patient_name=f"P{i}", doctor=doctor, token_number=i, ticket_id=f"S-{i}", status='completed',
+                        actual_start_time=opened + timedelta(minutes=10 * i),
+                        actual_end_time=opened + timedelta(minutes=10 * i + 10))
+            for i in range(6)
+        ])
+        # booked_at is auto_now_add: backdate after the insert. Half of the day goes to the archive
+        backdate = dict(booked_at=opened, booked_date=yesterday)
+        Appointment.objects.filter(token_number__lt=3).update(**backdate)
+        archive_appointments(archive_cutoff(1), batch_size=2, pause=0)
+        Appointment.objects.filter(token_number__gte=3).update(**backdate)
+        Appointment.objects.create(patient_name="Today", doctor=doctor)  # Outside the range
+
+        with tempfile.NamedTemporaryFile(suffix='.json') as output:
+            call_command('simulate_queue', start=str(yesterday), end=str(yesterday), estimator=['ewma', 'fixed'],
+                         assignment=['as-booked', 'earliest'], output=output.name, stdout=io.StringIO())
+            report = json.load(output)
+        self.assertEqual(set(report['runs']), {
+            'history', 'ewma/as-booked', 'ewma/earliest', 'fixed/as-booked', 'fixed/earliest',
+        })
+        history = report['runs']['history']
+        self.assertEqual((history['patients'], history['wait_p90_min']), (6, 50))
+        self.assertEqual(report['runs']['fixed/as-booked']['wait_p90_min'], 50)
+        self.assertEqual(report['runs']['fixed/as-booked']['utilization_mean'], 1.0)
+
+
+class StartupTests(SimpleTestCase):
+    def test_warm_up_starts_once_after_the_first_response(self):
+        with mock.patch.object(warmup, '_started', False), mock.patch.object(warmup, 'warm_up') as warm_up:
+            request_finished.connect(warmup.on_first_request, dispatch_uid=warmup.DISPATCH_UID)
+            request_finished.send(sender=None)
+            request_finished.send(sender=None)
+            for thread in threading.enumerate():
+                if thread.name == 'hospital-warmup':
+                    thread.join()
+        warm_up.assert_called_once_with()
+        self.assertFalse(request_finished.disconnect(dispatch_uid=warmup.DISPATCH_UID))
+
+    def test_importtime_log_is_summed_per_package(self):
+        rows = startup_benchmark.parse_importtime(
+            "import time: self [us] | cumulative | imported package\n"
+            "import time:       300 |        300 |     django.utils\n"
+            "import time:      1200 |       1500 |   django\n"
+            "import time:       500 |        500 | hospital.views\n"
+        )
+        self.assertEqual(rows[0], ('django.utils', 300, 300))
+        report = startup_benchmark.import_report(rows, top=2)
+        self.assertEqual(report['packages_ms'], {'django': 1.5, 'hospital': 0.5})
+        self.assertEqual(list(report['slowest_modules_ms']), ['django', 'hospital.views'])
+
+    def test_first_response_needs_no_pdf_or_http_client(self):
+        with tempfile.NamedTemporaryFile(suffix='.json') as output:
+            call_command('startup_benchmark', runs=1, output=output.name, stdout=io.StringIO())
+            report = json.load(output)
+        self.assertEqual(report['status'], 200)
+        self.assertEqual(report['lazy_modules_loaded'], [])
+        self.assertIn('hospital', report['imports']['packages_ms'])
+
+
+LANES = {
+    'doctor': {'views': ['call_patient', 'complete_appointment']},
+    'checkin': {'views': ['patient_check_in'], 'methods': ['POST'], 'per_client': (1, 2), 'total': (100, 100)},
+    'polling': {'views': ['patient_live_status'], 'per_client': (1, 3), 'total': (1, 4)},
+}
+
+
+@mock.patch('hospital.views.update_firebase')
+@override_settings(ADMISSION_LANES=LANES)
+class AdmissionControlTests(HospitalTestCase):
+    def setUp(self):
+        super().setUp()
+        self.doctor = make_doctor("house")
+        self.appointment = Appointment.objects.create(patient_name="Ann", doctor=self.doctor, token_number=1)
+        self.live_url = reverse('patient_live_status', args=[self.appointment.id])
+
+    def test_bucket_admits_a_burst_then_refills_at_the_rate(self, update_firebase):
+        waits = [admission.take("bucket", rate=2, burst=3, now=100.0) for _ in range(4)]
+        self.assertEqual(waits, [0, 0, 0, 0.5])
+        self.assertEqual(admission.take("bucket", rate=2, burst=3, now=100.5), 0)
+        self.assertEqual(admission.take("bucket", rate=2, burst=3, now=100.5), 0.5)
+        self.assertEqual(admission.take("bucket", rate=2, burst=3, now=110.0), 0)  # Idle: full again
+
+    def test_over_the_limit_gets_429_before_any_query(self, update_firebase):
+        statuses = [self.client.get(self.live_url, REMOTE_ADDR='10.0.0.1').status_code for _ in range(3)]
+        self.assertEqual(statuses, [200, 200, 200])
+        with self.assertNumQueries(0):
+            response = self.client.get(self.live_url, REMOTE_ADDR='10.0.0.1')
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], '1')
+
+        # Another phone has its own bucket, until the lane as a whole is full
+        self.assertEqual(self.client.get(self.live_url, REMOTE_ADDR='10.0.0.2').status_code, 200)
+        self.assertEqual(self.client.get(self.live_url, REMOTE_ADDR='10.0.0.3').status_code, 429)
+
+    def test_async_path_takes_buckets_off_the_event_loop(self, update_firebase):
+        threads = []
+
+        def admit(request, lane, config):
+            threads.append(threading.get_ident())
+            return 3
+
+        async def view(request):
+            return HttpResponse("ok")
+
+        async def run():
+            middleware = admission.AdmissionControlMiddleware(view)
+            factory = RequestFactory()
+            rejected = await middleware(factory.get(self.live_url))
+            passed = await middleware(factory.get('/'))  # Not in a lane: no bucket taken
+            return threading.get_ident(), rejected, passed
+
+        with mock.patch('hospital.admission.admit', admit):
+            loop_thread, rejected, passed = asyncio.run(run())
+        self.assertEqual(rejected.status_code, 429)
+        self.assertEqual(rejected['Retry-After'], '3')
+        self.assertEqual(passed.content, b"ok")
+        self.assertEqual(len(threads), 1)
+        self.assertNotEqual(threads[0], loop_thread)
+
+    def test_client_address_is_the_rightmost_untrusted_hop(self, update_firebase):
+        request = RequestFactory().get('/', REMOTE_ADDR='10.1.1.1',
+                                       HTTP_X_FORWARDED_FOR='6.6.6.6, 203.0.113.5, 10.0.0.9')
+        for proxies, address in ((0, '10.1.1.1'), (1, '10.0.0.9'), (2, '203.0.113.5'), (4, '10.1.1.1')):
+            with self.subTest(proxies=proxies), override_settings(ADMISSION_TRUSTED_PROXIES=proxies):
+                self.assertEqual(admission.client_address(request), address)
+
+        request.COOKIES['csrftoken'] = "abc"
+        with override_settings(ADMISSION_TRUSTED_PROXIES=2):
+            self.assertTrue(admission.client_id(request).startswith('203.0.113.5:'))
+
+    @override_settings(ADMISSION_LANES={'polling': {'views': ['patient_live_status'], 'per_client': (1, 1),
+                                                    'per_address': (1, 2)}})
+    def test_fresh_cookies_still_share_the_address_bucket(self, update_firebase):
+        statuses = []
+        for i in range(3):
+            self.client.cookies['csrftoken'] = f"rotated-{i}"
+            statuses.append(self.client.get(self.live_url, REMOTE_ADDR='10.0.0.1').status_code)
+        self.assertEqual(statuses, [200, 200, 429])
+        self.assertEqual(self.client.get(self.live_url, REMOTE_ADDR='10.0.0.2').status_code, 200)
+
+    def test_doctor_lane_is_never_throttled(self, update_firebase):
+        for _ in range(5):
+            self.client.get(self.live_url)
+        self.client.force_login(self.doctor.user)
+        for _ in range(10):
+            response = self.client.get(reverse('call_patient', args=[self.appointment.id]))
+            self.assertEqual(response.status_code, 302)
+
+    def test_duplicate_submit_books_once(self, update_firebase):
+        page = self.client.get(reverse('patient_check_in'))
+        key = re.search(r'name="idempotency_key" value="(\w+)"', page.content.decode()).group(1)
+        form = {'patient_name': "Ben", 'patient_email': "ben@example.com", 'doctor': self.doctor.id,
+                'idempotency_key': key}
+        first = self.client.post(reverse('patient_check_in'), form)
+        second = self.client.post(reverse('patient_check_in'), form)
+        self.assertEqual(first['Location'], second['Location'])
+        self.assertEqual(Appointment.objects.filter(patient_name="Ben").count(), 1)
+        # Only the form posts are limited (2 per client): the page itself stays reachable
+        self.assertEqual(self.client.get(reverse('patient_check_in')).status_code, 200)
+        self.assertEqual(self.client.post(reverse('patient_check_in'), form).status_code, 429)
+
+    def test_invalid_submit_frees_the_key(self, update_firebase):
+        form = {'patient_name': "Ben", 'patient_email': "ben@example.com", 'idempotency_key': "k" * 32}
+        self.assertEqual(self.client.post(reverse('patient_check_in'), form).status_code, 200)
+        response = self.client.post(reverse('patient_check_in'), dict(form, doctor=self.doctor.id))
+        self.assertEqual(response.status_code, 302)
+
+    def test_second_submit_waits_for_the_first(self, update_firebase):
+        self.assertIsNone(admission.claim('check_in', "a" * 32))
+        threading.Timer(0.1, admission.complete, args=('check_in', "a" * 32, 42)).start()
+        self.assertEqual(admission.claim('check_in', "a" * 32), 42)
+        self.assertIsNone(admission.claim('check_in', "short"))  # Not a usable key: no dedupe
+
+    @override_settings(IDEMPOTENCY_WAIT=0)
+    def test_bulk_replays_the_first_answer(self, update_firebase):
+        self.client.force_login(self.doctor.user)
+        body = json.dumps({'bookings': [{'patient_name': "Cat", 'patient_email': "cat@example.com",
+                                         'doctor': self.doctor.id}]})
+        post = lambda: self.client.post(reverse('bulk_check_in'), body, content_type='application/json',
+                                        HTTP_IDEMPOTENCY_KEY="b" * 32)
+        first, second = post(), post()
+        self.assertEqual((first.status_code, second.status_code), (201, 201))
+        self.assertEqual(first.json(), second.json())
+        self.assertEqual(Appointment.objects.filter(patient_name="Cat").count(), 1)
+
+
+@mock.patch('hospital.views.update_firebase')
+class AnalyticsTests(HospitalTestCase):
+    def setUp(self):
+        super().setUp()
+        self.doctor = make_doctor("house")
+        self.colleague = make_doctor("wilson", department=self.doctor.department)
+        self.client.force_login(self.doctor.user)
+
+    def book(self, name):
+        self.client.post(reverse('patient_check_in'), {
+            'patient_name': name, 'patient_email': f"{name}@example.com", 'doctor': self.doctor.id,
+        })
+        return Appointment.objects.get(patient_name=name)
+
+    def test_status_changes_are_logged_with_waits_and_lengths(self, update_firebase):
+        ann, ben = self.book("ann"), self.book("ben")
+        Appointment.objects.filter(pk=ann.pk).update(booked_at=timezone.now() - timedelta(minutes=20))
+        self.client.get(reverse('call_patient', args=[ann.id]))
+        Appointment.objects.filter(pk=ann.pk).update(actual_start_time=timezone.now() - timedelta(minutes=12))
+        self.client.get(reverse('call_patient', args=[ben.id]))
+        self.client.get(reverse('complete_appointment', args=[ben.id]))
+
+        log = list(AppointmentEvent.objects.order_by('id').values_list('appointment_id', 'kind'))
+        self.assertEqual(log, [(ann.id, 'booked'), (ben.id, 'booked'), (ann.id, 'called'),
+                               (ann.id, 'completed'), (ben.id, 'called'), (ben.id, 'completed')])
+        called = AppointmentEvent.objects.get(appointment_id=ann.id, kind='called')
+        self.assertAlmostEqual(called.wait_minutes, 20, delta=0.5)
+        completed = AppointmentEvent.objects.get(appointment_id=ann.id, kind='completed')
+        self.assertAlmostEqual(completed.duration_minutes, 12, delta=0.5)
+        self.assertEqual(completed.department_id, self.doctor.department_id)
+
+    def test_rebalance_logs_each_move(self, update_firebase):
+        ann = self.book("ann")
+        rebalance.rebalance_off_duty(Doctor.objects.get(pk=self.doctor.pk))
+        event = AppointmentEvent.objects.get(kind='reassigned')
+        self.assertEqual((event.appointment_id, event.doctor_id), (ann.id, self.colleague.id))
+
+    def admin_save(self, appointment, **changes):
+        form = modelform_factory(Appointment, fields=['doctor', 'status'])(
+            {'doctor': appointment.doctor_id, 'status': appointment.status, **changes}, instance=appointment,
+        )
+        self.assertTrue(form.is_valid(), form.errors)
+        with self.captureOnCommitCallbacks(execute=True):
+            AppointmentAdmin(Appointment, admin.site).save_model(None, form.save(commit=False), form, change=True)
+
+    def test_admin_cancel_and_reassign_refresh_both_queues(self, update_firebase):
+        ann, ben = self.book("ann"), self.book("ben")
+        get_queue_states([self.doctor, self.colleague])
+
+        self.admin_save(ann, status='cancelled')
+        self.assertEqual(get_queue_state(self.doctor).ids, [ben.id])
+        self.admin_save(Appointment.objects.get(pk=ben.pk), doctor=self.colleague.id)
+        self.assertEqual(get_queue_state(self.doctor).total_waiting, 0)
+        self.assertEqual(get_queue_state(self.colleague).ids, [ben.id])
+        self.assertEqual(list(AppointmentEvent.objects.filter(kind__in=['cancelled', 'reassigned']).values_list(
+            'appointment_id', 'kind')), [(ann.id, 'cancelled'), (ben.id, 'reassigned')])
+
+    def test_rollups_count_each_event_once(self, update_firebase):
+        at = timezone.make_aware(datetime.combine(timezone.localdate(), time(9, 40)))
+        log = [AppointmentEvent(appointment_id=i, doctor=self.doctor, department=self.doctor.department,
+                                kind='booked', at=at) for i in range(5)]
+        log.append(AppointmentEvent(appointment_id=0, doctor=self.doctor, department=self.doctor.department,
+                                    kind='called', at=at + timedelta(minutes=30), wait_minutes=30))
+        AppointmentEvent.objects.bulk_create(log)
+        later = timezone.now() + timedelta(seconds=settings.ROLLUP_LAG_SECONDS + 1)
+
+        self.assertEqual(analytics.roll_up(batch_size=4, now=later), 6)  # Two batches
+        self.assertEqual(analytics.roll_up(now=later), 0)
+        AppointmentEvent.objects.create(appointment_id=0, doctor=self.doctor, department=self.doctor.department,
+                                        kind='completed', at=at + timedelta(minutes=45), duration_minutes=15)
+        self.assertEqual(analytics.roll_up(now=later), 1)
+
+        hours = DoctorRollup.objects.filter(doctor=self.doctor, period='hour').order_by('start')
+        nine, ten = hours
+        self.assertEqual(nine.start, at.replace(minute=0))
+        self.assertEqual((nine.booked, nine.called, nine.completed), (5, 0, 0))
+        self.assertEqual((ten.called, ten.wait_minutes, ten.completed, ten.consultation_minutes), (1, 30, 1, 15))
+        day = DepartmentRollup.objects.get(period='day')
+        self.assertEqual((day.booked, day.called, day.completed), (5, 1, 1))
+        self.assertEqual(DepartmentRollup.objects.count(), 3)
+
+    @override_settings(ROLLUP_LAG_SECONDS=60)
+    def test_event_committed_after_a_higher_id_is_still_counted(self, update_firebase):
+        # Postgres: the transaction holding id 10 commits after id 11 is already visible
+        now = timezone.now()
+        event = dict(doctor=self.doctor, department=self.doctor.department, kind='booked', at=now)
+        AppointmentEvent.objects.create(id=11, appointment_id=2, recorded_at=now, **event)
+        self.assertEqual(analytics.roll_up(now=now + timedelta(seconds=30)), 0)  # Too young: 10 may be coming
+        AppointmentEvent.objects.create(id=10, appointment_id=1, recorded_at=now - timedelta(seconds=1), **event)
+
+        self.assertEqual(analytics.roll_up(now=now + timedelta(seconds=61)), 2)
+        self.assertEqual(DepartmentRollup.objects.get(period='day').booked, 2)
+        self.assertEqual(RollupCheckpoint.objects.get().last_event_id, 11)
+
+    def test_admin_report_reads_only_the_rollups(self, update_firebase):
+        today = timezone.localdate()
+        DepartmentRollup.objects.bulk_create([
+            DepartmentRollup(department=self.doctor.department, period='day',
+                             start=timezone.make_aware(datetime.combine(today, time.min)),
+                             booked=12, called=10, completed=10, wait_minutes=150),
+            DepartmentRollup(department=self.doctor.department, period='hour',
+                             start=timezone.make_aware(datetime.combine(today, time(9))), completed=10),
+        ])
+        report = analytics.report(today, today)
+        self.assertEqual(report['totals'][0]['average_wait'], 15)
+        self.assertEqual(report['patients_per_hour'], {"General Medicine": [10]})
+
+        User.objects.filter(pk=self.doctor.user.pk).update(is_staff=True, is_superuser=True)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('admin:hospital_departmentrollup_changelist'))
+        self.assertContains(response, "General Medicine")
+        self.assertFalse([q for q in queries if 'appointment' in q['sql'].lower()])
+
+
+@mock.patch('hospital.views.update_firebase')
+@override_settings(TURN_NOTIFY_PATIENTS_AHEAD=1, TURN_NOTIFY_MINUTES_AWAY=10)
+class TurnNotificationTests(HospitalTestCase):
+    def setUp(self):
+        super().setUp()
+        mail.outbox = []
+        self.doctor = make_doctor("house", avg_consultation_time=15)
+        self.queue = Appointment.objects.bulk_create([
+            Appointment(patient_name=f"P{i}", patient_email=f"p{i}@example.com" if i != 3 else None,
+                        doctor=self.doctor, token_number=i, ticket_id=f"T-{i}")
+            for i in range(1, 7)
+        ])
+        self.client.force_login(self.doctor.user)
+
+    def call(self, appointment):
+        self.client.get(reverse('call_patient', args=[appointment.id]))
+
+    def test_each_patient_is_emailed_once_as_their_turn_nears(self, update_firebase):
+        self.call(self.queue[0])  # P2 next, P3 one ahead (no email address)
+        self.assertEqual([m.to for m in mail.outbox], [["p2@example.com"]])
+        self.assertIn("You are next in line", mail.outbox[0].body)
+
+        self.call(self.queue[1])  # P3 next, P4 one ahead
+        self.call(self.queue[2])  # P4 next (already told), P5 one ahead
+        self.assertEqual([m.to[0] for m in mail.outbox], ["p2@example.com", "p4@example.com", "p5@example.com"])
+        self.assertIn("Patients ahead of you: 1", mail.outbox[1].body)
+        self.assertEqual(Appointment.objects.filter(turn_notified_at__isnull=False).count(), 3)
+
+    @override_settings(TURN_NOTIFY_PATIENTS_AHEAD=0, TURN_NOTIFY_MINUTES_AWAY=16)
+    def test_estimated_start_is_also_a_trigger(self, update_firebase):
+        Doctor.objects.filter(pk=self.doctor.pk).update(avg_consultation_time=5)
+        self.call(self.queue[0])  # 5 minutes each: P2, P3 (no email) and P4 start within 16 minutes
+        self.assertEqual({m.to[0] for m in mail.outbox}, {"p2@example.com", "p4@example.com"})
+
+    def test_batch_goes_out_over_one_connection(self, update_firebase):
+        notifier = notify.TurnNotifier(batch_size=2, autostart=False)
+        with override_settings(TURN_NOTIFY_IN_BACKGROUND=True), \
+                mock.patch('hospital.notify.get_connection', wraps=notify.get_connection) as get_connection:
+            notifier.enqueue({a.id: i for i, a in enumerate(self.queue)})
+            notifier.enqueue({self.queue[0].id: 0})  # Still one notice per appointment
+            self.assertEqual(notifier.pending, 6)
+            while notifier.pending:
+                notifier.flush()
+        self.assertEqual(len(mail.outbox), 5)  # P3 has no address
+        self.assertEqual(get_connection.call_count, 1)
+
+        # Already claimed: another worker (or process) sending the same notices sends nothing
+        other = notify.TurnNotifier(autostart=False)
+        other.enqueue({a.id: 0 for a in self.queue})
+        self.assertEqual(len(mail.outbox), 5)
+
+    def test_batch_is_claimed_in_one_update(self, update_firebase):
+        Appointment.objects.filter(pk=self.queue[1].pk).update(turn_notified_at=timezone.now())
+        notifier = notify.TurnNotifier(autostart=False)
+        with self.assertNumQueries(2):  # Claim, then read back what we claimed
+            sent = notifier._send({a.id: i for i, a in enumerate(self.queue)})
+        self.assertEqual(sent, 4)  # P2 was already told, P3 has no address
+        self.assertNotIn(["p2@example.com"], [m.to for m in mail.outbox])
+
+    def test_failed_send_is_retried_on_the_next_call(self, update_firebase):
+        with mock.patch('django.core.mail.backends.locmem.EmailBackend.send_messages', side_effect=OSError("down")):
+            self.call(self.queue[0])
+        self.assertEqual(mail.outbox, [])
+        self.assertFalse(Appointment.objects.filter(turn_notified_at__isnull=False).exists())
+        notify.queue_advanced(self.doctor)  # The next advance finds them again
+        self.assertEqual([m.to for m in mail.outbox], [["p2@example.com"]])
+
+
+class ExportTests(HospitalTestCase):
+    def setUp(self):
+        super().setUp()
+        self.doctor = make_doctor("house")
+        self.today = timezone.localdate()
+        Appointment.objects.bulk_create([
+            Appointment(patient_name=f"Live {i}", patient_email=f"live{i}@example.com", doctor=self.doctor,
+                        token_number=i, ticket_id=f"L-{i}")
+            for i in range(1, 4)
+        ])
+        old = self.today - timedelta(days=40)
+        ArchivedAppointment.objects.create(
+            id=9000, patient_name="Old, \"quoted\"", doctor=self.doctor, ticket_id="A-1", token_number=1,
+            status='completed', booked_date=old, booked_at=timezone.make_aware(datetime.combine(old, time(9))),
+        )
+        self.staff = User.objects.create_user("admin", password="pass", is_staff=True)
+
+    def url(self, **params):
+        return reverse('export_appointments') + '?' + '&'.join(f"{k}={v}" for k, v in params.items())
+
+    def test_staff_only(self):
+        self.client.force_login(self.doctor.user)
+        self.assertEqual(self.client.get(self.url()).status_code, 403)
+
+    def test_csv_streams_archived_then_live_rows(self):
+        self.client.force_login(self.staff)
+        start = self.today - timedelta(days=60)
+        response = self.client.get(self.url(start=start, end=self.today))
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Disposition'],
+                         f'attachment; filename="appointments_{start}_{self.today}.csv"')
+        lines = list(csv.reader(io.StringIO(b''.join(response.streaming_content).decode())))
+        self.assertEqual(lines[0], export.HEADERS)
+        self.assertEqual([line[4] for line in lines[1:]], ['Old, "quoted"', "Live 1", "Live 2", "Live 3"])
+        self.assertEqual(lines[2][9], "General Medicine")
+
+        # Default range: the last 30 days
+        default = b''.join(self.client.get(self.url()).streaming_content).decode()
+        self.assertEqual(len(default.splitlines()), 4)
+
+    def test_gzipped_ndjson(self):
+        self.client.force_login(self.staff)
+        response = self.client.get(self.url(format='ndjson', gzip=1))
+        self.assertEqual(response['Content-Type'], 'application/gzip')
+        records = [json.loads(line) for line in gzip.decompress(b''.join(response.streaming_content)).splitlines()]
+        self.assertEqual([r['ticket_id'] for r in records], ["L-1", "L-2", "L-3"])
+        self.assertEqual(records[0]['doctor_first_name'], "House")
+
+    def test_bad_range_is_rejected(self):
+        self.client.force_login(self.staff)
+        self.assertEqual(self.client.get(self.url(start="yesterday")).status_code, 400)
+        self.assertEqual(self.client.get(self.url(format="xml")).status_code, 400)
+
+    def test_query_count_does_not_grow_with_rows(self):
+        with CaptureQueriesContext(connection) as few:
+            list(export.export(self.today, self.today, chunk_size=2))
+        Appointment.objects.bulk_create([
+            Appointment(patient_name=f"More {i}", doctor=self.doctor, token_number=10 + i, ticket_id=f"M-{i}")
+            for i in range(200)
+        ])
+        with CaptureQueriesContext(connection) as many:
+            rows = list(export.rows(self.today, self.today, chunk_size=2))
+        self.assertEqual(len(rows), 203)
+        self.assertEqual(len(many), len(few))  # Chunks come off one cursor on SQLite
+
+    def test_command_reports_throughput(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "out.csv.gz")
+            err = io.StringIO()
+            call_command('export_appointments', '--start', str(self.today - timedelta(days=60)),
+                         '--end', str(self.today), '--gzip', '--output', path, stderr=err)
+            with open(path, 'rb') as f:
+                self.assertEqual(len(gzip.decompress(f.read()).splitlines()), 5)
+        self.assertRegex(err.getvalue(), r"Exported 4 rows .* rows/s")
+
+    async def test_asgi_streams_piece_by_piece(self):
+        await self.async_client.aforce_login(self.staff)
+        with mock.patch.object(export, 'BUFFER_BYTES', 1):
+            response = await self.async_client.get(self.url())
+            self.assertTrue(response.is_async)
+            pieces = [piece async for piece in response.streaming_content]
+        self.assertEqual(len(pieces), 4)  # Header + 3 rows, each sent on its own
+
+
+@mock.patch('hospital.views.update_firebase')
+class RoomActionTests(HospitalTestCase):
+    def setUp(self):
+        super().setUp()
+        self.doctor = make_doctor("house")
+        self.queue = Appointment.objects.bulk_create([
+            Appointment(patient_name=f"P{i}", doctor=self.doctor, token_number=i, ticket_id=f"R-{i}")
+            for i in range(1, 4)
+        ])
+        self.client.force_login(self.doctor.user)
+
+    def post(self, name, appointment):
+        return self.client.post(reverse(name, args=[appointment.id]), HTTP_ACCEPT='application/json')
+
+    def statuses(self):
+        return list(Appointment.objects.order_by('token_number').values_list('status', flat=True))
+
+    def test_call_returns_the_new_room_state(self, update_firebase):
+        data = self.post('call_patient', self.queue[0]).json()
+        self.assertTrue(data['changed'])
+        self.assertEqual(data['current'], {'id': self.queue[0].id, 'token': 1, 'name': "P1"})
+        self.assertEqual([p['token'] for p in data['waiting']], [2, 3])
+        self.assertEqual(data['total_waiting'], 2)
+
+        data = self.post('call_patient', self.queue[1]).json()
+        self.assertEqual(data['current']['token'], 2)
+        self.assertEqual(self.statuses(), ['completed', 'in_consultation', 'waiting'])
+
+    def test_repeated_clicks_change_nothing(self, update_firebase):
+        self.post('call_patient', self.queue[0])
+        again = self.post('call_patient', self.queue[0]).json()
+        self.assertFalse(again['changed'])
+        self.assertEqual(again['current']['token'], 1)
+
+        self.post('complete_appointment', self.queue[0])
+        self.assertFalse(self.post('complete_appointment', self.queue[0]).json()['changed'])
+        self.assertEqual(AppointmentEvent.objects.filter(kind='completed').count(), 1)
+        self.assertEqual(update_firebase.call_count, 2)  # Only the two real changes
+
+    def test_only_the_patient_inside_can_be_completed(self, update_firebase):
+        data = self.post('complete_appointment', self.queue[2]).json()
+        self.assertFalse(data['changed'])
+        self.assertEqual(self.statuses(), ['waiting', 'waiting', 'waiting'])
+
+    def test_a_call_clears_every_stale_patient_inside(self, update_firebase):
+        # What the old read-modify-save could leave behind after two quick clicks
+        Appointment.objects.filter(pk__in=[self.queue[0].pk, self.queue[1].pk]).update(
+            status='in_consultation', actual_start_time=timezone.now() - timedelta(minutes=10),
+        )
+        self.post('call_patient', self.queue[2])
+        self.assertEqual(self.statuses(), ['completed', 'completed', 'in_consultation'])
+        self.assertEqual(Appointment.objects.filter(status='in_consultation').count(), 1)
+
+    def test_other_doctors_patients_are_not_found(self, update_firebase):
+        other = Appointment.objects.create(patient_name="X", doctor=make_doctor("wilson"), token_number=1)
+        self.assertEqual(self.post('call_patient', other).status_code, 404)
+        self.assertEqual(Appointment.objects.get(pk=other.pk).status, 'waiting')
+
+    def test_plain_links_still_redirect(self, update_firebase):
+        response = self.client.get(reverse('call_patient', args=[self.queue[0].id]))
+        self.assertRedirects(response, reverse('doctor_dashboard'), fetch_redirect_response=False)
+        self.assertEqual(self.statuses(), ['in_consultation', 'waiting', 'waiting'])
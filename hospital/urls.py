@@ -5,6 +5,7 @@ urlpatterns = [
     # 1. Public Pages
     path('', views.home, name='home'),
     path('book/', views.patient_check_in, name='patient_check_in'),
+    path('book/bulk/', views.bulk_check_in, name='bulk_check_in'),
     path('success/<int:appointment_id>/', views.booking_success, name='booking_success'),
     
     # 2. PATIENT DASHBOARD (Login & Menu)
@@ -18,9 +19,11 @@ urlpatterns = [
     path('call/<int:appointment_id>/', views.call_patient, name='call_patient'),
     path('complete/<int:appointment_id>/', views.complete_appointment, name='complete_appointment'),
     path('toggle-duty/', views.toggle_duty, name='toggle_duty'),
+    path('export/appointments/', views.export_appointments, name='export_appointments'),
 
     # 5. Utilities
     path('get-doctors/', views.get_doctors_ajax, name='get_doctors'),
     path('pdf/<int:appointment_id>/', views.download_pdf, name='download_pdf'),
     path('display/', views.public_display, name='public_display'),
+    path('metrics', views.metrics_view, name='metrics'),
 ]
\ No newline at end of file
@@ -1,121 +1,207 @@
-from django.shortcuts import render, redirect, get_object_or_404
+from django.shortcuts import render, redirect, aget_object_or_404, get_object_or_404
 from django.utils import timezone
+from django.contrib import messages
 from django.contrib.auth.decorators import login_required
-from datetime import timedelta
-from django.http import HttpResponse, JsonResponse
-from django.template.loader import get_template
-from xhtml2pdf import pisa
-import requests
+from django.db import DatabaseError, transaction
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition, require_POST
+from django.conf import settings
+from datetime import date, timedelta
+from collections import defaultdict
+import hashlib
+import hmac
 import json
+import uuid
+from django.core.exceptions import PermissionDenied
+from django.http import FileResponse, Http404, HttpResponse, JsonResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.html import escape
+from django.utils.http import quote_etag
 
 # Import your models and forms
-from .models import Appointment, Doctor, Department
-from .forms import AppointmentForm
+from .models import Appointment, AppointmentEvent, ArchivedAppointment, Doctor, DoctorStats, Department, TokenCounter, new_ticket_ids
+from .forms import AppointmentForm, BulkAppointmentForm
+from .firebase import outbox, update_firebase
+from . import admission, consultation, events, export, metrics, notify, queue_state
+from .queue_state import aget_queue_state, aget_queue_states, get_queue_state, get_queue_states
+from .estimation import reestimate_queue
+from .archive import patient_history
+from .rebalance import rebalance_off_duty
+from .pdf import PDFRenderError, prerender_token_pdf, token_pdf
 
 # ==========================================
-# 1. FIREBASE CONFIGURATION (Real-Time)
-# ==========================================
-FIREBASE_DB_URL = "https://smarthospital-63b2c-default-rtdb.firebaseio.com"
-
-def get_last_token_from_firebase(doctor_id):
-    """Fetches the absolute last issued token from Firebase, handling missing or messy data."""
-    try:
-        url = f"{FIREBASE_DB_URL}/doctors/{doctor_id}/last_issued_token.json"
-        response = requests.get(url, timeout=5)
-        token_data = response.json()
-        
-        # Debugging print - look at your terminal when you book a token!
-        print(f"DEBUG Firebase Fetch: Doctor {doctor_id} returned: {token_data} (Type: {type(token_data)})")
-
-        if token_data is None:
-            return 0
-            
-        # If it comes back as a dictionary (e.g., if you accidentally nested it in Firebase)
-        if isinstance(token_data, dict):
-            print("⚠️ WARNING: Firebase returned a dictionary, not a number. Resetting to 0.")
-            return 0
-            
-        # Convert to int, strip quotes if it's a string
-        return int(str(token_data).strip('"\''))
-        
-    except Exception as e:
-        print(f"⚠️ Firebase Fetch Error: {e}")
-        return 0
-
-def update_firebase(doctor_id, current_serving, status, doctor_name, update_last_issued=None):
-    """
-    Sends live updates. 
-    If update_last_issued is a number, it updates the 'high water mark' counter.
-    """
-    try:
-        url = f"{FIREBASE_DB_URL}/doctors/{doctor_id}.json"
-        
-        # Base data for the doctor's live card
-        data = {
-            "status": status,
-            "doctor_name": doctor_name,
-            "last_updated": str(timezone.now())
-        }
-        
-        # Only update current_token if a doctor is calling a patient
-        if current_serving > 0:
-            data["current_token"] = current_serving
-            
-        # Update the counter ONLY if we are booking (pass the new token number here)
-        if update_last_issued is not None:
-            data["last_issued_token"] = update_last_issued
-
-        requests.patch(url, data=json.dumps(data), timeout=5)
-    except Exception as e:
-        print(f"⚠️ Firebase Sync Error: {e}")
-
-# ==========================================
-# 2. PATIENT & PUBLIC VIEWS
+# 1. PATIENT & PUBLIC VIEWS
 # ==========================================
 
 def home(request):
     return render(request, 'hospital/home.html')
 
-def get_doctors_ajax(request):
+@cache_control(no_cache=True)
+@condition(etag_func=lambda request: doctors_etag(request))
+async def get_doctors_ajax(request):
     department_id = request.GET.get('department_id')
-    doctors = Doctor.objects.filter(department_id=department_id, is_on_duty=True).values('id', 'user__first_name', 'user__last_name')
-    return JsonResponse({'doctors': list(doctors)})
+    doctors = [doc async for doc in Doctor.objects.filter(
+        department_id=department_id, is_on_duty=True
+    ).select_related('user')]
+    states = await aget_queue_states(doctors)
+    return JsonResponse({'doctors': [{
+        'id': doc.id,
+        'user__first_name': doc.user.first_name,
+        'user__last_name': doc.user.last_name,
+        'waiting': states[doc.id].total_waiting,
+        'avg_consultation_time': doc.avg_consultation_time,
+    } for doc in doctors]})
 
 def patient_check_in(request):
     departments = Department.objects.all() 
 
     if request.method == 'POST':
+        # One key per rendered form: a double submit must not book twice
+        idempotency_key = request.POST.get('idempotency_key')
+        try:
+            booked_id = admission.claim('check_in', idempotency_key)
+        except admission.IdempotencyConflict:
+            return HttpResponse("Your booking is still being processed. Please wait a moment.", status=409)
+        if booked_id is not None:
+            return redirect('booking_success', appointment_id=booked_id)
+
         form = AppointmentForm(request.POST)
-        if form.is_valid():
-            appointment = form.save(commit=False)
-            doctor = appointment.doctor
-            
-            # 1. Get last token from Firebase
-            last_token_fb = get_last_token_from_firebase(doctor.id)
-            
-            # 2. Safety Check: If server hasn't reset, local count might be higher
-            today = timezone.now().date()
-            local_count = Appointment.objects.filter(doctor=doctor, booked_at__date=today).count()
-            
-            # 3. Calculate new token (The Max ensures we never duplicate)
-            new_token = max(last_token_fb, local_count) + 1
-            appointment.token_number = new_token
-            
-            # 4. SYNC TO FIREBASE: Pass new_token to update_last_issued
+        booked = False
+        try:
+            if form.is_valid():
+                appointment = form.save(commit=False)
+                doctor = appointment.doctor
+                
+                appointment.patient_email = request.POST.get('patient_email') 
+
+                # Initial Estimation: everyone already waiting, at the doctor's expected speed
+                people_ahead = get_queue_state(doctor).total_waiting
+                wait_minutes = people_ahead * DoctorStats.expected_minutes(doctor)
+                appointment.estimated_start_time = timezone.now() + timedelta(minutes=wait_minutes)
+
+                # 1. Allocate token + save in one short transaction (no network inside)
+                with queue_state.applied_by_caller(), transaction.atomic():
+                    new_token = TokenCounter.allocate(doctor)
+                    appointment.token_number = new_token
+                    appointment.save()
+                    AppointmentEvent.record(appointment, 'booked')
+                booked = True
+        finally:
+            if booked:
+                admission.complete('check_in', idempotency_key, appointment.id)
+            else:
+                admission.release('check_in', idempotency_key)  # A corrected form reuses the key
+
+        if booked:
+            # 2. SYNC TO FIREBASE: only publish the token once it is committed
+            queue_state.on_booked(appointment)
             update_firebase(doctor.id, 0, "Live", doctor.user.first_name, update_last_issued=new_token)
-            
-            appointment.patient_email = request.POST.get('patient_email') 
-            
-            # Initial Estimation
-            wait_minutes = (new_token - 1) * doctor.avg_consultation_time
-            appointment.estimated_start_time = timezone.now() + timedelta(minutes=wait_minutes)
-            
-            appointment.save()
+            publish_queue_event('booked', doctor, appointment)
+            prerender_token_pdf(appointment)
             return redirect('booking_success', appointment_id=appointment.id)
     else:
         form = AppointmentForm()
-    
-    return render(request, 'hospital/checkin.html', {'form': form, 'departments': departments})
+        idempotency_key = None
+
+    return render(request, 'hospital/checkin.html', {
+        'form': form,
+        'departments': departments,
+        'idempotency_key': idempotency_key or uuid.uuid4().hex,
+    })
+
+MAX_BULK_BOOKINGS = 500
+
+@login_required
+@require_POST
+def bulk_check_in(request):
+    """
+    Books a whole batch (kiosk uploads, health camps) in one request.
+
+    Body: {"bookings": [{"patient_name": ..., "patient_email": ..., "doctor": <id>}, ...]}
+    All or nothing: any invalid row rejects the batch with per-row errors.
+    Each doctor gets one contiguous token range, and the rows are inserted
+    with bulk_create, so the query count does not grow with the batch size.
+    Resending with the same Idempotency-Key header returns the first answer.
+    """
+    idempotency_scope = f"bulk_check_in:{request.user.pk}"
+    idempotency_key = request.headers.get('Idempotency-Key')
+    try:
+        replay = admission.claim(idempotency_scope, idempotency_key)
+    except admission.IdempotencyConflict:
+        return JsonResponse({'error': 'A batch with this Idempotency-Key is still being booked.'}, status=409)
+    if replay is not None:
+        return JsonResponse(replay, status=201)
+    try:
+        response = _bulk_check_in(request)
+    except Exception:
+        admission.release(idempotency_scope, idempotency_key)
+        raise
+    if response.status_code == 201:
+        admission.complete(idempotency_scope, idempotency_key, json.loads(response.content))
+    else:
+        admission.release(idempotency_scope, idempotency_key)
+    return response
+
+def _bulk_check_in(request):
+    try:
+        bookings = json.loads(request.body).get('bookings')
+    except (ValueError, AttributeError):
+        bookings = None
+    if not isinstance(bookings, list) or not all(isinstance(row, dict) for row in bookings):
+        return JsonResponse({'error': 'Expected {"bookings": [{...}, ...]}.'}, status=400)
+    if not bookings or len(bookings) > MAX_BULK_BOOKINGS:
+        return JsonResponse({'error': f'Send between 1 and {MAX_BULK_BOOKINGS} bookings.'}, status=400)
+
+    # 1. Validate every row; doctors are loaded once for the whole batch
+    doctor_ids = {int(row['doctor']) for row in bookings if str(row.get('doctor')).isdigit()}
+    doctors = Doctor.objects.select_related('user').in_bulk(doctor_ids)
+    booking_forms = [BulkAppointmentForm(row, doctors=doctors) for row in bookings]
+    errors = {i: form.errors.get_json_data() for i, form in enumerate(booking_forms) if not form.is_valid()}
+    if errors:
+        return JsonResponse({'errors': errors}, status=400)
+
+    by_doctor = defaultdict(list)
+    for form in booking_forms:
+        appointment = form.save(commit=False)
+        by_doctor[appointment.doctor].append(appointment)
+
+    # 2. Estimates: everyone already waiting, then this batch in order
+    now = timezone.now()
+    states = get_queue_states(by_doctor)
+    for doctor, appointments in by_doctor.items():
+        minutes = DoctorStats.expected_minutes(doctor)
+        for position, appointment in enumerate(appointments, start=states[doctor.id].total_waiting):
+            appointment.estimated_start_time = now + timedelta(minutes=position * minutes)
+
+    # 3. One token range per doctor + one bulk insert, in one transaction
+    appointments = [appointment for batch in by_doctor.values() for appointment in batch]
+    for appointment, ticket_id in zip(appointments, new_ticket_ids(len(appointments))):
+        appointment.ticket_id = ticket_id
+    with transaction.atomic():
+        for doctor, batch in by_doctor.items():
+            first_token = TokenCounter.allocate(doctor, count=len(batch))
+            for offset, appointment in enumerate(batch):
+                appointment.token_number = first_token + offset
+        Appointment.objects.bulk_create(appointments)
+        AppointmentEvent.objects.bulk_create(
+            [AppointmentEvent.for_appointment(appointment, 'booked') for appointment in appointments]
+        )
+
+    # 4. Same post-commit fan-out as a single booking, once per doctor
+    for doctor, batch in by_doctor.items():
+        queue_state.on_booked_many(doctor, batch)
+        update_firebase(doctor.id, 0, "Live", doctor.user.first_name, update_last_issued=batch[-1].token_number)
+        for appointment in batch:
+            publish_queue_event('booked', doctor, appointment)
+
+    # Tickets come back in the order they were sent
+    return JsonResponse({'tickets': [{
+        'id': form.instance.id,
+        'ticket_id': form.instance.ticket_id,
+        'token_number': form.instance.token_number,
+        'doctor': form.instance.doctor_id,
+        'estimated_start_time': form.instance.estimated_start_time,
+    } for form in booking_forms]}, status=201)
 
 def booking_success(request, appointment_id):
     appointment = get_object_or_404(Appointment, id=appointment_id)
@@ -125,7 +211,8 @@ def patient_dashboard(request):
     email = request.GET.get('email')
     history = []
     if email:
-        history = Appointment.objects.filter(patient_email=email).order_by('-booked_at')
+        # Recent visits from the live table, older ones from the archive
+        history = patient_history(email)
 
     if request.method == "POST":
         input_id = request.POST.get('ticket_id').strip() 
@@ -133,25 +220,27 @@ def patient_dashboard(request):
             appointment = Appointment.objects.get(ticket_id=input_id)
             return redirect('patient_live_status', appointment_id=appointment.id)
         except Appointment.DoesNotExist:
+            finished = ArchivedAppointment.objects.filter(ticket_id=input_id).exists()
             return render(request, 'hospital/patient_dashboard.html', {
-                'error': "Invalid Ticket ID.",
+                'error': "This visit is already completed." if finished else "Invalid Ticket ID.",
                 'history': history
             })
 
     return render(request, 'hospital/patient_dashboard.html', {'history': history})
 
-def patient_live_status(request, appointment_id):
-    appointment = get_object_or_404(Appointment, id=appointment_id)
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=lambda request, appointment_id: live_status_etag(request, appointment_id))
+async def patient_live_status(request, appointment_id):
+    appointment = await aget_object_or_404(
+        Appointment.objects.select_related('doctor__user', 'doctor__department'), id=appointment_id
+    )
     doctor = appointment.doctor
+    queue_state.remember_doctors([appointment])  # Lets the next poll be answered from its ETag
     
-    # local counting for "people ahead" is okay for current session
-    people_ahead = Appointment.objects.filter(
-        doctor=doctor, 
-        status='waiting', 
-        token_number__lt=appointment.token_number
-    ).count()
+    # "People ahead" comes from the cached queue (bisect), not a COUNT query
+    people_ahead = (await aget_queue_state(doctor)).people_ahead(appointment.token_number)
     
-    estimated_wait_minutes = people_ahead * doctor.avg_consultation_time
+    estimated_wait_minutes = round(people_ahead * await DoctorStats.aexpected_minutes(doctor))
     
     context = {
         'appointment': appointment,
@@ -159,31 +248,32 @@ def patient_live_status(request, appointment_id):
         'people_ahead': people_ahead,
         'estimated_wait_minutes': estimated_wait_minutes
     }
-    return render(request, 'hospital/patient_live_status.html', context)
+    return await arender(request, 'hospital/patient_live_status.html', context)
+
+@cache_control(no_cache=True)
+@condition(etag_func=lambda request: display_etag(request))
+async def public_display(request):
+    # One query for the roster; queues come from the cache (rebuilt in one batch on a miss)
+    active_doctors = [doc async for doc in Doctor.objects.filter(is_on_duty=True).select_related('department', 'user')]
+    states = await aget_queue_states(active_doctors)
 
-def public_display(request):
-    active_doctors = Doctor.objects.filter(is_on_duty=True).select_related('department', 'user')
     doctor_data = []
-    
     for doc in active_doctors:
-        current = Appointment.objects.filter(doctor=doc, status='in_consultation').first()
-        
-        # 1. Get ALL waiting patients to count them
-        all_waiting = Appointment.objects.filter(doctor=doc, status='waiting').order_by('token_number')
-        
+        state = states[doc.id]
+        has_current = state.current_id is not None
         doctor_data.append({
             'doctor': doc, 
             'dept': doc.department.name,
-            'current_token': current.token_number if current else "--",
-            'current_name': current.patient_name if current else "Available",
-            'waiting': all_waiting[:3],         # Just the next 3 names for the UI
-            'total_waiting': all_waiting.count() # The true total count of everyone
+            'current_token': state.current_token if has_current else "--",
+            'current_name': state.current_name if has_current else "Available",
+            'waiting': state.waiting(limit=3),       # Just the next 3 names for the UI
+            'total_waiting': state.total_waiting     # The true total count of everyone
         })
         
-    return render(request, 'hospital/display.html', {'doctors': doctor_data})
+    return await arender(request, 'hospital/display.html', {'doctors': doctor_data})
 
 # ==========================================
-# 3. DOCTOR & ADMIN VIEWS
+# 2. DOCTOR & ADMIN VIEWS
 # ==========================================
 
 @login_required
@@ -193,14 +283,15 @@ def doctor_dashboard(request):
     except Exception:
         return render(request, 'hospital/error.html', {'message': "Access Denied."})
 
-    current_patient = Appointment.objects.filter(doctor=doctor, status='in_consultation').first()
-    queue = Appointment.objects.filter(doctor=doctor, status='waiting').order_by('token_number')
+    state = get_queue_state(doctor)
+    current_patient = state.current
+    queue = state.waiting()
     
-    today = timezone.now().date()
+    today = timezone.localdate()
     history = Appointment.objects.filter(
         doctor=doctor, 
         status='completed',
-        booked_at__date=today
+        booked_date=today
     ).order_by('-actual_end_time')
 
     return render(request, 'hospital/dashboard.html', {
@@ -213,71 +304,210 @@ def doctor_dashboard(request):
 @login_required
 def call_patient(request, appointment_id):
     doctor = request.user.doctor
-    
-    # 1. FINISH PREVIOUS PATIENT
-    current_patient = Appointment.objects.filter(doctor=doctor, status='in_consultation').first()
-    if current_patient:
-        current_patient.status = 'completed'
-        current_patient.actual_end_time = timezone.now()
-        if current_patient.actual_start_time:
-            duration = current_patient.actual_end_time - current_patient.actual_start_time
-            duration_minutes = duration.total_seconds() / 60
-            doctor.update_average_time(duration_minutes)
-        current_patient.save()
-
-    # 2. START NEW PATIENT
-    new_patient = get_object_or_404(Appointment, id=appointment_id)
-    new_patient.status = 'in_consultation'
-    new_patient.actual_start_time = timezone.now()
-    new_patient.save()
-    
-    # 3. SYNC FIREBASE
+
+    # 1. FINISH PREVIOUS + START NEW: conditional UPDATEs, a repeated click changes nothing
+    called = consultation.call_in(doctor, appointment_id)
+    if called is None:
+        return _room_response(request, doctor, appointment_id, changed=False)
+    new_patient, _ = called
+
+    # 2. SYNC CACHED QUEUE + ESTIMATES + FIREBASE + "YOUR TURN IS NEAR" EMAILS
+    queue_state.on_called(doctor, new_patient)
+    reestimate_queue(doctor)
+    notify.queue_advanced(doctor)
     update_firebase(doctor.id, new_patient.token_number, "Live", doctor.user.first_name)
-    
-    return redirect('doctor_dashboard')
+    publish_queue_event('called', doctor, new_patient)
+    return _room_response(request, doctor, appointment_id)
 
 @login_required
 def complete_appointment(request, appointment_id):
-    appointment = get_object_or_404(Appointment, id=appointment_id)
-    appointment.status = 'completed'
-    appointment.actual_end_time = timezone.now()
-    
-    if appointment.actual_start_time:
-        duration = appointment.actual_end_time - appointment.actual_start_time
-        duration_minutes = duration.total_seconds() / 60
-        appointment.doctor.update_average_time(duration_minutes)
-    else:
-        appointment.actual_start_time = appointment.actual_end_time
-    
-    appointment.save()
-    update_firebase(appointment.doctor.id, 0, "Live", appointment.doctor.user.first_name)
-    return redirect('doctor_dashboard')
+    doctor = request.user.doctor
+    appointment = consultation.complete(doctor, appointment_id)
+    if appointment is None:
+        return _room_response(request, doctor, appointment_id, changed=False)
+
+    queue_state.on_completed(appointment)
+    reestimate_queue(doctor)
+    update_firebase(doctor.id, 0, "Live", doctor.user.first_name)
+    publish_queue_event('completed', doctor, appointment)
+    return _room_response(request, doctor, appointment_id)
+
+def _room_response(request, doctor, appointment_id, changed=True):
+    """
+    The dashboard's fetch() asks for JSON: the room's new state, applied in
+    place. A plain link click (no JavaScript) still gets the redirect.
+    """
+    if not changed and not Appointment.objects.filter(pk=appointment_id, doctor=doctor).exists():
+        raise Http404("No such appointment in your queue.")
+    if request.get_preferred_type(['text/html', 'application/json']) != 'application/json':
+        return redirect('doctor_dashboard')
+    state = get_queue_state(doctor)
+    current = state.current
+    return JsonResponse({
+        'changed': changed,
+        'version': state.version,
+        'current': current and {'id': current['id'], 'token': current['token_number'], 'name': current['patient_name']},
+        'waiting': [{'id': p['id'], 'token': p['token_number'], 'name': p['patient_name']} for p in state.waiting()],
+        'total_waiting': state.total_waiting,
+    })
 
 @login_required
 def toggle_duty(request):
     try:
         doctor = request.user.doctor
-        doctor.is_on_duty = not doctor.is_on_duty
-        doctor.save()
-        status = "Live" if doctor.is_on_duty else "Offline"
-        update_firebase(doctor.id, 0, status, doctor.user.first_name)
-    except:
-        pass
+    except Doctor.DoesNotExist:
+        return render(request, 'hospital/error.html', {'message': "Access Denied."})
+
+    try:
+        # The flip and the hand-over commit together: if the rebalance fails, the doctor stays on duty
+        with queue_state.applied_by_caller(), transaction.atomic():
+            doctor.is_on_duty = not doctor.is_on_duty
+            doctor.save()
+            moved = {} if doctor.is_on_duty else rebalance_off_duty(doctor)
+    except DatabaseError as e:
+        print(f"⚠️ Duty toggle error: {e}")
+        messages.error(request, "Your duty status could not be changed. Please try again.")
+        return redirect('doctor_dashboard')
+
+    # Committed: now the caches, Firebase and the live screens
+    queue_state.on_duty_changed(doctor)
+    queue_state.on_reassigned(doctor, moved)
+    for colleague, patients in moved.items():
+        update_firebase(colleague.id, 0, "Live", colleague.user.first_name,
+                        update_last_issued=patients[-1].token_number)
+        for appointment in patients:
+            publish_queue_event('booked', colleague, appointment)
+    status = "Live" if doctor.is_on_duty else "Offline"
+    update_firebase(doctor.id, 0, status, doctor.user.first_name)
+    publish_queue_event('duty', doctor)
     return redirect('doctor_dashboard')
 
+@login_required
+def export_appointments(request):
+    """
+    Streams appointments booked between ?start= and ?end= (YYYY-MM-DD, default
+    the last 30 days) as ?format=csv|ndjson, gzipped with ?gzip=1. Staff only.
+    """
+    if not request.user.is_staff:
+        raise PermissionDenied
+    try:
+        end = date.fromisoformat(request.GET['end']) if request.GET.get('end') else timezone.localdate()
+        start = date.fromisoformat(request.GET['start']) if request.GET.get('start') else end - timedelta(days=29)
+    except ValueError:
+        return HttpResponse("start and end must be YYYY-MM-DD dates.", status=400)
+    fmt = request.GET.get('format', 'csv')
+    if fmt not in export.FORMATS or start > end:
+        return HttpResponse("Unknown format, or start is after end.", status=400)
+    compress = request.GET.get('gzip') == '1'
+
+    stream = export.export(start, end, fmt, gzip=compress)
+    if hasattr(request, 'scope'):
+        stream = export.aiterate(stream)  # ASGI: piece by piece, not read into memory first
+    response = StreamingHttpResponse(
+        stream,
+        content_type='application/gzip' if compress else f"{export.CONTENT_TYPES[fmt]}; charset=utf-8",
+    )
+    response['Content-Disposition'] = f'attachment; filename="{export.filename(start, end, fmt, compress)}"'
+    response['Cache-Control'] = 'private, no-store'
+    return response
+
 # ==========================================
-# 4. UTILITIES
+# 3. UTILITIES
 # ==========================================
 
+# ETags for the polled read views. They come only from cached version counters
+# (queue_state.py), so an unchanged poll gets a 304 with no query and no template.
+
+def doctors_etag(request):
+    department_id = request.GET.get('department_id', '')
+    if not department_id.isdigit():
+        return None
+    return f"roster-{department_id}-{queue_state.roster_version(int(department_id))}"
+
+def display_etag(request):
+    return f"board-{queue_state.board_version()}"
+
+def live_status_etag(request, appointment_id):
+    doctor_id = queue_state.doctor_of(appointment_id)
+    if doctor_id is None or 'messages' in request.COOKIES:
+        return None  # Unknown yet, or a one-off flash message to show
+    # The wait estimate depends on the hour; base.html shows who is logged in
+    hour = timezone.localtime().strftime('%Y%m%d%H')
+    viewer = hashlib.sha256(request.COOKIES.get(settings.SESSION_COOKIE_NAME, '').encode()).hexdigest()[:8]
+    return f"live-{appointment_id}-{queue_state.doctor_version(doctor_id)}-{hour}-{viewer}"
+
+async def arender(request, template_name, context):
+    """
+    render() for async views. Loads the user (and with it the session) first,
+    so templates reading `user` or messages never query from the event loop.
+    """
+    request.user = await request.auser()
+    return render(request, template_name, context)
+
+def publish_queue_event(event_type, doctor, appointment=None):
+    """Pushes the doctor's new queue card (and the patient involved) to live screens."""
+    if not events.broker.subscriber_count:
+        return  # Nobody is listening (e.g. plain WSGI), skip the work
+
+    state = get_queue_state(doctor)
+    data = {
+        'doctor_id': doctor.id,
+        'on_duty': doctor.is_on_duty,
+        'current_token': state.current_token,
+        'current_name': state.current_name,
+        'waiting': [{'token': p['token_number'], 'name': p['patient_name']} for p in state.waiting(limit=3)],
+        'total_waiting': state.total_waiting,
+    }
+    if appointment is not None:
+        data['appointment'] = {
+            'id': appointment.id,
+            'token': appointment.token_number,
+            'name': appointment.patient_name,
+            'status': appointment.status,
+        }
+    events.publish(event_type, data)
+
 def download_pdf(request, appointment_id):
-    appointment = get_object_or_404(Appointment, id=appointment_id)
-    template_path = 'hospital/pdf_token.html'
-    context = {'appointment': appointment}
-    response = HttpResponse(content_type='application/pdf')
-    response['Content-Disposition'] = f'attachment; filename="Token_{appointment.token_number}.pdf"'
-    template = get_template(template_path)
-    html = template.render(context)
-    pisa_status = pisa.CreatePDF(html, dest=response)
-    if pisa_status.err:
-        return HttpResponse('We had some errors <pre>' + html + '</pre>')
-    return response
\ No newline at end of file
+    appointment = get_object_or_404(
+        Appointment.objects.select_related('doctor__user', 'doctor__department'), id=appointment_id
+    )
+    try:
+        path, digest = token_pdf(appointment)
+    except PDFRenderError as e:
+        return HttpResponse('We had some errors <pre>' + escape(str(e)) + '</pre>')
+
+    # Same ticket version the client already has: skip the body entirely
+    not_modified = get_conditional_response(request, etag=quote_etag(digest))
+    if not_modified is not None:
+        return not_modified
+
+    try:
+        pdf_file = open(path, 'rb')
+    except FileNotFoundError:
+        # A newer version of the ticket replaced it a moment ago
+        path, digest = token_pdf(appointment)
+        pdf_file = open(path, 'rb')
+    response = FileResponse(
+        pdf_file, as_attachment=True, filename=f"Token_{appointment.token_number}.pdf",
+        content_type='application/pdf',
+    )
+    response['ETag'] = quote_etag(digest)
+    response['Cache-Control'] = 'private, no-cache'
+    return response
+
+def metrics_view(request):
+    """
+    Prometheus scrape target, for staff or a scraper sending
+    "Authorization: Bearer <METRICS_TOKEN>". View names and query counts
+    are not for the public.
+    """
+    token = settings.METRICS_TOKEN
+    offered = request.headers.get('Authorization', '').removeprefix('Bearer ')
+    if not (token and hmac.compare_digest(offered.encode(), token.encode())) and not request.user.is_staff:
+        raise PermissionDenied
+    return HttpResponse(metrics.render(extra=[
+        ('hospital_firebase_outbox_pending', 'gauge', 'Doctors with unsent Firebase changes.', outbox.pending),
+        ('hospital_firebase_outbox_dropped_total', 'counter', 'Updates dropped because the outbox was full.',
+         outbox.dropped),
+        ('hospital_sse_subscribers', 'gauge', 'Connected live screens.', events.broker.subscriber_count),
+    ]), content_type=metrics.CONTENT_TYPE)
@@ -0,0 +1,43 @@
+"""
+Background warm-up of the libraries the app imports lazily.
+
+On a cold start (Cloud Run scaling from zero) nothing heavy is imported
+before the first response. The PDF stack (xhtml2pdf pulls in reportlab,
+html5lib and friends) loads on the first ticket download, and the Firebase
+HTTP client loads on the outbox's first flush. Once the first response has
+gone out, a daemon thread imports them anyway, so the first patient to
+download a ticket doesn't pay for it either.
+
+`manage.py startup_benchmark` checks that none of these are loaded before
+the first response.
+"""
+import importlib
+import threading
+
+from django.core.signals import request_finished
+
+MODULES = ('requests', 'xhtml2pdf.pisa', 'pypdf')
+
+DISPATCH_UID = 'hospital.warmup'
+
+_lock = threading.Lock()
+_started = False
+
+
+def warm_up(modules=MODULES):
+    for name in modules:
+        try:
+            importlib.import_module(name)
+        except Exception as e:
+            print(f"⚠️ Warm-up could not import {name}: {e}")
+
+
+def on_first_request(sender, **kwargs):
+    """request_finished receiver: starts the warm-up thread once, then disconnects."""
+    global _started
+    with _lock:
+        if _started:
+            return
+        _started = True
+    request_finished.disconnect(dispatch_uid=DISPATCH_UID)
+    threading.Thread(target=warm_up, name='hospital-warmup', daemon=True).start()